@@ -7,6 +7,8 @@ Responsabilidades deste app:
 """
 
 import datetime
+import decimal
+import numpy as np
 from django.db import models
 from django.urls import reverse
 from django.contrib.contenttypes.fields import GenericRelation
@@ -63,16 +65,24 @@ class Ativo(models.Model):
     def retorno_do_periodo(self, data_inicio, data_fim, dividendos=False):
         """
         dividendos indica se um ativo deve ser reajustado de acordo com os
-        dividendos distribuídos no período.
+        dividendos distribuídos no período. Com ou sem o ajuste, o retorno usa
+        os preços de fechamento das próprias datas de início e fim, e levanta
+        Preco.DoesNotExist se faltar algum deles.
         """
         import mercado.models as mm
         if dividendos == False:
-            preco_inicio = mm.Preco.objects.get(ativo=self, \
-                data_referencia=data_inicio)
-            preco_fim = mm.Preco.objects.get(ativo=self, data_referencia=data_fim)
-            return preco_fim.preco_fechamento/preco_inicio.preco_fechamento - 1
+            precos = dict(mm.Preco.objects.filter(ativo=self,
+                data_referencia__in=(data_inicio, data_fim)).\
+                values_list('data_referencia', 'preco_fechamento'))
+            if data_inicio not in precos or data_fim not in precos:
+                raise mm.Preco.DoesNotExist("Preço indisponível: " + self.nome)
+            return precos[data_fim]/precos[data_inicio] - 1
         else:
-            return 0
+            retorno = mm.IndiceRetornoTotal.retornos([self.id], data_inicio,
+                data_fim, exato=True)[self.id]
+            if np.isnan(retorno):
+                raise mm.Preco.DoesNotExist("Preço indisponível: " + self.nome)
+            return decimal.Decimal(retorno).quantize(decimal.Decimal('1.000000000000'))
 
 class Renda_Fixa(Ativo):
     TIPO_INFO_CHOICES = (
@@ -59,8 +59,7 @@ class BoletaAcaoAdmin(ImportExportModelAdmin):
     actions = ['fechar_boleta']
 
     def fechar_boleta(self, request, queryset):
-        for boleta in queryset:
-            boleta.fechar_boleta()
+        models.BoletaAcao.fechar_em_lote(queryset)
 
     fechar_boleta.short_description = "Fechar boleta"
 
@@ -129,11 +128,18 @@ class BoletaCPRResource(resources.ModelResource):
             'data_inicio', 'data_vigencia_inicio', 'data_vigencia_fim',
             'data_pagamento', 'tipo', 'capitalizacao')
 
+class ComposicaoCPRInLine(admin.TabularInline):
+    model = models.ComposicaoCPR
+    fields = ('content_type', 'object_id', 'valor')
+    readonly_fields = fields
+    extra = 0
+
 @admin.register(models.BoletaCPR)
 class BoletaCPRAdmin(ImportExportModelAdmin):
     class Meta:
         model = models.BoletaCPR
     resource_class = BoletaCPRResource
+    inlines = [ComposicaoCPRInLine]
     list_display = ('id','descricao', 'fundo', 'valor_cheio',
         'valor_parcial', 'data_inicio', 'data_pagamento', 'content_object')
     exclude = ('deletado_em', 'content_type', 'object_id')
@@ -155,9 +161,16 @@ class BoletaProvisaoResource(resources.ModelResource):
         fields = ('id', 'descricao', 'caixa_alvo', 'fundo', 'data_pagamento',
             'financeiro', 'estado')
 
+class ComposicaoProvisaoInLine(admin.TabularInline):
+    model = models.ComposicaoProvisao
+    fields = ('content_type', 'object_id', 'valor')
+    readonly_fields = fields
+    extra = 0
+
 @admin.register(models.BoletaProvisao)
 class BoletaProvisaoAdmin(ImportExportModelAdmin):
     resource_class = BoletaProvisaoResource
+    inlines = [ComposicaoProvisaoInLine]
     list_display = ('descricao', 'caixa_alvo', 'fundo', 'data_pagamento', 'financeiro')
     exclude = ('deletado_em', )
 
@@ -251,3 +264,11 @@ class BoletaCambioAdmin(ImportExportModelAdmin):
         'cambio', 'taxa', 'financeiro_origem', 'financeiro_final', \
         'data_liquidacao_origem', 'data_liquidacao_destino')
     exclude = ('deletado_em',)
+
+@admin.register(models.EventoCotizacao)
+class EventoCotizacaoAdmin(admin.ModelAdmin):
+    list_display = ('boleta', 'fundo', 'data_cotizacao', 'criado_em', \
+        'processado_em', 'reprocessar')
+    list_filter = ('fundo',)
+    readonly_fields = ('content_type', 'object_id', 'fundo', 'data_cotizacao', \
+        'processado_em')
@@ -0,0 +1,29 @@
+import time
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = 'Processa a fila de boletas de fundo cuja informação de cotização foi gravada.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fundos', nargs='*', type=int,
+            help='Ids dos fundos a processar. Por padrão, todos.')
+        parser.add_argument('--reprocessar', action='store_true',
+            help='Reprocessa as datas fechadas afetadas pelos eventos.')
+        parser.add_argument('--intervalo', type=int, default=None,
+            help='Segundos entre execuções. Sem o intervalo, processa a fila uma vez.')
+
+    def handle(self, *args, **options):
+        import boletagem.models as bm
+        import fundo.models as fm
+        while True:
+            for fundo, data in bm.EventoCotizacao.processar(options['fundos']).items():
+                self.stdout.write('%s: %s' % (fm.Fundo.objects.get(id=fundo),
+                    'reprocessar a partir de %s' % data if data else 'processado'))
+            if options['reprocessar']:
+                for fundo, dias in bm.EventoCotizacao.reprocessar_fundos().items():
+                    self.stdout.write('%s: %s dias reprocessados' % (
+                        fm.Fundo.objects.get(id=fundo), len(dias) if dias is not None else 0))
+            if options['intervalo'] is None:
+                break
+            time.sleep(options['intervalo'])
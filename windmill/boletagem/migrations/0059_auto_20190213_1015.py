@@ -0,0 +1,113 @@
+# Generated by Django 2.0 on 2019-02-13 10:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('boletagem', '0058_auto_20190207_1011'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='boletaacao',
+            name='fechada',
+            field=models.BooleanField(db_index=True, default=False),
+        ),
+        migrations.AddField(
+            model_name='boletaacao',
+            name='proxima_acao',
+            field=models.DateField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='boletacambio',
+            name='fechada',
+            field=models.BooleanField(db_index=True, default=False),
+        ),
+        migrations.AddField(
+            model_name='boletacambio',
+            name='proxima_acao',
+            field=models.DateField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='boletacpr',
+            name='fechada',
+            field=models.BooleanField(db_index=True, default=False),
+        ),
+        migrations.AddField(
+            model_name='boletacpr',
+            name='proxima_acao',
+            field=models.DateField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='boletaemprestimo',
+            name='fechada',
+            field=models.BooleanField(db_index=True, default=False),
+        ),
+        migrations.AddField(
+            model_name='boletaemprestimo',
+            name='proxima_acao',
+            field=models.DateField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='boletafundolocal',
+            name='fechada',
+            field=models.BooleanField(db_index=True, default=False),
+        ),
+        migrations.AddField(
+            model_name='boletafundolocal',
+            name='proxima_acao',
+            field=models.DateField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='boletafundooffshore',
+            name='fechada',
+            field=models.BooleanField(db_index=True, default=False),
+        ),
+        migrations.AddField(
+            model_name='boletafundooffshore',
+            name='proxima_acao',
+            field=models.DateField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='boletapassivo',
+            name='fechada',
+            field=models.BooleanField(db_index=True, default=False),
+        ),
+        migrations.AddField(
+            model_name='boletapassivo',
+            name='proxima_acao',
+            field=models.DateField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='boletaprovisao',
+            name='fechada',
+            field=models.BooleanField(db_index=True, default=False),
+        ),
+        migrations.AddField(
+            model_name='boletaprovisao',
+            name='proxima_acao',
+            field=models.DateField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='boletarendafixalocal',
+            name='fechada',
+            field=models.BooleanField(db_index=True, default=False),
+        ),
+        migrations.AddField(
+            model_name='boletarendafixalocal',
+            name='proxima_acao',
+            field=models.DateField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='boletarendafixaoffshore',
+            name='fechada',
+            field=models.BooleanField(db_index=True, default=False),
+        ),
+        migrations.AddField(
+            model_name='boletarendafixaoffshore',
+            name='proxima_acao',
+            field=models.DateField(blank=True, db_index=True, null=True),
+        ),
+    ]
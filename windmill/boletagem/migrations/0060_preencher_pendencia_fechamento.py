@@ -0,0 +1,63 @@
+# Generated by Django 2.0 on 2019-02-13 10:20
+
+from django.db import migrations
+from django.db.models import F
+from django.db.models.functions import Least
+
+# Boletas com uma única ação no fechamento, na data de operação.
+BOLETAS_DATA_OPERACAO = ('BoletaAcao', 'BoletaRendaFixaLocal',
+    'BoletaRendaFixaOffshore', 'BoletaCambio')
+
+
+def preencher(apps, schema_editor):
+    """
+    Preenche a pendência das boletas existentes com a primeira data em que o
+    fechamento as processaria. O primeiro fechamento depois da migração
+    processa cada boleta uma vez e recalcula a sua pendência, e as boletas
+    que já passaram da data são marcadas como fechadas.
+    """
+    for nome in BOLETAS_DATA_OPERACAO:
+        apps.get_model('boletagem', nome).objects.update(proxima_acao=F('data_operacao'))
+
+    BoletaFundoLocal = apps.get_model('boletagem', 'BoletaFundoLocal')
+    BoletaFundoLocal.objects.update(proxima_acao=Least('data_cotizacao', 'data_liquidacao'))
+
+    BoletaFundoOffshore = apps.get_model('boletagem', 'BoletaFundoOffshore')
+    BoletaFundoOffshore.objects.filter(estado='Concluído').update(fechada=True)
+    BoletaFundoOffshore.objects.exclude(estado='Concluído').update( \
+        proxima_acao=Least('data_cotizacao', 'data_liquidacao'))
+
+    BoletaEmprestimo = apps.get_model('boletagem', 'BoletaEmprestimo')
+    BoletaEmprestimo.objects.exclude(data_liquidacao=None).update(fechada=True)
+    BoletaEmprestimo.objects.filter(data_liquidacao=None).update( \
+        proxima_acao=F('data_operacao'))
+
+    BoletaCPR = apps.get_model('boletagem', 'BoletaCPR')
+    BoletaCPR.objects.exclude(data_pagamento=None).update(proxima_acao=F('data_inicio'))
+
+    BoletaPassivo = apps.get_model('boletagem', 'BoletaPassivo')
+    BoletaPassivo.objects.update(proxima_acao=F('data_operacao'))
+
+    # Provisões com quantidade já foram fechadas.
+    ContentType = apps.get_model('contenttypes', 'ContentType')
+    Quantidade = apps.get_model('fundo', 'Quantidade')
+    BoletaProvisao = apps.get_model('boletagem', 'BoletaProvisao')
+    tipo = ContentType.objects.filter(app_label='boletagem', model='boletaprovisao').first()
+    fechadas = []
+    if tipo is not None:
+        fechadas = Quantidade.objects.filter(content_type_id=tipo.id).values('object_id')
+    BoletaProvisao.objects.filter(id__in=fechadas).update(fechada=True)
+    BoletaProvisao.objects.filter(fechada=False).update(proxima_acao=F('data_pagamento'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('boletagem', '0059_auto_20190213_1015'),
+        ('fundo', '0044_preencher_custodia_corretora_ativo'),
+        ('contenttypes', '0002_remove_content_type_name'),
+    ]
+
+    operations = [
+        migrations.RunPython(preencher, migrations.RunPython.noop),
+    ]
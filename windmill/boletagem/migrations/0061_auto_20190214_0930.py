@@ -0,0 +1,63 @@
+# Generated by Django 2.0 on 2019-02-14 09:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('boletagem', '0060_preencher_pendencia_fechamento'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='boletaacao',
+            name='derivados',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='boletacambio',
+            name='derivados',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='boletacpr',
+            name='derivados',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='boletaemprestimo',
+            name='derivados',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='boletafundolocal',
+            name='derivados',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='boletafundooffshore',
+            name='derivados',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='boletapassivo',
+            name='derivados',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='boletaprovisao',
+            name='derivados',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='boletarendafixalocal',
+            name='derivados',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='boletarendafixaoffshore',
+            name='derivados',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+    ]
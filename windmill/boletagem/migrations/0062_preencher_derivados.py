@@ -0,0 +1,51 @@
+# Generated by Django 2.0 on 2019-02-14 09:35
+
+from django.db import migrations
+from django.db.models import F
+
+BOLETAS = ('BoletaAcao', 'BoletaRendaFixaLocal', 'BoletaRendaFixaOffshore',
+    'BoletaFundoLocal', 'BoletaFundoOffshore', 'BoletaEmprestimo', 'BoletaCambio',
+    'BoletaProvisao', 'BoletaCPR', 'BoletaPassivo')
+
+# Bits de PendenciaFechamento.
+DERIVADOS = (
+    ('boletagem', 'BoletaProvisao', 1),
+    ('boletagem', 'BoletaCPR', 2),
+    ('fundo', 'Quantidade', 4),
+    ('fundo', 'Movimentacao', 8),
+    ('boletagem', 'BoletaPassivo', 16),
+)
+DERIVADO_CERTIFICADO = 32
+
+
+def preencher(apps, schema_editor):
+    """
+    Preenche a máscara de objetos derivados das boletas existentes, com uma
+    atualização por tipo de boleta e de objeto derivado.
+    """
+    ContentType = apps.get_model('contenttypes', 'ContentType')
+    for nome in BOLETAS:
+        boleta = apps.get_model('boletagem', nome)
+        tipo = ContentType.objects.filter(app_label='boletagem', model=nome.lower()).first()
+        if tipo is None:
+            continue
+        for app_label, nome_derivado, bit in DERIVADOS:
+            derivado = apps.get_model(app_label, nome_derivado)
+            origens = derivado.objects.filter(content_type_id=tipo.id).values('object_id')
+            boleta.objects.filter(id__in=origens).update(derivados=F('derivados').bitor(bit))
+
+    BoletaPassivo = apps.get_model('boletagem', 'BoletaPassivo')
+    certificados = BoletaPassivo.certificado_passivo.through.objects.values('boletapassivo_id')
+    BoletaPassivo.objects.filter(id__in=certificados).update( \
+        derivados=F('derivados').bitor(DERIVADO_CERTIFICADO))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('boletagem', '0061_auto_20190214_0930'),
+    ]
+
+    operations = [
+        migrations.RunPython(preencher, migrations.RunPython.noop),
+    ]
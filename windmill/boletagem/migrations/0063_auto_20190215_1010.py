@@ -0,0 +1,47 @@
+# Generated by Django 2.0 on 2019-02-15 10:10
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fundo', '0045_auto_20190215_1010'),
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('boletagem', '0062_preencher_derivados'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='boletacpr',
+            name='custodia',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, to='fundo.Custodiante'),
+        ),
+        migrations.CreateModel(
+            name='ComposicaoProvisao',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('object_id', models.PositiveIntegerField()),
+                ('valor', models.DecimalField(decimal_places=2, max_digits=16)),
+                ('content_type', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to='contenttypes.ContentType')),
+                ('provisao', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='composicao', to='boletagem.BoletaProvisao')),
+            ],
+            options={
+                'verbose_name_plural': 'Composições de provisões',
+            },
+        ),
+        migrations.CreateModel(
+            name='ComposicaoCPR',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('object_id', models.PositiveIntegerField()),
+                ('valor', models.DecimalField(decimal_places=2, max_digits=16)),
+                ('content_type', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to='contenttypes.ContentType')),
+                ('cpr', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='composicao', to='boletagem.BoletaCPR')),
+            ],
+            options={
+                'verbose_name_plural': 'Composições de CPRs',
+            },
+        ),
+    ]
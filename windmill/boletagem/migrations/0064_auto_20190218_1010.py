@@ -0,0 +1,32 @@
+# Generated by Django 2.0 on 2019-02-18 10:10
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fundo', '0045_auto_20190215_1010'),
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('boletagem', '0063_auto_20190215_1010'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EventoCotizacao',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('object_id', models.PositiveIntegerField()),
+                ('data_cotizacao', models.DateField()),
+                ('criado_em', models.DateTimeField(auto_now_add=True)),
+                ('processado_em', models.DateTimeField(blank=True, db_index=True, null=True)),
+                ('reprocessar', models.DateField(blank=True, db_index=True, null=True)),
+                ('content_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='contenttypes.ContentType')),
+                ('fundo', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='fundo.Fundo')),
+            ],
+            options={
+                'verbose_name_plural': 'Eventos de cotização',
+            },
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 2.0 on 2019-02-20 10:10
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ativos', '0029_auto_20190207_1011'),
+        ('boletagem', '0064_auto_20190218_1010'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='boletafundolocal',
+            index_together={('ativo', 'fechada', 'proxima_acao')},
+        ),
+        migrations.AlterIndexTogether(
+            name='boletafundooffshore',
+            index_together={('ativo', 'fechada', 'proxima_acao')},
+        ),
+    ]
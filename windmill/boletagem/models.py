@@ -47,10 +47,13 @@ Sobre o tratamento de boletas do ponto de vista de processo do sistema:
     relacionados devem ser atualizados com as informações relevantes também.
 
 """
+import collections
 import datetime
 from django.utils import timezone
 import decimal
-from django.db import models
+from django.db import models, transaction
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.dispatch import receiver
 from django.contrib.contenttypes.fields import GenericForeignKey, GenericRelation
 from django.contrib.contenttypes.models import ContentType
 from django.core.exceptions import ValidationError
@@ -108,9 +111,230 @@ class BaseModel(models.Model):
     # def hard_delete(self):
     #     super(BaseModel, self).delete()
 
+class PendenciaFechamento(models.Model):
+    """
+    Índice do trabalho pendente de uma boleta no fechamento dos fundos. A
+    boleta guarda a próxima data em que o fechamento deve processá-la
+    (proxima_acao) e se ainda há algo a fazer (fechada), de modo que o
+    fechamento busque apenas as boletas com ação na data, e não todas as
+    boletas do fundo. Também guarda quais objetos derivados (provisão, CPR,
+    quantidade, movimentação, boleta de passivo e certificado) já existem,
+    para que as verificações de fechamento não precisem consultar o banco.
+        Depois de fechar a boleta em uma data, o fechamento chama
+    atualizar_pendencia com essa data. Com a data vazia, calcula a pendência
+    de uma boleta que ainda não foi processada. Por padrão, a boleta tem uma
+    única ação, na data de operação.
+    """
+    # Objetos derivados da boleta, gravados como máscara de bits em
+    # derivados e mantidos pelos sinais ao final do módulo.
+    DERIVADO_PROVISAO = 1
+    DERIVADO_CPR = 2
+    DERIVADO_QUANTIDADE = 4
+    DERIVADO_MOVIMENTACAO = 8
+    DERIVADO_PASSIVO = 16
+    DERIVADO_CERTIFICADO = 32
+    DERIVADO_TODOS = 63
+
+    proxima_acao = models.DateField(null=True, blank=True, db_index=True)
+    fechada = models.BooleanField(default=False, db_index=True)
+    derivados = models.PositiveSmallIntegerField(default=0)
+
+    # Campos de data que, a partir de uma data reprocessada, tornam a boleta
+    # pendente novamente.
+    CAMPOS_PENDENCIA = ('data_operacao',)
+
+    class Meta:
+        abstract = True
 
+    def save(self, *args, **kwargs):
+        if self.pk == None:
+            # Uma boleta nova, mesmo copiada de outra, ainda não tem derivados.
+            self.derivados = 0
+            self.fechada = False
+            self.proxima_acao = None
+        if self.fechada == False and self.proxima_acao == None:
+            self.atualizar_pendencia()
+        super().save(*args, **kwargs)
 
-class BoletaAcao(BaseModel):
+    def atualizar_pendencia(self, data_referencia=None):
+        """ date -> None
+        Recebe a última data em que a boleta foi processada pelo fechamento
+        e atualiza a próxima ação. Não salva a boleta.
+        """
+        self.fechada = data_referencia != None and data_referencia >= self.data_operacao
+        self.proxima_acao = None if self.fechada else self.data_operacao
+
+    def possui(self, *derivados):
+        """ int -> Boolean
+        Retorna True se a boleta possuir todos os objetos derivados indicados.
+        """
+        mascara = 0
+        for derivado in derivados:
+            mascara |= derivado
+        return self.derivados & mascara == mascara
+
+    def registrar_fechamento(self, data_referencia):
+        """ date -> None
+        Atualiza e salva a pendência da boleta depois de processá-la no
+        fechamento da data de referência.
+        """
+        self.atualizar_pendencia(data_referencia)
+        self.save(update_fields=['proxima_acao', 'fechada'])
+
+    def salvar_derivado(self, objeto, derivado):
+        """ Model, int -> None
+        Salva um objeto derivado da boleta. Provisões e CPRs de fundos que
+        compensam liquidações entram na composição do valor líquido, em vez
+        de serem salvos, e o derivado é marcado na boleta aqui.
+        """
+        restantes = [objeto]
+        if isinstance(objeto, (BoletaProvisao, BoletaCPR)):
+            restantes = compensar_liquidacoes(type(objeto), restantes)
+        for restante in restantes:
+            restante.save()
+        if not restantes:
+            marcar_derivado(ContentType.objects.get_for_model(self).id, self.id, \
+                derivado, True, self)
+
+    # Relações carregadas junto com as boletas no fechamento em lote.
+    RELACIONADOS_LOTE = ()
+
+    def montar_derivados(self):
+        """ -> list
+        Monta, sem salvar, os objetos derivados que a boleta ainda não possui,
+        como pares (bit do derivado, objeto). Usado pelo fechamento em lote.
+        Por padrão a boleta não tem derivados a montar, e o fechamento em
+        lote só registra a sua pendência; os modelos que geram derivados no
+        lote sobrescrevem este método.
+        """
+        return []
+
+    @classmethod
+    def fechar_em_lote(cls, boletas, data_referencia=None):
+        """ QuerySet, date -> list
+        Fecha as boletas do queryset de uma só vez: monta em memória todos os
+        objetos derivados que faltam e os grava com gravar_derivados, dentro
+        de uma transação. Com a data de referência, também registra o
+        fechamento das boletas nessa data. Retorna as boletas processadas.
+        """
+        boletas = list(boletas.select_related(*cls.RELACIONADOS_LOTE))
+        if not boletas:
+            return boletas
+        montagens = [(boleta, boleta.montar_derivados()) for boleta in boletas]
+        with transaction.atomic():
+            cls.gravar_derivados(montagens)
+            if data_referencia != None:
+                for boleta in boletas:
+                    boleta.atualizar_pendencia(data_referencia)
+                cls.gravar_pendencias(boletas)
+        return boletas
+
+    @classmethod
+    def gravar_derivados(cls, montagens, compensar=True):
+        """ list, Boolean -> None
+        Recebe pares (boleta, [(bit do derivado, objeto)]) de objetos
+        derivados montados em memória. Valida os objetos sem consultar o banco
+        e os insere com um bulk_create por modelo. Como o bulk_create não
+        dispara os sinais, a máscara de derivados das boletas e as posições
+        dos fundos são atualizadas aqui. Com compensar, provisões e CPRs de
+        fundos que compensam liquidações são somados aos valores líquidos.
+        Deve ser chamado dentro de uma transação.
+        """
+        derivados = {}
+        marcas = {}
+        erros = []
+        for boleta, pares in montagens:
+            mascara = 0
+            for derivado, objeto in pares:
+                # As chaves estrangeiras vêm da boleta já salva, e não precisam
+                # ser conferidas no banco objeto a objeto.
+                relacoes = [campo.name for campo in objeto._meta.fields if campo.is_relation]
+                try:
+                    objeto.full_clean(exclude=relacoes, validate_unique=False)
+                except ValidationError as erro:
+                    erros.extend('%s: %s' % (boleta, mensagem) for mensagem in erro.messages)
+                # O bulk_create não passa pelo save, que calcula a pendência
+                # dos derivados que também são fechados, como os CPRs.
+                if isinstance(objeto, PendenciaFechamento) and \
+                    objeto.fechada == False and objeto.proxima_acao == None:
+                    objeto.atualizar_pendencia()
+                derivados.setdefault(type(objeto), []).append(objeto)
+                mascara |= derivado
+            if mascara:
+                marcas.setdefault(mascara, []).append(boleta.id)
+                boleta.derivados |= mascara
+        if erros:
+            raise ValidationError(erros)
+
+        compensam = None
+        if compensar and (BoletaProvisao in derivados or BoletaCPR in derivados):
+            compensam = fundos_que_compensam({boleta.fundo_id for boleta, pares in montagens})
+        for modelo, objetos in derivados.items():
+            if compensam and modelo in (BoletaProvisao, BoletaCPR):
+                objetos = compensar_liquidacoes(modelo, objetos, compensam)
+            modelo.objects.bulk_create(objetos)
+        for mascara, ids in marcas.items():
+            cls.objects.filter(id__in=ids).update( \
+                derivados=models.F('derivados').bitor(mascara))
+        # Invalida as posições a partir da primeira quantidade nova de
+        # cada fundo, como faria o sinal de Quantidade.
+        inicio = {}
+        for quantidade in derivados.get(fm.Quantidade, []):
+            if quantidade.fundo_id not in inicio or quantidade.data < inicio[quantidade.fundo_id]:
+                inicio[quantidade.fundo_id] = quantidade.data
+        for fundo_id, data in inicio.items():
+            fm.Posicao.objects.filter(fundo_id=fundo_id, data__gte=data).delete()
+
+    @classmethod
+    def gravar_pendencias(cls, boletas):
+        """ list -> None
+        Grava a pendência das boletas em memória, com um UPDATE por
+        combinação de próxima ação e fechamento.
+        """
+        pendencias = {}
+        for boleta in boletas:
+            pendencias.setdefault((boleta.fechada, boleta.proxima_acao), \
+                []).append(boleta.id)
+        for (fechada, proxima_acao), ids in pendencias.items():
+            cls.objects.filter(id__in=ids).update(fechada=fechada, \
+                proxima_acao=proxima_acao)
+
+    @classmethod
+    def gravar_campos(cls, boletas, campos):
+        """ list, tuple -> None
+        Grava os campos indicados das boletas em memória com um UPDATE por
+        lote, escolhendo o valor de cada boleta com CASE, já que os valores
+        variam de uma boleta para outra.
+        """
+        conexao = transaction.get_connection()
+        campos = [cls._meta.get_field(nome) for nome in campos]
+        tamanho = conexao.ops.bulk_batch_size(['id'] + campos * 2, boletas)
+        for inicio in range(0, len(boletas), max(tamanho, 1)):
+            lote = boletas[inicio:inicio + tamanho]
+            valores = {}
+            for campo in campos:
+                casos = [models.When(id=boleta.id, then=models.Value( \
+                    getattr(boleta, campo.attname), output_field=campo)) \
+                    for boleta in lote]
+                valores[campo.attname] = models.Case(*casos, output_field=campo)
+            cls.objects.filter(id__in=[boleta.id for boleta in lote]).update(**valores)
+
+    @classmethod
+    def reabrir_pendencias(cls, fundo, data_referencia):
+        """ Fundo, date -> None
+        No reprocessamento do fundo a partir da data de referência, recalcula
+        a pendência das boletas afetadas como se o último fechamento tivesse
+        sido no dia anterior.
+        """
+        filtro = models.Q(proxima_acao__gt=data_referencia)
+        for campo in cls.CAMPOS_PENDENCIA:
+            filtro |= models.Q(**{campo + '__gte': data_referencia})
+        anterior = data_referencia - datetime.timedelta(days=1)
+        for boleta in cls.objects.filter(filtro, fundo=fundo):
+            boleta.atualizar_pendencia(anterior)
+            boleta.save()
+
+class BoletaAcao(PendenciaFechamento, BaseModel):
     """
     Representa a boleta de um trade de ações. A boleta de ações deve ter todas
     as informações necessárias para a geração das boletas e quantidades
@@ -141,6 +365,8 @@ class BoletaAcao(BaseModel):
     relacao_quantidade = GenericRelation('fundo.Quantidade', related_query_name='qtd_acao')
     relacao_movimentacao = GenericRelation('fundo.Movimentacao', related_query_name='mov_acao')
 
+    RELACIONADOS_LOTE = ('acao',)
+
     class Meta:
         verbose_name_plural = "Boletas de operação de ações"
 
@@ -206,10 +432,86 @@ class BoletaAcao(BaseModel):
         quando a movimentação e quantidade do ativo já tiverem sido gerados,
         assim como a boleta de CPR e provisão relacionadas.
         """
-        return self.boleta_provisao.all().exists() and \
-            self.boleta_CPR.all().exists() and \
-            self.relacao_quantidade.all().exists() and \
-            self.relacao_movimentacao.all().exists()
+        return self.possui(self.DERIVADO_PROVISAO, self.DERIVADO_CPR, \
+            self.DERIVADO_QUANTIDADE, self.DERIVADO_MOVIMENTACAO)
+
+    def montar_derivados(self):
+        """
+        Monta as boletas de provisão e CPR, a quantidade e a movimentação que
+        a boleta ainda não possui, para o fechamento em lote.
+        """
+        montagens = (
+            (self.DERIVADO_PROVISAO, self.montar_boleta_provisao),
+            (self.DERIVADO_CPR, self.montar_boleta_CPR),
+            (self.DERIVADO_QUANTIDADE, self.montar_quantidade),
+            (self.DERIVADO_MOVIMENTACAO, self.montar_movimentacao),
+        )
+        return [(derivado, montar()) for derivado, montar in montagens \
+            if not self.possui(derivado)]
+
+    def descricao_derivados(self):
+        if self.operacao == "C":
+            return 'Compra ' + self.acao.nome
+        return 'Venda ' + self.acao.nome
+
+    def montar_boleta_provisao(self):
+        """
+        Monta, sem salvar, a boleta de provisão da boleta de ação.
+        """
+        return BoletaProvisao(
+            descricao = self.descricao_derivados(),
+            caixa_alvo_id = self.caixa_alvo_id,
+            fundo_id = self.fundo_id,
+            data_pagamento = self.data_liquidacao,
+            # A movimentação de caixa tem sinal oposto à variação de quantidade
+            financeiro = decimal.Decimal(-(self.preco * self.quantidade) + self.corretagem).quantize(decimal.Decimal('1.00')),
+            content_object = self
+        )
+
+    def montar_boleta_CPR(self):
+        """
+        Monta, sem salvar, a boleta de CPR da boleta de ação.
+        """
+        return BoletaCPR(
+            descricao = self.descricao_derivados(),
+            valor_cheio = decimal.Decimal(-(self.preco * self.quantidade) + self.corretagem).quantize(decimal.Decimal('1.00')),
+            data_inicio = self.data_operacao,
+            data_pagamento = self.data_liquidacao,
+            fundo_id = self.fundo_id,
+            content_object = self
+        )
+
+    def montar_quantidade(self):
+        """
+        Monta, sem salvar, a quantidade da ação negociada.
+        """
+        return fm.Quantidade(
+            qtd = self.quantidade,
+            fundo_id = self.fundo_id,
+            data = self.data_operacao,
+            content_object = self,
+            objeto_quantidade = self.acao,
+            custodia_id = self.custodia_id,
+            corretora_id = self.corretora_id,
+            ativo = self.acao
+        )
+
+    def montar_movimentacao(self):
+        """
+        Monta, sem salvar, a movimentação da ação negociada.
+        """
+        valor = self.preco * self.quantidade + self.corretagem
+        valor = decimal.Decimal(valor).quantize(decimal.Decimal('1.000000'))
+        return fm.Movimentacao(
+            valor = valor,
+            fundo_id = self.fundo_id,
+            data = self.data_operacao,
+            content_object = self,
+            objeto_movimentacao = self.acao,
+            custodia_id = self.custodia_id,
+            corretora_id = self.corretora_id,
+            ativo = self.acao
+        )
 
     def criar_boleta_provisao(self):
         """
@@ -217,25 +519,10 @@ class BoletaAcao(BaseModel):
         de ação. Se já houver uma boleta de provisão criada, não há necessidade
         de criar outra.
         """
-        # Checar se já há boleta de provisão criada relacionada com esta.
-        if self.boleta_provisao.all().exists() == False:
-            op = ''
-            if self.operacao == "C":
-                op = 'Compra '
-            else:
-                op = 'Venda '
-            # Criar boleta de provisão
-            boleta_provisao = BoletaProvisao(
-                descricao = op + self.acao.nome,
-                caixa_alvo = self.caixa_alvo,
-                fundo = self.fundo,
-                data_pagamento = self.data_liquidacao,
-                # A movimentação de caixa tem sinal oposto à variação de quantidade
-                financeiro = decimal.Decimal(-(self.preco * self.quantidade) + self.corretagem).quantize(decimal.Decimal('1.00')),
-                content_object = self
-            )
+        if not self.possui(self.DERIVADO_PROVISAO):
+            boleta_provisao = self.montar_boleta_provisao()
             boleta_provisao.full_clean()
-            boleta_provisao.save()
+            self.salvar_derivado(boleta_provisao, self.DERIVADO_PROVISAO)
 
     def criar_boleta_CPR(self):
         """
@@ -243,24 +530,10 @@ class BoletaAcao(BaseModel):
         de ação. Se já houver uma boleta de CPR criada, não há necessidade
         de criar outra.
         """
-        # Checar se há boleta de CPR já criada:
-        if self.boleta_CPR.all().exists() == False:
-            # Criar boleta de CPR
-            op = ''
-            if self.operacao == "C":
-                op = 'Compra '
-            else:
-                op = 'Venda '
-            boleta_CPR = BoletaCPR(
-                descricao = op + self.acao.nome,
-                valor_cheio = decimal.Decimal(-(self.preco * self.quantidade) + self.corretagem).quantize(decimal.Decimal('1.00')),
-                data_inicio = self.data_operacao,
-                data_pagamento = self.data_liquidacao,
-                fundo = self.fundo,
-                content_object = self
-            )
+        if not self.possui(self.DERIVADO_CPR):
+            boleta_CPR = self.montar_boleta_CPR()
             boleta_CPR.full_clean()
-            boleta_CPR.save()
+            self.salvar_derivado(boleta_CPR, self.DERIVADO_CPR)
 
     def criar_quantidade(self):
         """
@@ -268,17 +541,8 @@ class BoletaAcao(BaseModel):
         de ação. Se já houver uma quantidade criada, não há necessidade
         de criar outra.
         """
-        # Checar se há quantidade já criada
-        from fundo.models import Quantidade, Movimentacao
-        if self.relacao_quantidade.all().exists() == False:
-            # Criar Quantidade do Ativo
-            acao_quantidade = Quantidade(
-                qtd = self.quantidade,
-                fundo = self.fundo,
-                data = self.data_operacao,
-                content_object = self,
-                objeto_quantidade = self.acao
-            )
+        if not self.possui(self.DERIVADO_QUANTIDADE):
+            acao_quantidade = self.montar_quantidade()
             acao_quantidade.full_clean()
             acao_quantidade.save()
 
@@ -288,23 +552,12 @@ class BoletaAcao(BaseModel):
         de ação. Se já houver uma movimentação criada, não há necessidade
         de criar outra.
         """
-        # Checar se há movimentação já criada
-        if self.relacao_movimentacao.all().exists() == False:
-            # Criar Movimentacao do Ativo
-            from fundo.models import Quantidade, Movimentacao
-            valor = self.preco * self.quantidade + self.corretagem
-            valor = decimal.Decimal(valor).quantize(decimal.Decimal('1.000000'))
-            acao_movimentacao = Movimentacao(
-                valor = valor,
-                fundo = self.fundo,
-                data = self.data_operacao,
-                content_object = self,
-                objeto_movimentacao = self.acao
-            )
+        if not self.possui(self.DERIVADO_MOVIMENTACAO):
+            acao_movimentacao = self.montar_movimentacao()
             acao_movimentacao.full_clean()
             acao_movimentacao.save()
 
-class BoletaRendaFixaLocal(BaseModel):
+class BoletaRendaFixaLocal(PendenciaFechamento, BaseModel):
     """
     Representa uma boleta de renda fixa local. Processada da mesma maneira que
     a boleta de ação
@@ -382,10 +635,8 @@ class BoletaRendaFixaLocal(BaseModel):
         quando a movimentação e quantidade do ativo já tiverem sido gerados,
         assim como a boleta de CPR e provisão relacionadas.
         """
-        return self.boleta_provisao.all().exists() and \
-            self.boleta_CPR.all().exists() and \
-            self.relacao_quantidade.all().exists() and \
-            self.relacao_movimentacao.all().exists()
+        return self.possui(self.DERIVADO_PROVISAO, self.DERIVADO_CPR, \
+            self.DERIVADO_QUANTIDADE, self.DERIVADO_MOVIMENTACAO)
 
     def criar_boleta_provisao(self):
         """
@@ -394,7 +645,7 @@ class BoletaRendaFixaLocal(BaseModel):
         de criar outra.
         """
         # Checar se já há boleta de provisão criada relacionada com esta.
-        if self.boleta_provisao.all().exists() == False:
+        if not self.possui(self.DERIVADO_PROVISAO):
             op = ''
             if self.operacao == "C":
                 op = 'Compra '
@@ -411,7 +662,7 @@ class BoletaRendaFixaLocal(BaseModel):
                 content_object = self
 
             )
-            boleta_provisao.save()
+            self.salvar_derivado(boleta_provisao, self.DERIVADO_PROVISAO)
 
     def criar_boleta_CPR(self):
         """
@@ -420,7 +671,7 @@ class BoletaRendaFixaLocal(BaseModel):
         de criar outra.
         """
         # Checar se há boleta de CPR já criada:
-        if self.boleta_CPR.all().exists() == False:
+        if not self.possui(self.DERIVADO_CPR):
             # Criar boleta de CPR
             op = ''
             if self.operacao == "C":
@@ -435,7 +686,7 @@ class BoletaRendaFixaLocal(BaseModel):
                 fundo = self.fundo,
                 content_object = self
             )
-            boleta_CPR.save()
+            self.salvar_derivado(boleta_CPR, self.DERIVADO_CPR)
 
     def criar_quantidade(self):
         """
@@ -444,7 +695,7 @@ class BoletaRendaFixaLocal(BaseModel):
         de criar outra.
         """
         # Checar se há quantidade já criada
-        if self.relacao_quantidade.all().exists() == False:
+        if not self.possui(self.DERIVADO_QUANTIDADE):
             # Criar Quantidade do Ativo
             from fundo.models import Quantidade, Movimentacao
             acao_quantidade = Quantidade(
@@ -452,7 +703,10 @@ class BoletaRendaFixaLocal(BaseModel):
                 fundo = self.fundo,
                 data = self.data_operacao,
                 content_object = self,
-                objeto_quantidade = self.ativo
+                objeto_quantidade = self.ativo,
+                custodia = self.custodia,
+                corretora = self.corretora,
+                ativo = self.ativo
             )
             acao_quantidade.save()
 
@@ -463,7 +717,7 @@ class BoletaRendaFixaLocal(BaseModel):
         criar outra.
         """
         # Checar se há movimentação já criada
-        if self.relacao_movimentacao.all().exists() == False:
+        if not self.possui(self.DERIVADO_MOVIMENTACAO):
             # Criar Movimentacao do Ativo
             from fundo.models import Quantidade, Movimentacao
             acao_movimentacao = Movimentacao(
@@ -471,11 +725,14 @@ class BoletaRendaFixaLocal(BaseModel):
                 fundo = self.fundo,
                 data = self.data_operacao,
                 content_object = self,
-                objeto_movimentacao = self.ativo
+                objeto_movimentacao = self.ativo,
+                custodia = self.custodia,
+                corretora = self.corretora,
+                ativo = self.ativo
             )
             acao_movimentacao.save()
 
-class BoletaRendaFixaOffshore(BaseModel):
+class BoletaRendaFixaOffshore(PendenciaFechamento, BaseModel):
     """
     Representa uma operação de renda fixa offshore. Processado da mesma maneira
     que a boleta de ação.
@@ -550,24 +807,25 @@ class BoletaRendaFixaOffshore(BaseModel):
         self.criar_boleta_provisao()
 
     def fechado(self):
-        return self.boleta_provisao.all().exists() and \
-            self.boleta_CPR.all().exists() and \
-            self.relacao_quantidade.all().exists() and \
-            self.relacao_movimentacao.all().exists()
+        return self.possui(self.DERIVADO_PROVISAO, self.DERIVADO_CPR, \
+            self.DERIVADO_QUANTIDADE, self.DERIVADO_MOVIMENTACAO)
 
     def criar_movimentacao(self):
         """
         Cria uma movimentação do ativo relacionada a essa boleta, apenas se
         a boleta não possuir nenhuma movimentação ligada a ela
         """
-        if self.relacao_movimentacao.all().exists() == False:
+        if not self.possui(self.DERIVADO_MOVIMENTACAO):
             from fundo.models import Quantidade, Movimentacao
             ativo_movimentacao = Movimentacao(
                 valor = round(self.quantidade * self.preco + self.corretagem, 2),
                 fundo = self.fundo,
                 data = self.data_operacao,
                 content_object = self,
-                objeto_movimentacao = self.ativo
+                objeto_movimentacao = self.ativo,
+                custodia = self.custodia,
+                corretora = self.corretora,
+                ativo = self.ativo
             )
             ativo_movimentacao.clean()
             ativo_movimentacao.save()
@@ -576,7 +834,7 @@ class BoletaRendaFixaOffshore(BaseModel):
         """
         Uma quantidade do ativo é criada para movimentar a quantidade de ativos na carteira.
         """
-        if self.relacao_quantidade.all().exists() == False:
+        if not self.possui(self.DERIVADO_QUANTIDADE):
             self.clean_quantidade()
             from fundo.models import Quantidade, Movimentacao
             ativo_quantidade = Quantidade(
@@ -584,7 +842,10 @@ class BoletaRendaFixaOffshore(BaseModel):
                 fundo = self.fundo,
                 data = self.data_operacao,
                 content_object = self,
-                objeto_quantidade = self.ativo
+                objeto_quantidade = self.ativo,
+                custodia = self.custodia,
+                corretora = self.corretora,
+                ativo = self.ativo
             )
             ativo_quantidade.clean()
             ativo_quantidade.save()
@@ -594,7 +855,7 @@ class BoletaRendaFixaOffshore(BaseModel):
         É criado um CPR para o trade.
         """
         # Checar se há boleta de CPR já criada:
-        if self.boleta_CPR.all().exists() == False:
+        if not self.possui(self.DERIVADO_CPR):
             # Criar boleta de CPR
             op = ''
             if self.operacao == "C":
@@ -618,7 +879,7 @@ class BoletaRendaFixaOffshore(BaseModel):
         de criar outra.
         """
         # Checar se já há boleta de provisão criada relacionada com esta.
-        if self.boleta_provisao.all().exists() == False:
+        if not self.possui(self.DERIVADO_PROVISAO):
             op = ''
             i_op = 1
             if self.operacao == "C":
@@ -639,7 +900,7 @@ class BoletaRendaFixaOffshore(BaseModel):
             )
             boleta_provisao.save()
 
-class BoletaFundoLocal(BaseModel):
+class BoletaFundoLocal(PendenciaFechamento, BaseModel):
     """
     Representa uma operação de cotas de fundo local. Processado da mesma maneira
     que a boleta de ação.
@@ -738,6 +999,37 @@ class BoletaFundoLocal(BaseModel):
             self.quantidade = -abs(self.quantidade)
             self.clean_financeiro()
 
+    class Meta:
+        # Boletas pendentes em que o ativo negociado é o fundo fechado.
+        index_together = (('ativo', 'fechada', 'proxima_acao'),)
+
+    CAMPOS_PENDENCIA = ('data_cotizacao', 'data_liquidacao')
+
+    def atualizar_pendencia(self, data_referencia=None):
+        """ date -> None
+        A boleta é processada todos os dias entre a cotização e a liquidação,
+        até ser fechada. Depois de processada, se faltar apenas a informação
+        de cotização, aguarda o EventoCotizacao.
+        """
+        inicio = min(self.data_cotizacao, self.data_liquidacao)
+        fim = max(self.data_cotizacao, self.data_liquidacao)
+        self.fechada = self.fechado() or (data_referencia != None and self.aguardando_cota())
+        if self.fechada or (data_referencia != None and data_referencia >= fim):
+            self.proxima_acao = None
+        elif data_referencia == None:
+            self.proxima_acao = inicio
+        else:
+            self.proxima_acao = max(inicio, data_referencia + datetime.timedelta(days=1))
+
+    def registrar_fechamento(self, data_referencia):
+        """ date -> None
+        Se a boleta passar a aguardar a cota, confere se ela já foi gravada
+        durante o fechamento.
+        """
+        super().registrar_fechamento(data_referencia)
+        if self.fechada and self.aguardando_cota():
+            EventoCotizacao.enfileirar_cotadas([(self.ativo_id, self.data_cotizacao)])
+
     def fechado(self):
         """
         Retorna True se houver boleta de provisão e CPR associadas a essa boleta,
@@ -745,13 +1037,19 @@ class BoletaFundoLocal(BaseModel):
         """
         passivo_fechado = True
         if self.passivo() == True:
-            if self.relacao_passivo.all().exists() == False:
+            if not self.possui(self.DERIVADO_PASSIVO):
                 passivo_fechado = False
 
-        return self.boleta_provisao.all().exists() and \
-            self.boleta_CPR.all().exists() and \
-            self.relacao_quantidade.all().exists() and \
-            self.relacao_movimentacao.all().exists() and passivo_fechado
+        return self.possui(self.DERIVADO_PROVISAO, self.DERIVADO_CPR, \
+            self.DERIVADO_QUANTIDADE, self.DERIVADO_MOVIMENTACAO) and passivo_fechado
+
+    def aguardando_cota(self):
+        """
+        Retorna True se a boleta já criou a provisão e o CPR, e falta apenas
+        a cota para criar a quantidade e a movimentação.
+        """
+        return self.preco == None and self.quantidade == None and \
+            self.possui(self.DERIVADO_PROVISAO, self.DERIVADO_CPR)
 
     def passivo(self):
         """
@@ -774,10 +1072,10 @@ class BoletaFundoLocal(BaseModel):
         com ele.
         """
         if self.preco == None:
-            preco = mm.Preco.objects.filter(ativo=self.ativo, data_referencia=self.data_cotizacao).first()
+            preco = mm.Preco.preco_do_dia(self.ativo, self.data_cotizacao)
             if preco == None:
                 return False
-            self.preco = decimal.Decimal(preco.preco_fechamento).quantize(decimal.Decimal('1.000000'))
+            self.preco = decimal.Decimal(preco).quantize(decimal.Decimal('1.000000'))
             self.save()
             return True
         else:
@@ -812,7 +1110,7 @@ class BoletaFundoLocal(BaseModel):
                     # Caso o ativo negociado seja um fundo gerido, atualiza a
                     # boleta de passivo gerada. Deve haver apenas uma boleta,
                     # logo, basta pegar a primeira da relacao_passivo
-                    if self.passivo() == True and self.relacao_passivo.exists():
+                    if self.passivo() == True and self.possui(self.DERIVADO_PASSIVO):
                         passivo = self.relacao_passivo.first()
                         passivo.cota = self.preco
                         passivo.save()
@@ -824,7 +1122,7 @@ class BoletaFundoLocal(BaseModel):
         """
         Cria uma movimentação do ativo movimentado.
         """
-        if self.relacao_movimentacao.all().exists() == False:
+        if not self.possui(self.DERIVADO_MOVIMENTACAO):
             self.clean_financeiro()
             from fundo.models import Quantidade, Movimentacao
             mov = Movimentacao(
@@ -834,6 +1132,9 @@ class BoletaFundoLocal(BaseModel):
                 content_object=self,
                 object_id=self.id,
                 objeto_movimentacao=self.ativo,
+                custodia=self.custodia,
+                corretora=self.caixa_alvo.corretora,
+                ativo=self.ativo,
                 tipo_id=self.ativo.id
             )
             mov.full_clean()
@@ -846,7 +1147,7 @@ class BoletaFundoLocal(BaseModel):
         """
         # TODO: VERIFICAR SE O PREÇO DO ATIVO JÁ FOI INFORMADO PARA CRIAR
         # A MOVIMENTAÇÃO.
-        if self.relacao_quantidade.all().exists() == False:
+        if not self.possui(self.DERIVADO_QUANTIDADE):
             self.clean_quantidade()
             from fundo.models import Quantidade, Movimentacao
             qtd = Quantidade(
@@ -854,7 +1155,10 @@ class BoletaFundoLocal(BaseModel):
                 fundo=self.fundo,
                 data=self.data_cotizacao,
                 content_object=self,
-                objeto_quantidade=self.ativo
+                objeto_quantidade=self.ativo,
+                custodia=self.custodia,
+                corretora=self.caixa_alvo.corretora,
+                ativo=self.ativo
             )
             qtd.full_clean()
             qtd.save()
@@ -863,7 +1167,7 @@ class BoletaFundoLocal(BaseModel):
         """
         Cria a boleta de CPR da operação, caso já não tenha sido criada.
         """
-        if self.boleta_CPR.all().exists() == False:
+        if not self.possui(self.DERIVADO_CPR):
             # Clean na data de cotização para verificar se está tudo certo.
             self.full_clean()
             financeiro = 0
@@ -880,7 +1184,7 @@ class BoletaFundoLocal(BaseModel):
                     fundo = self.fundo,
                     content_object = self
                 )
-                cpr.save()
+                self.salvar_derivado(cpr, self.DERIVADO_CPR)
             else:
                 cpr = BoletaCPR(
                     descricao = self.operacao + " " + self.ativo.nome,
@@ -890,10 +1194,10 @@ class BoletaFundoLocal(BaseModel):
                     fundo = self.fundo,
                     content_object = self
                 )
-                cpr.save()
+                self.salvar_derivado(cpr, self.DERIVADO_CPR)
 
     def criar_boleta_provisao(self):
-        if self.boleta_provisao.all().exists() == False:
+        if not self.possui(self.DERIVADO_PROVISAO):
             provisao = BoletaProvisao(
                 descricao=self.operacao + " " + self.ativo.nome,
                 caixa_alvo=self.caixa_alvo,
@@ -906,14 +1210,14 @@ class BoletaFundoLocal(BaseModel):
                 content_object=self
             )
             provisao.full_clean()
-            provisao.save()
+            self.salvar_derivado(provisao, self.DERIVADO_PROVISAO)
 
     def criar_boleta_passivo(self):
         """
         Quando o ativo movimentado é um fundo gerido, deve haver a geração
         de uma boleta de passivo para o fundo.
         """
-        if self.relacao_passivo.all().exists() == False:
+        if not self.possui(self.DERIVADO_PASSIVO):
             # Busca cotista equivalente ao fundo
             cotista = fm.Cotista.objects.filter(fundo_cotista=self.fundo).first()
             if cotista is None:
@@ -935,7 +1239,14 @@ class BoletaFundoLocal(BaseModel):
             passivo.full_clean()
             passivo.save()
 
-class BoletaFundoOffshore(BaseModel):
+# Transição de estado da boleta de fundo offshore: parte do estado de origem
+# (índice em BoletaFundoOffshore.ESTADO) quando o fechamento ocorre na data
+# indicada e as condições são atendidas, executa as tarefas e leva ao estado
+# de destino. Se continua, as transições são avaliadas outra vez na mesma data.
+Transicao = collections.namedtuple('Transicao', ['numero', 'origem', 'data', \
+    'condicoes', 'tarefas', 'destino', 'continua'])
+
+class BoletaFundoOffshore(PendenciaFechamento, BaseModel):
     """
     Representa uma operação de cotas de fundo offshore. Processado de acordo
     com o seu estado atual.
@@ -982,13 +1293,40 @@ class BoletaFundoOffshore(BaseModel):
     relacao_movimentacao = GenericRelation('fundo.Movimentacao', related_query_name='mov_fundo_off')
     boleta_passivo = GenericRelation('BoletaPassivo', related_query_name='passivo')
 
+    # Transições documentadas em fechar_boleta, avaliadas em ordem. A data é
+    # 'cotizacao', 'liquidacao' ou 'apos_cotizacao' (qualquer data posterior
+    # à cotização). As condições são 'financeiro' (valor financeiro
+    # preenchido), 'cota' (preço da cota disponível) e 'sem_cota', e cada
+    # tarefa é executada pelo método tarefa_<nome>.
+    TRANSICOES = (
+        Transicao(1, 4, 'liquidacao', ('financeiro',),
+            ('cpr_cotizacao', 'provisao'), 0, True),
+        Transicao(2, 4, 'cotizacao', ('financeiro', 'cota'),
+            ('cotizar', 'cpr_liquidacao', 'provisao', 'movimentacao',
+            'quantidade', 'passivo'), 1, True),
+        Transicao(7, 4, 'cotizacao', ('financeiro', 'sem_cota'),
+            ('cpr_cotizacao', 'cpr_liquidacao', 'provisao', 'passivo'), 3, False),
+        Transicao(3, 0, 'cotizacao', ('cota',),
+            ('pagar_cpr_cotizacao', 'cotizar', 'movimentacao', 'quantidade',
+            'passivo'), 5, False),
+        Transicao(4, 1, 'liquidacao', (), (), 5, False),
+        Transicao(5, 0, 'cotizacao', ('sem_cota',), ('passivo',), 2, False),
+        Transicao(6, 2, 'apos_cotizacao', ('cota',),
+            ('pagar_cpr_cotizacao', 'cotizar', 'movimentacao', 'quantidade',
+            'cota_passivo'), 5, False),
+        Transicao(8, 3, 'liquidacao', ('cota',),
+            ('pagar_cpr_cotizacao', 'cotizar', 'movimentacao', 'quantidade',
+            'cota_passivo'), 5, False),
+        Transicao(9, 3, 'liquidacao', ('sem_cota',), (), 2, False),
+    )
+
     def clean_preco(self):
         """
         Busca o valor do preco no banco de dados e preenche a boleta, caso esteja
         disponível.
         """
         if self.cotizavel() and self.preco == None:
-            self.preco = mm.Preco.objects.filter(ativo=self.ativo, data_referencia=self.data_cotizacao).first().preco_fechamento
+            self.preco = mm.Preco.preco_do_dia(self.ativo, self.data_cotizacao)
         elif self.preco != None:
             pass
         else:
@@ -1019,6 +1357,29 @@ class BoletaFundoOffshore(BaseModel):
         if self.financeiro == None:
             self.financeiro = self.preco * self.quantidade
 
+    class Meta:
+        # Boletas pendentes em que o ativo negociado é o fundo fechado.
+        index_together = (('ativo', 'fechada', 'proxima_acao'),)
+
+    CAMPOS_PENDENCIA = ('data_cotizacao', 'data_liquidacao')
+
+    def atualizar_pendencia(self, data_referencia=None):
+        """ date -> None
+        A próxima ação depende do estado da boleta: a primeira entre cotização
+        e liquidação, ou a data que ainda falta. Enquanto a informação de
+        cotização não for disponibilizada, o fechamento não tem o que fazer:
+        a boleta é reaberta pelo EventoCotizacao quando a cota for gravada.
+        """
+        self.fechada = self.estado in (self.ESTADO[2][0], self.ESTADO[5][0])
+        if self.fechada:
+            self.proxima_acao = None
+        elif self.estado == self.ESTADO[0][0]:
+            self.proxima_acao = self.data_cotizacao
+        elif self.estado in (self.ESTADO[1][0], self.ESTADO[3][0]):
+            self.proxima_acao = self.data_liquidacao
+        else:
+            self.proxima_acao = min(self.data_cotizacao, self.data_liquidacao)
+
     def fechado(self):
         """
         Determina se a boleta já foi fechada ou não.
@@ -1034,8 +1395,7 @@ class BoletaFundoOffshore(BaseModel):
         Se houver, atualiza o preço da boleta e quantidade de cotas.
         """
         if self.cotizavel() == True:
-            mm.Preco.objects.filter(ativo=self.ativo, data_referencia=self.data_cotizacao)
-            self.preco = mm.Preco.objects.get(ativo=self.ativo, data_referencia=self.data_cotizacao).preco_fechamento
+            self.preco = mm.Preco.preco_do_dia(self.ativo, self.data_cotizacao)
             self.quantidade = (self.financeiro/self.preco).quantize(decimal.Decimal('1.000000'))
 
     def cotizavel(self):
@@ -1043,7 +1403,8 @@ class BoletaFundoOffshore(BaseModel):
         Determina se é possível cotizar a boleta, calculando a quantidade de
         cotas que serão movimentadas na operação.
         """
-        if mm.Preco.objects.filter(ativo=self.ativo, data_referencia=self.data_cotizacao).exists() or self.preco != None:
+        if self.preco != None or \
+            mm.Preco.preco_do_dia(self.ativo, self.data_cotizacao) != None:
             return True
         return False
 
@@ -1149,149 +1510,319 @@ class BoletaFundoOffshore(BaseModel):
                     - Cota indisponível na data de liquidação.
                 Tarefas a executar:
                     - Apenas atualiza o estado.
-        """
-        print(self.estado)
-        if self.estado != self.ESTADO[5][0]:
-            if self.estado == self.ESTADO[4][0]: # Pendente de liquidação e cotização.
-                if self.financeiro != None and data_referencia == self.data_liquidacao:
-                    """
-                    Transição 1 - Pendente de liquidação e cotização -> Pendente de cotização
-                    """
-                    self.criar_boleta_CPR_cotizacao()
-                    self.criar_provisao()
-                    self.estado = self.ESTADO[0][0]
-                    self.save()
-                    self.fechar_boleta(data_referencia)
-
-                elif self.financeiro != None and (self.preco != None or self.cotizavel()) and \
-                    data_referencia == self.data_cotizacao:
-                    """
-                    Transição 2 - Pendente de liquidação e cotização -> Pendente de liquidação.
-                    """
-                    """
-                    CPR deve ser negativo quando a operação for de aplicação, e positivo
-                    quando for de resgate
-                    """
-                    if self.preco == None:
-                        self.clean_preco()
-                        self.clean_quantidade()
-                    if self.quantidade == None:
-                        if self.operacao == self.OPERACAO[0][0]:
-                            self.quantidade = abs((self.financeiro/self.preco).quantize(decimal.Decimal('1.000000')))
-                        else:
-                            self.quantidade = -abs((self.financeiro/self.preco).quantize(decimal.Decimal('1.000000')))
-                    self.criar_boleta_CPR_liquidacao()
-                    self.criar_provisao()
-                    self.criar_movimentacao()
-                    self.criar_quantidade()
-                    if self.passivo():
-                        self.criar_boleta_passivo()
-                    self.estado = self.ESTADO[1][0]
-                    self.save()
-                    self.fechar_boleta(data_referencia)
-
-                elif self.financeiro != None and self.cotizavel() == False and \
-                    data_referencia == self.data_cotizacao and self.preco == None:
-
-                    """
-                    Transição 7 - Pendente de cotização e liquidação -> pendente de liquidação e informação de cotização.
-                    """
-                    self.criar_boleta_CPR_cotizacao()
-                    self.criar_boleta_CPR_liquidacao()
-                    self.criar_provisao()
-                    self.estado = self.ESTADO[3][0]
-                    if self.passivo():
-                        self.criar_boleta_passivo()
-                    self.save()
-
-            elif self.estado == self.ESTADO[0][0] and (self.cotizavel() == True or self.preco != None)\
-                and data_referencia == self.data_cotizacao:
-                """
-                Transição 3 - Pendente de cotização -> Concluído
-                """
-                financeiro = 0
-                if self.operacao == self.OPERACAO[0][0]:
-                    financeiro = decimal.Decimal(-abs(self.financeiro)).quantize(decimal.Decimal('1.00'))
+            As transições estão em TRANSICOES, e a boleta é fechada pelo
+        fechamento em lote, que também registra a sua pendência na data.
+        """
+        type(self).fechar_em_lote([self], data_referencia)
+
+    # Relações carregadas junto com as boletas no fechamento em lote.
+    RELACIONADOS_LOTE = ('ativo__gestao__gestora', 'caixa_alvo')
+
+    def transicao(self, data_referencia, precos):
+        """ date, dict -> Transicao
+        Retorna a primeira transição de TRANSICOES que se aplica à boleta no
+        fechamento da data de referência, ou None. A cota está disponível se
+        a boleta já tiver preço ou se o preço da data de cotização estiver em
+        precos, indexado por (id do ativo, data).
+        """
+        datas = {
+            'cotizacao': data_referencia == self.data_cotizacao,
+            'liquidacao': data_referencia == self.data_liquidacao,
+            'apos_cotizacao': data_referencia > self.data_cotizacao,
+        }
+        cota = self.preco != None or (self.ativo_id, self.data_cotizacao) in precos
+        condicoes = {
+            'financeiro': self.financeiro != None,
+            'cota': cota,
+            'sem_cota': not cota,
+        }
+        for transicao in self.TRANSICOES:
+            if self.estado == self.ESTADO[transicao.origem][0] and \
+                datas[transicao.data] and \
+                all(condicoes[condicao] for condicao in transicao.condicoes):
+                return transicao
+        return None
+
+    @classmethod
+    def fechar_em_lote(cls, boletas, data_referencia):
+        """ QuerySet ou list, date -> list
+        Fecha as boletas na data de referência, aplicando as transições de
+        TRANSICOES em memória. Os preços das datas de cotização e os CPRs já
+        criados são carregados uma única vez para todas as boletas, e os
+        objetos derivados, os pagamentos de CPR e os novos estados são
+        gravados em lote, de modo que o número de consultas não dependa da
+        quantidade de boletas pendentes. Também registra o fechamento das
+        boletas na data. Retorna as boletas processadas.
+        """
+        if isinstance(boletas, models.QuerySet):
+            boletas = list(boletas.select_related(*cls.RELACIONADOS_LOTE))
+        if not boletas:
+            return boletas
+        tipo = ContentType.objects.get_for_model(cls)
+        lote = {
+            'precos': mm.Preco.precos_nas_datas((boleta.ativo_id, \
+                boleta.data_cotizacao) for boleta in boletas if boleta.preco == None),
+            'cprs': {},
+            'pagos': [],
+            'passivos': [],
+            'cotas_passivo': [],
+        }
+        for cpr in BoletaCPR.objects.filter(content_type=tipo, \
+            object_id__in=[boleta.id for boleta in boletas]):
+            lote['cprs'].setdefault(cpr.object_id, []).append(cpr)
+
+        montagens = []
+        alteradas = []
+        inalteradas = []
+        for boleta in boletas:
+            pares = []
+            transicao = boleta.transicao(data_referencia, lote['precos'])
+            if transicao == None:
+                inalteradas.append(boleta)
+            else:
+                alteradas.append(boleta)
+            while transicao != None:
+                for tarefa in transicao.tarefas:
+                    pares.extend(getattr(boleta, 'tarefa_' + tarefa)(data_referencia, lote))
+                boleta.estado = cls.ESTADO[transicao.destino][0]
+                if transicao.continua:
+                    transicao = boleta.transicao(data_referencia, lote['precos'])
                 else:
-                    financeiro = decimal.Decimal(abs(self.financeiro)).quantize(decimal.Decimal('1.00'))
-
-                boleta = self.boleta_CPR.filter(valor_cheio=self.financeiro).first()
-                boleta.data_pagamento = data_referencia
-                boleta.save()
-                self.clean_preco()
-                self.clean_quantidade()
-                self.criar_movimentacao(data_referencia)
-                self.criar_quantidade(data_referencia)
-                if self.passivo():
-                    self.criar_boleta_passivo()
-                self.save()
-
-            elif self.estado == self.ESTADO[1][0] and data_referencia == self.data_liquidacao:
-                """
-                Transição 4 - Pendente de liquidação -> Concluído
-                """
-                self.estado = self.ESTADO[5][0]
-                self.save()
-
-            elif self.estado == self.ESTADO[0][0] and data_referencia == self.data_cotizacao and \
-                self.cotizavel() == False:
-                """
-                Transição 5 - Pendente de cotização -> Pendente de informação de cotização
-                """
-                self.estado = self.ESTADO[2][0]
-                if self.passivo():
-                    self.criar_boleta_passivo()
-                self.save()
-
-            elif self.estado == self.ESTADO[2][0] and self.cotizavel() == True and \
-                data_referencia > self.data_cotizacao:
-                """
-                Transição 6 - Pendente de informação de cotização -> Concluído
-                """
-                # Pegando boleta de cotização
-                boleta = self.boleta_CPR.filter(valor_cheio=self.financeiro).first()
-                boleta.data_pagamento = data_referencia
-                boleta.save()
-                self.clean_preco()
-                self.clean_quantidade()
-                self.criar_movimentacao(data_referencia)
-                self.criar_quantidade(data_referencia)
-                self.estado = self.ESTADO[5][0]
-                if self.passivo():
-                    # Atualiza a boleta de passivo com o valor da cota.
-                    passivo = self.boleta_passivo.all().get(object_id=self.id)
-                    if passivo.cota == None:
-                        passivo.cota = self.preco
-                        passivo.save()
-                self.save()
+                    transicao = None
+            if pares:
+                montagens.append((boleta, pares))
+            boleta.atualizar_pendencia(data_referencia)
+
+        with transaction.atomic():
+            cls.gravar_derivados(montagens, compensar=False)
+            pagamentos = {}
+            for cpr in lote['pagos']:
+                if cpr.fechada == False and cpr.proxima_acao == None:
+                    cpr.atualizar_pendencia()
+                pagamentos.setdefault((cpr.data_pagamento, cpr.fechada, \
+                    cpr.proxima_acao), []).append(cpr.id)
+            for (data_pagamento, fechada, proxima_acao), ids in pagamentos.items():
+                BoletaCPR.objects.filter(id__in=ids).update(data_pagamento=data_pagamento, \
+                    fechada=fechada, proxima_acao=proxima_acao)
+            cotas = {}
+            for boleta in lote['cotas_passivo']:
+                cotas.setdefault(boleta.preco, []).append(boleta.id)
+            for cota, ids in cotas.items():
+                BoletaPassivo.objects.filter(content_type=tipo, object_id__in=ids, \
+                    cota=None).update(cota=cota)
+            # Boletas de passivo só existem para fundos geridos, e são criadas
+            # uma a uma, junto com o cotista do fundo.
+            for boleta in lote['passivos']:
+                boleta.criar_boleta_passivo()
+            cls.gravar_campos(alteradas, ('estado', 'preco', 'quantidade', \
+                'financeiro', 'fechada', 'proxima_acao'))
+            cls.gravar_pendencias(inalteradas)
+            EventoCotizacao.enfileirar_cotadas((boleta.ativo_id, boleta.data_cotizacao) \
+                for boleta in alteradas if boleta.fechada and \
+                boleta.estado == cls.ESTADO[2][0])
+        return boletas
+
+    def tarefa_cotizar(self, data_referencia, lote):
+        """
+        Preenche o preço da cota com o preço carregado para a data de
+        cotização, e calcula a quantidade de cotas.
+        """
+        if self.preco == None:
+            self.preco = lote['precos'][(self.ativo_id, self.data_cotizacao)]
+        self.clean_quantidade()
+        return []
+
+    def cpr_de_cotizacao(self, lote):
+        """
+        Retorna o CPR de cotização da boleta entre os CPRs carregados, ou None.
+        """
+        for cpr in lote['cprs'].get(self.id, []):
+            if cpr.descricao.startswith("Cotização de "):
+                return cpr
+        return None
+
+    def tarefa_cpr_cotizacao(self, data_referencia, lote):
+        if self.cpr_de_cotizacao(lote) != None:
+            return []
+        cpr = self.montar_boleta_CPR_cotizacao()
+        lote['cprs'].setdefault(self.id, []).append(cpr)
+        return [(self.DERIVADO_CPR, cpr)]
+
+    def tarefa_cpr_liquidacao(self, data_referencia, lote):
+        for cpr in lote['cprs'].get(self.id, []):
+            if cpr.descricao.startswith("Liquidação de "):
+                return []
+        cpr = self.montar_boleta_CPR_liquidacao()
+        lote['cprs'].setdefault(self.id, []).append(cpr)
+        return [(self.DERIVADO_CPR, cpr)]
+
+    def tarefa_pagar_cpr_cotizacao(self, data_referencia, lote):
+        """
+        Preenche a data de pagamento do CPR de cotização com a data em que a
+        cota foi disponibilizada. CPRs ainda não gravados recebem a data antes
+        de serem criados.
+        """
+        cpr = self.cpr_de_cotizacao(lote)
+        if cpr != None:
+            cpr.data_pagamento = data_referencia
+            if cpr.pk != None:
+                lote['pagos'].append(cpr)
+        return []
+
+    def tarefa_provisao(self, data_referencia, lote):
+        if self.possui(self.DERIVADO_PROVISAO):
+            return []
+        return [(self.DERIVADO_PROVISAO, self.montar_provisao())]
+
+    def tarefa_movimentacao(self, data_referencia, lote):
+        if self.possui(self.DERIVADO_MOVIMENTACAO):
+            return []
+        return [(self.DERIVADO_MOVIMENTACAO, self.montar_movimentacao(data_referencia))]
+
+    def tarefa_quantidade(self, data_referencia, lote):
+        if self.possui(self.DERIVADO_QUANTIDADE):
+            return []
+        return [(self.DERIVADO_QUANTIDADE, self.montar_quantidade(data_referencia))]
+
+    def tarefa_passivo(self, data_referencia, lote):
+        if self.passivo() and not self.possui(self.DERIVADO_PASSIVO):
+            lote['passivos'].append(self)
+        return []
+
+    def tarefa_cota_passivo(self, data_referencia, lote):
+        """
+        Atualiza a boleta de passivo, criada sem cota, com o valor da cota.
+        """
+        if self.passivo():
+            lote['cotas_passivo'].append(self)
+        return []
+
+    def reabrir(self, data_referencia):
+        """ date -> None
+        Volta a boleta ao estado em que estava antes do fechamento da data
+        de referência, no reprocessamento do fundo. As quantidades,
+        movimentações, provisões e CPRs criados a partir da data já devem ter
+        sido apagados. Se a boleta voltar a aguardar a cotização, a data de
+        pagamento do CPR de cotização, preenchida na conclusão, é apagada.
+        """
+        cotizada = self.data_cotizacao < data_referencia
+        liquidada = self.data_liquidacao < data_referencia
+        if not cotizada and not liquidada:
+            estado = self.ESTADO[4][0]
+        elif liquidada and not cotizada:
+            estado = self.ESTADO[0][0]
+        elif cotizada and not liquidada:
+            # A quantidade só é criada na cotização se a cota estiver disponível.
+            if self.possui(self.DERIVADO_QUANTIDADE):
+                estado = self.ESTADO[1][0]
+            else:
+                estado = self.ESTADO[3][0]
+        else:
+            # Concluída antes da data, ou concluída depois dela quando a
+            # informação de cotização foi disponibilizada.
+            if self.possui(self.DERIVADO_QUANTIDADE):
+                return
+            estado = self.ESTADO[2][0]
+        if estado in (self.ESTADO[0][0], self.ESTADO[2][0], self.ESTADO[3][0]):
+            self.boleta_CPR.filter(descricao__startswith="Cotização de ", \
+                data_pagamento__gte=data_referencia).update(data_pagamento=None, \
+                proxima_acao=None, fechada=False)
+        self.estado = estado
+        self.atualizar_pendencia(data_referencia - datetime.timedelta(days=1))
+        if estado == self.ESTADO[2][0]:
+            # A cota pode já estar disponível: o fechamento da data verifica.
+            self.fechada = False
+            self.proxima_acao = data_referencia
+        self.save()
+
+    def montar_movimentacao(self, data_referencia=None):
+        """
+        Monta, sem salvar, a movimentação do ativo na data de referência ou,
+        se ela não for informada, na data de cotização.
+        """
+        if data_referencia == None:
+            data_referencia = self.data_cotizacao
+        self.clean_financeiro()
+        return fm.Movimentacao(
+            valor=self.financeiro,
+            fundo_id=self.fundo_id,
+            data=data_referencia,
+            content_object=self,
+            objeto_movimentacao=self.ativo,
+            custodia_id=self.custodia_id,
+            corretora_id=self.caixa_alvo.corretora_id,
+            ativo=self.ativo
+        )
+
+    def montar_quantidade(self, data_referencia=None):
+        """
+        Monta, sem salvar, a variação de quantidade do ativo na data de
+        referência ou, se ela não for informada, na data de cotização.
+        """
+        if data_referencia == None:
+            data_referencia = self.data_cotizacao
+        self.clean_quantidade()
+        return fm.Quantidade(
+            qtd=self.quantidade.quantize(decimal.Decimal('1.000000')),
+            fundo_id=self.fundo_id,
+            data=data_referencia,
+            content_object=self,
+            objeto_quantidade=self.ativo,
+            custodia_id=self.custodia_id,
+            corretora_id=self.caixa_alvo.corretora_id,
+            ativo=self.ativo
+        )
+
+    def montar_boleta_CPR_cotizacao(self, data_pagamento=None):
+        """
+        Monta, sem salvar, a boleta de CPR de cotização. Começa na primeira
+        entre as datas de liquidação e de cotização e, enquanto a cota não
+        for disponibilizada, não tem data de pagamento.
+        """
+        if self.operacao == self.OPERACAO[0][0]:
+            financeiro = decimal.Decimal(abs(self.financeiro)).quantize(decimal.Decimal('1.00'))
+        else:
+            financeiro = decimal.Decimal(-abs(self.financeiro)).quantize(decimal.Decimal('1.00'))
+        return BoletaCPR(
+            descricao="Cotização de " + self.ativo.nome,
+            valor_cheio=financeiro,
+            data_pagamento=data_pagamento,
+            data_inicio=min(self.data_liquidacao, self.data_cotizacao),
+            fundo_id=self.fundo_id,
+            content_object=self
+        )
 
-            elif self.estado == self.ESTADO[3][0] and \
-                (self.cotizavel() == True or self.preco != None) and \
-                data_referencia == self.data_liquidacao:
-                """
-                Transição 8 - Pendente de liquidação e informação de cotização -> concluído
-                """
-                # Pegando boleta de CPR de cotização
-                boleta = self.boleta_CPR.filter(valor_cheio=self.financeiro).first()
-                boleta.data_pagamento = data_referencia
-                self.clean_preco()
-                self.clean_quantidade()
-                self.criar_movimentacao(data_referencia)
-                self.criar_quantidade(data_referencia)
-                self.estado = self.ESTADO[5][0]
-                if self.passivo():
-                    passivo = self.boleta_passivo.all().get(object_id=self.id)
-                    if passivo.cota == None:
-                        passivo.cota = self.preco
-                        passivo.save()
-                boleta.save()
-            elif self.estado == self.ESTADO[3][0] and self.cotizavel() == False and\
-                self.preco == None and data_referencia == self.data_liquidacao:
-                """
-                Transição 9 - Pendente de liquidação e informação de cotização -> Pendente de informação de cotização.
-                """
-                self.estado = self.ESTADO[2][0]
-                self.save()
+    def montar_boleta_CPR_liquidacao(self):
+        """
+        Monta, sem salvar, a boleta de CPR de liquidação, com valor contrário
+        ao do CPR de cotização.
+        """
+        if self.operacao == self.OPERACAO[0][0]:
+            financeiro = decimal.Decimal(-abs(self.financeiro)).quantize(decimal.Decimal('1.00'))
+        else:
+            financeiro = decimal.Decimal(abs(self.financeiro)).quantize(decimal.Decimal('1.00'))
+        return BoletaCPR(
+            descricao="Liquidação de " + self.ativo.nome,
+            valor_cheio=financeiro,
+            data_pagamento=self.data_liquidacao,
+            data_inicio=self.data_cotizacao,
+            fundo_id=self.fundo_id,
+            content_object=self
+        )
+
+    def montar_provisao(self):
+        """
+        Monta, sem salvar, a provisão da saída ou entrada de caixa na data de
+        liquidação.
+        """
+        return BoletaProvisao(
+            descricao=self.operacao + " de " + self.ativo.nome,
+            caixa_alvo_id=self.caixa_alvo_id,
+            fundo_id=self.fundo_id,
+            data_pagamento=self.data_liquidacao,
+            financeiro=-self.financeiro.quantize(decimal.Decimal('1.00')),
+            content_object=self
+        )
 
     def criar_movimentacao(self, data_referencia=None):
         """
@@ -1300,18 +1831,8 @@ class BoletaFundoOffshore(BaseModel):
         variação de quantidade e, no cálculo do retorno do ativo, não haja
         um retorno errado devido a esse descasamento
         """
-        if self.relacao_movimentacao.all().exists() == False:
-            if data_referencia == None:
-                data_referencia = self.data_cotizacao
-            self.clean_financeiro()
-            from fundo.models import Quantidade, Movimentacao
-            mov = Movimentacao(
-                valor=self.financeiro,
-                fundo=self.fundo,
-                data=data_referencia,
-                content_object=self,
-                objeto_movimentacao=self.ativo
-            )
+        if not self.possui(self.DERIVADO_MOVIMENTACAO):
+            mov = self.montar_movimentacao(data_referencia)
             mov.full_clean()
             mov.save()
 
@@ -1319,18 +1840,8 @@ class BoletaFundoOffshore(BaseModel):
         """
         Cria a variação de quantidade do ativo sendo negociado.
         """
-        if self.relacao_quantidade.all().exists() == False:
-            if data_referencia == None:
-                data_referencia = self.data_cotizacao
-            self.clean_quantidade()
-            from fundo.models import Quantidade, Movimentacao
-            qtd = Quantidade(
-                qtd=self.quantidade.quantize(decimal.Decimal('1.000000')),
-                fundo=self.fundo,
-                data=data_referencia,
-                content_object=self,
-                objeto_quantidade=self.ativo
-            )
+        if not self.possui(self.DERIVADO_QUANTIDADE):
+            qtd = self.montar_quantidade(data_referencia)
             qtd.full_clean()
             qtd.save()
 
@@ -1338,60 +1849,10 @@ class BoletaFundoOffshore(BaseModel):
         """
         Cria uma boleta de cotização com as informações da boleta.
         """
-        if self.boleta_CPR.all().filter(valor_cheio=self.financeiro).exists() == False:
-            # Verifica se há preço. Se não houver, cria uma boleta de CPR sem
-            # data de pagamento
-            financeiro = 0
-            if self.operacao == self.OPERACAO[0][0]:
-                financeiro = decimal.Decimal(abs(self.financeiro)).quantize(decimal.Decimal('1.00'))
-            else:
-                financeiro = decimal.Decimal(-abs(self.financeiro)).quantize(decimal.Decimal('1.00'))
-            if self.preco == None:
-                if self.data_liquidacao < self.data_cotizacao:
-                    cpr = BoletaCPR(
-                        descricao="Cotização de " + self.ativo.nome,
-                        valor_cheio=financeiro,
-                        data_pagamento=data_referencia,
-                        data_inicio=self.data_liquidacao,
-                        fundo=self.fundo,
-                        content_object=self
-                    )
-                    cpr.full_clean()
-                    cpr.save()
-                else:
-                    cpr = BoletaCPR(
-                        descricao="Cotização de " + self.ativo.nome,
-                        valor_cheio=financeiro,
-                        data_pagamento=data_referencia,
-                        data_inicio=self.data_cotizacao,
-                        fundo=self.fundo,
-                        content_object=self
-                    )
-                    cpr.full_clean()
-                    cpr.save()
-            else:
-                if self.data_liquidacao < self.data_cotizacao:
-                    cpr = BoletaCPR(
-                        descricao="Cotização de " + self.ativo.nome,
-                        valor_cheio=financeiro,
-                        data_pagamento=data_referencia,
-                        data_inicio=self.data_liquidacao,
-                        fundo=self.fundo,
-                        content_object=self
-                    )
-                    cpr.full_clean()
-                    cpr.save()
-                else:
-                    cpr = BoletaCPR(
-                        descricao="Cotização de " + self.ativo.nome,
-                        valor_cheio=financeiro,
-                        data_pagamento=data_referencia,
-                        data_inicio=self.data_cotizacao,
-                        fundo=self.fundo,
-                        content_object=self
-                    )
-                    cpr.full_clean()
-                    cpr.save()
+        if not self.boleta_CPR.filter(descricao__startswith="Cotização de ").exists():
+            cpr = self.montar_boleta_CPR_cotizacao(data_referencia)
+            cpr.full_clean()
+            cpr.save()
 
     def criar_boleta_CPR_liquidacao(self, data_referencia=None):
         """
@@ -1399,20 +1860,8 @@ class BoletaFundoOffshore(BaseModel):
         Ela deve ter um valor contrário ao valor financeiro da boleta de
         CPR de cotização.
         """
-        if self.boleta_CPR.all().filter(valor_cheio=-self.financeiro).exists() == False:
-            financeiro = 0
-            if self.operacao == self.OPERACAO[0][0]:
-                financeiro = decimal.Decimal(-abs(self.financeiro)).quantize(decimal.Decimal('1.00'))
-            else:
-                financeiro = decimal.Decimal(abs(self.financeiro)).quantize(decimal.Decimal('1.00'))
-            cpr = BoletaCPR(
-                descricao="Liquidação de " + self.ativo.nome,
-                valor_cheio=financeiro,
-                data_pagamento=self.data_liquidacao,
-                data_inicio=self.data_cotizacao,
-                fundo=self.fundo,
-                content_object=self
-            )
+        if not self.boleta_CPR.filter(descricao__startswith="Liquidação de ").exists():
+            cpr = self.montar_boleta_CPR_liquidacao()
             cpr.full_clean()
             cpr.save()
 
@@ -1420,15 +1869,8 @@ class BoletaFundoOffshore(BaseModel):
         """
         Cria provisão com base na data de liquidação da operação.
         """
-        if self.boleta_provisao.all().exists() == False:
-            provisao = BoletaProvisao(
-                descricao=self.operacao + " de " + self.ativo.nome,
-                caixa_alvo=self.caixa_alvo,
-                fundo=self.fundo,
-                data_pagamento=self.data_liquidacao,
-                financeiro=-self.financeiro.quantize(decimal.Decimal('1.00')),
-                content_object=self
-            )
+        if not self.possui(self.DERIVADO_PROVISAO):
+            provisao = self.montar_provisao()
             provisao.full_clean()
             provisao.save()
 
@@ -1436,7 +1878,7 @@ class BoletaFundoOffshore(BaseModel):
         """
         Cria boleta de passivo, caso o ativo negociado seja um fundo gerido.
         """
-        if self.boleta_passivo.all().exists() == False:
+        if not self.possui(self.DERIVADO_PASSIVO):
             cotista = fm.Cotista.objects.filter(fundo_cotista=self.fundo).first()
             if cotista == None:
                 cotista = fm.Cotista(
@@ -1459,7 +1901,7 @@ class BoletaFundoOffshore(BaseModel):
             passivo.full_clean()
             passivo.save()
 
-class BoletaEmprestimo(BaseModel):
+class BoletaEmprestimo(PendenciaFechamento, BaseModel):
     """
     Representa uma operação de empréstimo de ações locais.
     CPR: Ao fazer o fechamento de uma boleta de empréstimo, caso não haja boleta
@@ -1712,6 +2154,21 @@ class BoletaEmprestimo(BaseModel):
         else:
             raise ValueError('O contrato não é reversível, só é possível liquidá-lo no vencimento.')
 
+    CAMPOS_PENDENCIA = ('data_operacao', 'data_liquidacao')
+
+    def atualizar_pendencia(self, data_referencia=None):
+        """ date -> None
+        O empréstimo em aberto é processado todos os dias a partir da data de
+        operação. Empréstimos liquidados não são mais processados.
+        """
+        self.fechada = self.data_liquidacao != None
+        if self.fechada:
+            self.proxima_acao = None
+        elif data_referencia == None:
+            self.proxima_acao = self.data_operacao
+        else:
+            self.proxima_acao = max(self.data_operacao, data_referencia + datetime.timedelta(days=1))
+
     def fechar_boleta(self, data_referencia):
         """
         O fechamento da boleta deve ocorrer da seguinte maneira:
@@ -1750,7 +2207,7 @@ class BoletaEmprestimo(BaseModel):
         """
         # TODO: testar
         # Checar se já há boleta de provisão criada relacionada com esta.
-        if self.boleta_provisao.all().exists() == False:
+        if not self.possui(self.DERIVADO_PROVISAO):
             # Criar boleta de provisão
             boleta_provisao = BoletaProvisao(
                 descricao = "Aluguel de " + self.ativo.nome,
@@ -1771,7 +2228,7 @@ class BoletaEmprestimo(BaseModel):
         de criar outra. O valor_cheio é atualizado no fechamento da boleta.
         """
         # Checar se há boleta de CPR já criada:
-        if self.boleta_CPR.all().exists() == False:
+        if not self.possui(self.DERIVADO_CPR):
             # Criar boleta de CPR
             boleta_CPR = BoletaCPR(
                 descricao = 'Aluguel ' + self.ativo.nome,
@@ -1792,7 +2249,7 @@ class BoletaEmprestimo(BaseModel):
         A movimentação é medida em financeiro do ativo.
         """
         # Checar se há movimentação já criada
-        if self.relacao_movimentacao.all().exists() == False:
+        if not self.possui(self.DERIVADO_MOVIMENTACAO):
             # Criar Movimentacao do Ativo
             if self.data_liquidacao is not None:
                 if self.data_liquidacao > self.data_operacao:
@@ -1805,7 +2262,10 @@ class BoletaEmprestimo(BaseModel):
                         fundo = self.fundo,
                         data = self.calendario.dia_trabalho(self.data_liquidacao, 1),
                         content_object = self,
-                        objeto_movimentacao = self.ativo
+                        objeto_movimentacao = self.ativo,
+                        custodia = self.custodia,
+                        corretora = self.caixa_alvo.corretora,
+                        ativo = self.ativo
                     )
                     acao_movimentacao.save()
                 else:
@@ -1813,7 +2273,7 @@ class BoletaEmprestimo(BaseModel):
             else:
                 raise TypeError("A data de liquidação deve estar preenchida para criar a movimentação.")
 
-class BoletaCambio(BaseModel):
+class BoletaCambio(PendenciaFechamento, BaseModel):
     """
     Representa uma operação de câmbio entre caixas. Ele também pode ser
     usado para transferência de caixas da mesma moeda
@@ -1919,7 +2379,7 @@ class BoletaCambio(BaseModel):
             provisao.full_clean()
             provisao.save()
 
-class BoletaProvisao(BaseModel):
+class BoletaProvisao(PendenciaFechamento, BaseModel):
     """
     Boleta para registrar despesas a serem pagas por um fundo
     """
@@ -1949,11 +2409,91 @@ class BoletaProvisao(BaseModel):
     class Meta:
         verbose_name_plural = "Boletas de provisão"
 
+    CAMPOS_PENDENCIA = ('data_pagamento',)
+
+    def atualizar_pendencia(self, data_referencia=None):
+        """ date -> None
+        A provisão é processada no primeiro fechamento após ser criada. A
+        próxima ação indica a data de pagamento. Provisões de zeragem não
+        criam movimentação.
+        """
+        self.fechada = self.possui(self.DERIVADO_QUANTIDADE) and \
+            (self.estado == self.ESTADO[2][0] or self.possui(self.DERIVADO_MOVIMENTACAO))
+        self.proxima_acao = None if self.fechada else self.data_pagamento
+
+    # Campo somado nas provisões compensadas.
+    CAMPO_COMPENSADO = 'financeiro'
+
+    def chave_compensacao(self, moeda_fundo=None):
+        """ int -> tuple
+        Provisões pendentes são compensadas por fundo, caixa e data de
+        pagamento.
+        """
+        if self.estado != self.ESTADO[0][0]:
+            return None
+        return (self.fundo_id, self.caixa_alvo_id, self.data_pagamento)
+
+    def montar_liquida(self, chave):
+        """ tuple -> BoletaProvisao
+        Monta, sem salvar e com valor zerado, a provisão líquida da chave de
+        compensação desta provisão.
+        """
+        return BoletaProvisao(
+            descricao='Liquidação compensada',
+            caixa_alvo_id=self.caixa_alvo_id,
+            fundo_id=self.fundo_id,
+            data_pagamento=self.data_pagamento,
+            financeiro=0
+        )
+
+    @classmethod
+    def liquidos_em_aberto(cls):
+        """ -> QuerySet
+        Provisões compensadas que ainda não geraram quantidade nem
+        movimentação, e podem receber novas parcelas.
+        """
+        return cls.objects.filter(content_type=None, estado=cls.ESTADO[0][0], \
+            derivados=0, composicao__isnull=False).distinct()
+
     def fechado(self):
         """
         Determina se uma boleta de provisão foi fechada ou não.
         """
-        return self.relacao_quantidade.exists() and self.relacao_movimentacao.exists()
+        return self.possui(self.DERIVADO_QUANTIDADE, self.DERIVADO_MOVIMENTACAO)
+
+    RELACIONADOS_LOTE = ('caixa_alvo',)
+
+    def montar_derivados(self):
+        """
+        Monta a quantidade e a movimentação do caixa que a provisão ainda não
+        possui, para o fechamento em lote. Provisões de zeragem não criam
+        movimentação.
+        """
+        pares = []
+        if not self.possui(self.DERIVADO_MOVIMENTACAO) and \
+            self.estado != self.ESTADO[2][0]:
+            pares.append((self.DERIVADO_MOVIMENTACAO, fm.Movimentacao(
+                valor=self.financeiro,
+                fundo_id=self.fundo_id,
+                data=self.data_pagamento,
+                objeto_movimentacao=self.caixa_alvo,
+                custodia_id=self.caixa_alvo.custodia_id,
+                corretora_id=self.caixa_alvo.corretora_id,
+                ativo_id=self.caixa_alvo_id,
+                content_object=self
+            )))
+        if not self.possui(self.DERIVADO_QUANTIDADE):
+            pares.append((self.DERIVADO_QUANTIDADE, fm.Quantidade(
+                qtd=self.financeiro,
+                fundo_id=self.fundo_id,
+                data=self.data_pagamento,
+                objeto_quantidade=self.caixa_alvo,
+                custodia_id=self.caixa_alvo.custodia_id,
+                corretora_id=self.caixa_alvo.corretora_id,
+                ativo_id=self.caixa_alvo_id,
+                content_object=self
+            )))
+        return pares
 
     def fechar_boleta(self, data_referencia):
         """
@@ -1970,7 +2510,7 @@ class BoletaProvisao(BaseModel):
         """
         Cria a movimentação do caixa
         """
-        if self.relacao_movimentacao.exists() == False and \
+        if not self.possui(self.DERIVADO_MOVIMENTACAO) and \
             self.estado != self.ESTADO[2][0]:
             from fundo.models import Quantidade, Movimentacao
             mov = Movimentacao(
@@ -1978,6 +2518,9 @@ class BoletaProvisao(BaseModel):
                 fundo=self.fundo,
                 data=self.data_pagamento,
                 objeto_movimentacao=self.caixa_alvo,
+                custodia=self.caixa_alvo.custodia,
+                corretora=self.caixa_alvo.corretora,
+                ativo=self.caixa_alvo,
                 content_object=self
             )
             self.save()
@@ -1988,20 +2531,23 @@ class BoletaProvisao(BaseModel):
         """
         Cria a quantidade do caixa.
         """
-        if self.relacao_quantidade.exists() == False:
+        if not self.possui(self.DERIVADO_QUANTIDADE):
             from fundo.models import Quantidade, Movimentacao
             qtd = Quantidade(
                 qtd=self.financeiro,
                 fundo=self.fundo,
                 data=self.data_pagamento,
                 objeto_quantidade=self.caixa_alvo,
+                custodia=self.caixa_alvo.custodia,
+                corretora=self.caixa_alvo.corretora,
+                ativo=self.caixa_alvo,
                 content_object=self
             )
             self.save()
             qtd.full_clean()
             qtd.save()
 
-class BoletaCPR(BaseModel):
+class BoletaCPR(PendenciaFechamento, BaseModel):
     """
     Boleta para registrar CPR dos fundos.
     Acúmulo:
@@ -2079,6 +2625,9 @@ class BoletaCPR(BaseModel):
     # Capitalização indica o período com que o CPR acumula
     capitalizacao = models.CharField(max_length=7, choices=CAPITALIZACAO,
         default=CAPITALIZACAO[2][0])
+    # Custodiante do CPR compensado, que não tem boleta de origem.
+    custodia = models.ForeignKey('fundo.Custodiante', on_delete=models.PROTECT,
+        null=True, blank=True)
 
     relacao_vertice = GenericRelation('fundo.Vertice', related_query_name='cpr')
     relacao_provisao= GenericRelation('BoletaProvisao')
@@ -2113,6 +2662,73 @@ class BoletaCPR(BaseModel):
             self.data_vigencia_fim, self.data_pagamento, self.tipo,
             self.capitalizacao)
 
+    CAMPOS_PENDENCIA = ('data_inicio', 'data_pagamento')
+
+    # Campo somado nos CPRs compensados.
+    CAMPO_COMPENSADO = 'valor_cheio'
+
+    def chave_compensacao(self, moeda_fundo=None):
+        """ int -> tuple
+        CPRs de operação são compensados por fundo, custodiante, data de
+        início e data de pagamento. O custodiante vem da boleta de origem.
+        Como o CPR compensado não tem ativo para buscar o câmbio, apenas CPRs
+        de ativos na moeda do fundo são compensados.
+        """
+        if self.tipo != self.TIPO[2][0] or self.data_pagamento == None:
+            return None
+        if self.content_type_id == None:
+            custodia_id = self.custodia_id
+        else:
+            origem = self.content_object
+            ativo = getattr(origem, 'acao', None) or getattr(origem, 'ativo', None)
+            if ativo == None or ativo.moeda_id != moeda_fundo:
+                return None
+            custodia_id = getattr(origem, 'custodia_id', None)
+        if custodia_id == None:
+            return None
+        return (self.fundo_id, custodia_id, self.data_inicio, self.data_pagamento)
+
+    def montar_liquida(self, chave):
+        """ tuple -> BoletaCPR
+        Monta, sem salvar e com valor zerado, o CPR líquido da chave de
+        compensação deste CPR.
+        """
+        fundo_id, custodia_id, data_inicio, data_pagamento = chave
+        return BoletaCPR(
+            descricao='CPR compensado',
+            fundo_id=fundo_id,
+            custodia_id=custodia_id,
+            valor_cheio=0,
+            data_inicio=data_inicio,
+            data_pagamento=data_pagamento
+        )
+
+    @classmethod
+    def liquidos_em_aberto(cls):
+        """ -> QuerySet
+        CPRs compensados que ainda não foram processados pelo fechamento na
+        data de início, e podem receber novas parcelas.
+        """
+        return cls.objects.filter(content_type=None, fechada=False, \
+            proxima_acao=models.F('data_inicio'), composicao__isnull=False).distinct()
+
+    def atualizar_pendencia(self, data_referencia=None):
+        """ date -> None
+        O CPR é processado todos os dias entre as datas de início e de
+        pagamento. Sem data de pagamento, aguarda até que ela seja preenchida.
+        """
+        if self.data_pagamento == None:
+            self.fechada = False
+            self.proxima_acao = None
+            return
+        self.fechada = data_referencia != None and data_referencia >= self.data_pagamento
+        if self.fechada:
+            self.proxima_acao = None
+        elif data_referencia == None:
+            self.proxima_acao = self.data_inicio
+        else:
+            self.proxima_acao = max(self.data_inicio, data_referencia + datetime.timedelta(days=1))
+
     def fechar_boleta(self, data_referencia):
         self.criar_vertice(data_referencia)
 
@@ -2122,7 +2738,6 @@ class BoletaCPR(BaseModel):
         tipo, data de vigência e data de início e pagamento. No caso de
         CPR e Empréstimo, seu valor cheio é o seu valor presente, sempre
         """
-        import pdb
         if self.tipo == self.TIPO[2][0] or self.tipo == self.TIPO[3][0]:
             cambio = self.buscar_cambio(data_referencia)
             return self.valor_cheio*cambio
@@ -2426,7 +3041,7 @@ class BoletaCPR(BaseModel):
                     """
                     desc_prov = "Taxa de administração"
                     # Verifica se há provisão criada. Se não houver, cria uma.
-                    if self.relacao_provisao.exists() == False:
+                    if not self.possui(self.DERIVADO_PROVISAO):
                         prov_taxa_adm = Provisao(
                             descricao=self.TAXA_ADM_TEXTO,
                             caixa_alvo=self.fundo.caixa_padrao,
@@ -2459,6 +3074,8 @@ class BoletaCPR(BaseModel):
         Encontra quem é o custodiante do ativo relativo ao CPR
         """
         from mercado import models as mm
+        if self.custodia_id != None:
+            return self.custodia
         if type(self.content_object) == mm.Provento:
             # Encontra a boleta de provisão fruto do mesmo provento.
             provisao = BoletaProvisao.objects.get(content_type=self.content_type, \
@@ -2478,7 +3095,7 @@ class BoletaCPR(BaseModel):
         elif self.content_object == None:
             return self.fundo.custodia
 
-class BoletaPassivo(BaseModel):
+class BoletaPassivo(PendenciaFechamento, BaseModel):
     """
     Boleta de movimentação de passivo de fundos.
     Deve criar um certificado de passivo quando a boleta for cotizável.
@@ -2559,7 +3176,7 @@ class BoletaPassivo(BaseModel):
         """
         Cria uma boleta de provisão de acordo com as informações na boleta.
         """
-        if self.boleta_provisao.all().exists() == False:
+        if not self.possui(self.DERIVADO_PROVISAO):
             financeiro = abs(self.valor)
             if self.operacao == self.OPERACAO[0][0]:
                 financeiro = abs(self.valor)
@@ -2594,7 +3211,7 @@ class BoletaPassivo(BaseModel):
             - Aplicação - cotização anteiror à liquidação
             - Resgate - liquidação anterior à cotização.
         """
-        if self.boleta_CPR.all().exists() == False:
+        if not self.possui(self.DERIVADO_CPR):
             financeiro = 0
             if (self.operacao == self.OPERACAO[0][0] and self.data_cotizacao < self.data_liquidacao) or \
                 (self.operacao != self.OPERACAO[0][0] and self.data_liquidacao < self.data_cotizacao):
@@ -2632,15 +3249,30 @@ class BoletaPassivo(BaseModel):
             cpr.full_clean()
             cpr.save()
 
+    CAMPOS_PENDENCIA = ('data_operacao', 'data_cotizacao', 'data_liquidacao')
+
+    def atualizar_pendencia(self, data_referencia=None):
+        """ date -> None
+        A boleta é processada todos os dias, da data de operação até a data
+        de cotização, até ser fechada.
+        """
+        self.fechada = self.fechado()
+        if self.fechada or (data_referencia != None and data_referencia >= self.data_cotizacao):
+            self.proxima_acao = None
+        elif data_referencia == None:
+            self.proxima_acao = self.data_operacao
+        else:
+            self.proxima_acao = max(self.data_operacao, data_referencia + datetime.timedelta(days=1))
+
     def fechado(self):
-        return self.boleta_provisao.exists() and self.boleta_CPR.exists() and \
-            self.certificado_passivo.exists()
+        return self.possui(self.DERIVADO_PROVISAO, self.DERIVADO_CPR, \
+            self.DERIVADO_CERTIFICADO)
 
     def gerar_certificado(self):
         """
         Gera um certificado de passivo no fundo.
         """
-        if (self.certificado_passivo.all().exists()==False) and self.cota != None:
+        if not self.possui(self.DERIVADO_CERTIFICADO) and self.cota != None:
             qtd = (self.valor/self.cota).quantize(decimal.Decimal('1.0000000'))
             certificado = fm.CertificadoPassivo(
                 cotista=self.cotista,
@@ -2662,7 +3294,7 @@ class BoletaPassivo(BaseModel):
         """
         # Só consome os certificados se for possível calcular a quantidade de
         # cotas a serem consumidas - NO CASO DE RESGATE NÃO TOTAL.
-        if (self.certificado_passivo.all().exists()==False and self.cota!=None and self.valor!=None and self.operacao==self.OPERACAO[1][0]):
+        if (not self.possui(self.DERIVADO_CERTIFICADO) and self.cota!=None and self.valor!=None and self.operacao==self.OPERACAO[1][0]):
             cotas_totais = abs(self.valor/self.cota)
             cotas_consumidas = cotas_totais
             while cotas_consumidas > 0:
@@ -2679,3 +3311,431 @@ class BoletaPassivo(BaseModel):
                 self.save()
         if (self.operacao == self.OPERACAO[2][0]):
             pass
+
+    def desfazer_certificado(self):
+        """
+        Desfaz o que o fechamento da boleta fez nos certificados de passivo.
+        Na aplicação, apaga o certificado gerado. No resgate, devolve as cotas
+        consumidas aos certificados ligados à boleta, do mais recente ao mais
+        antigo, já que o consumo parte do certificado mais antigo.
+        """
+        if self.operacao == self.OPERACAO[0][0]:
+            certificados = list(self.certificado_passivo.all().values_list('id', flat=True))
+            self.certificado_passivo.clear()
+            fm.CertificadoPassivo.objects.filter(id__in=certificados).delete()
+            return
+        if self.cota != None and self.valor != None and self.operacao == self.OPERACAO[1][0]:
+            cotas_devolvidas = abs(self.valor/self.cota)
+            for certificado in self.certificado_passivo.all().order_by('-data', '-id'):
+                if cotas_devolvidas <= 0:
+                    break
+                devolvidas = min(cotas_devolvidas, certificado.qtd_cotas - certificado.cotas_aplicadas)
+                certificado.cotas_aplicadas = (certificado.cotas_aplicadas + devolvidas).quantize(decimal.Decimal('1.0000000'))
+                certificado.save()
+                cotas_devolvidas -= devolvidas
+        self.certificado_passivo.clear()
+
+class Composicao(models.Model):
+    """
+    Parcela de uma provisão ou CPR compensado, ligada à boleta de operação
+    que a originou. Guarda a linhagem dos valores líquidos.
+    """
+    content_type = models.ForeignKey(ContentType, on_delete=models.PROTECT)
+    object_id = models.PositiveIntegerField()
+    content_object = GenericForeignKey('content_type', 'object_id')
+    valor = models.DecimalField(max_digits=16, decimal_places=2)
+
+    class Meta:
+        abstract = True
+
+class ComposicaoProvisao(Composicao):
+    provisao = models.ForeignKey('BoletaProvisao', on_delete=models.CASCADE,
+        related_name='composicao')
+
+    class Meta:
+        verbose_name_plural = "Composições de provisões"
+
+class ComposicaoCPR(Composicao):
+    cpr = models.ForeignKey('BoletaCPR', on_delete=models.CASCADE,
+        related_name='composicao')
+
+    class Meta:
+        verbose_name_plural = "Composições de CPRs"
+
+class EventoCotizacao(models.Model):
+    """
+    Fila das boletas de fundo que aguardam a informação de cotização. Quando
+    a cota de um Fundo_Offshore ou Fundo_Local é gravada em Preco, pelo
+    admin, pela carga em lote ou por qualquer outro meio, as boletas que
+    aguardam a cota dessa data são enfileiradas, e deixam de ser procuradas
+    a cada fechamento. O comando processar_cotizacoes executa a fila fora do
+    fechamento: as transições são aplicadas na primeira data ainda não
+    fechada do fundo e, se os objetos criados caírem em uma data já fechada,
+    a data é marcada em reprocessar.
+    """
+    content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
+    object_id = models.PositiveIntegerField()
+    boleta = GenericForeignKey('content_type', 'object_id')
+    fundo = models.ForeignKey('fundo.Fundo', on_delete=models.CASCADE)
+    data_cotizacao = models.DateField()
+    criado_em = models.DateTimeField(auto_now_add=True)
+    processado_em = models.DateTimeField(null=True, blank=True, db_index=True)
+    # Primeira data já fechada do fundo afetada pelo processamento, que deve
+    # ser reprocessada.
+    reprocessar = models.DateField(null=True, blank=True, db_index=True)
+
+    class Meta:
+        verbose_name_plural = "Eventos de cotização"
+
+    def __str__(self):
+        return "Cotização de %s em %s" % (self.boleta, self.data_cotizacao)
+
+    @staticmethod
+    def aguardando_cota():
+        """ -> list
+        Retorna, para cada modelo de boleta de fundo, a condição das boletas
+        que aguardam a informação de cotização. Boletas ainda pendentes no
+        fechamento encontram a cota quando forem fechadas.
+        """
+        return [
+            (BoletaFundoOffshore, models.Q(fechada=True, \
+                estado=BoletaFundoOffshore.ESTADO[2][0])),
+            (BoletaFundoLocal, models.Q(fechada=True, preco=None, quantidade=None)),
+        ]
+
+    @classmethod
+    def enfileirar(cls, pares):
+        """ iterable (int, date) -> int
+        Recebe os pares (id do ativo, data) gravados com preço de fechamento
+        e enfileira as boletas que aguardam a cota do ativo nessa data de
+        cotização, se ainda não estiverem na fila. Só os preços de fundos
+        (Fundo_Local e Fundo_Offshore) podem ser cotas, então os demais são
+        descartados com uma única consulta antes de buscar as boletas.
+        Retorna a quantidade de boletas enfileiradas.
+        """
+        pares = set(pares)
+        if not pares:
+            return 0
+        fundos = set(am.Ativo.objects.filter(models.Q(fundo_local__isnull=False) | \
+            models.Q(fundo_offshore__isnull=False), \
+            id__in={ativo for ativo, data in pares}).values_list('id', flat=True))
+        pares = {(ativo, data) for ativo, data in pares if ativo in fundos}
+        if not pares:
+            return 0
+        ativos = {ativo for ativo, data in pares}
+        datas = {data for ativo, data in pares}
+        novos = []
+        for modelo, aguardando in cls.aguardando_cota():
+            tipo = ContentType.objects.get_for_model(modelo)
+            enfileiradas = cls.objects.filter(content_type=tipo, \
+                processado_em=None).values('object_id')
+            boletas = modelo.objects.filter(aguardando, ativo_id__in=ativos, \
+                data_cotizacao__in=datas).exclude(id__in=enfileiradas).\
+                values_list('id', 'fundo_id', 'ativo_id', 'data_cotizacao')
+            novos.extend(cls(content_type=tipo, object_id=id, fundo_id=fundo, \
+                data_cotizacao=data) for id, fundo, ativo, data in boletas \
+                if (ativo, data) in pares)
+        cls.objects.bulk_create(novos)
+        return len(novos)
+
+    @classmethod
+    def enfileirar_cotadas(cls, pares):
+        """ iterable (int, date) -> int
+        Recebe os pares (id do ativo, data de cotização) de boletas que o
+        fechamento acabou de gravar como aguardando a cota, e enfileira as
+        que já têm cota. Uma cota gravada durante o fechamento, antes de as
+        boletas serem gravadas como aguardando, não as encontra em enfileirar.
+        Deve ser chamado na transação que grava as boletas.
+        """
+        return cls.enfileirar(mm.Preco.precos_nas_datas(pares))
+
+    @classmethod
+    def processar(cls, fundos=None):
+        """ list -> dict
+        Processa os eventos pendentes, fundo a fundo, cada um em uma
+        transação. As boletas de fundo offshore passam pelas transições de
+        fechamento em lote na primeira data ainda não fechada do fundo,
+        posterior à cotização, e as de fundo local são fechadas e registradas
+        na última data fechada. Fundos sendo fechados por outro processo em
+        alguma dessas datas ficam para a próxima execução. Retorna, para cada
+        fundo processado, a data a reprocessar, ou None.
+        """
+        eventos = cls.objects.filter(processado_em=None).select_related('fundo')
+        if fundos is not None:
+            eventos = eventos.filter(fundo__in=fundos)
+        por_fundo = {}
+        for evento in eventos:
+            por_fundo.setdefault(evento.fundo, []).append(evento)
+        tipo_offshore = ContentType.objects.get_for_model(BoletaFundoOffshore).id
+        resultado = {}
+        for fundo, eventos_fundo in por_fundo.items():
+            reprocessar = None
+            with transaction.atomic():
+                ultima, offshore, locais = cls.travar_datas(fundo, eventos_fundo, \
+                    tipo_offshore)
+                if offshore == None:
+                    # Os eventos ficam na fila para a próxima execução.
+                    continue
+                for data, ids in offshore.items():
+                    BoletaFundoOffshore.fechar_em_lote(BoletaFundoOffshore.objects.filter( \
+                        id__in=ids, estado=BoletaFundoOffshore.ESTADO[2][0]), data)
+                for boleta in BoletaFundoLocal.objects.filter(id__in=locais, \
+                    preco=None, quantidade=None):
+                    boleta.fechar_boleta()
+                    boleta.registrar_fechamento(ultima)
+                    # A quantidade do fundo local é criada na data de cotização.
+                    if boleta.possui(boleta.DERIVADO_QUANTIDADE) and ultima != None \
+                        and boleta.data_cotizacao <= ultima:
+                        if reprocessar == None or boleta.data_cotizacao < reprocessar:
+                            reprocessar = boleta.data_cotizacao
+                cls.objects.filter(id__in=[evento.id for evento in eventos_fundo]).\
+                    update(processado_em=timezone.now(), reprocessar=reprocessar)
+            resultado[fundo.id] = reprocessar
+        return resultado
+
+    @staticmethod
+    def travar_datas(fundo, eventos, tipo_offshore):
+        """ Fundo, list, int -> (date, dict, list)
+        Obtém a trava de Fundo.travar_fechamento em cada data em que os
+        eventos do fundo serão processados: as boletas de fundo offshore, na
+        primeira data ainda não fechada posterior à cotização, e as de fundo
+        local, na primeira data ainda não fechada do fundo. Retorna a última
+        data fechada, os ids das boletas offshore por data e os ids das
+        boletas locais. Se outro processo estiver fechando o fundo em alguma
+        das datas, retorna (None, None, None). Deve ser chamado dentro de
+        uma transação.
+        """
+        um_dia = datetime.timedelta(days=1)
+        ultima = fundo.ultima_data_fechada()
+        while True:
+            offshore = {}
+            locais = []
+            datas = set()
+            for evento in eventos:
+                if evento.content_type_id == tipo_offshore:
+                    data = evento.data_cotizacao + um_dia
+                    if ultima != None:
+                        data = max(data, ultima + um_dia)
+                    offshore.setdefault(data, []).append(evento.object_id)
+                else:
+                    data = evento.data_cotizacao if ultima == None else ultima + um_dia
+                    locais.append(evento.object_id)
+                datas.add(data)
+            for data in sorted(datas):
+                if fundo.travar_fechamento(data) == False:
+                    return None, None, None
+            # Um fechamento concluído antes das travas muda as datas.
+            atual = fundo.ultima_data_fechada()
+            if atual == ultima:
+                return ultima, offshore, locais
+            ultima = atual
+
+    @classmethod
+    def reprocessar_fundos(cls):
+        """ -> dict
+        Reprocessa cada fundo a partir da primeira data marcada pelos eventos
+        e limpa as marcas. Fundos sendo fechados por outro processo mantêm as
+        marcas. Retorna os dias fechados novamente de cada fundo.
+        """
+        resultado = {}
+        datas = cls.objects.exclude(reprocessar=None).values('fundo_id').\
+            annotate(data=models.Min('reprocessar'))
+        for linha in datas:
+            fundo = fm.Fundo.objects.get(id=linha['fundo_id'])
+            dias = fundo.reprocessar_cota(linha['data'])
+            if dias is not None:
+                cls.objects.filter(fundo=fundo).exclude(reprocessar=None).\
+                    update(reprocessar=None)
+            resultado[fundo.id] = dias
+        return resultado
+
+def fundos_que_compensam(fundos):
+    """ set -> dict
+    Moeda, pelo id do fundo, dos fundos informados que compensam
+    liquidações.
+    """
+    return dict(fm.Fundo.objects.filter(id__in=fundos, \
+        compensar_liquidacoes=True).values_list('id', 'pais__moeda_id'))
+
+def compensar_liquidacoes(modelo, objetos, compensam=None):
+    """ Model, list, dict -> list
+    Compensa as provisões ou CPRs, ainda não salvos, gerados por boletas de
+    operação de fundos que compensam liquidações. Os objetos de mesma chave
+    de compensação são somados a um valor líquido sem boleta de origem,
+    ainda não processado pelo fechamento, que é criado se não existir, e
+    cada boleta de origem entra na composição do valor líquido. Retorna os
+    objetos que não são compensados e devem ser salvos normalmente. Não
+    marca o derivado nas boletas de origem. Os fundos que compensam podem
+    ser informados, para evitar a consulta.
+    """
+    if not objetos:
+        return objetos
+    if compensam == None:
+        compensam = fundos_que_compensam({objeto.fundo_id for objeto in objetos})
+    grupos = {}
+    restantes = []
+    for objeto in objetos:
+        chave = None
+        if objeto.fundo_id in compensam and objeto.content_type_id != None:
+            chave = objeto.chave_compensacao(compensam[objeto.fundo_id])
+        if chave == None:
+            restantes.append(objeto)
+        else:
+            grupos.setdefault(chave, []).append(objeto)
+    if not grupos:
+        return restantes
+
+    campo = modelo.CAMPO_COMPENSADO
+    relacao = modelo._meta.get_field('composicao')
+    liquidos = {}
+    for liquido in modelo.liquidos_em_aberto().filter(fundo_id__in=compensam, \
+        data_pagamento__in={chave[-1] for chave in grupos}):
+        liquidos.setdefault(liquido.chave_compensacao(), liquido)
+
+    composicoes = []
+    with transaction.atomic():
+        for chave, grupo in grupos.items():
+            liquido = liquidos.get(chave)
+            if liquido == None:
+                liquido = grupo[0].montar_liquida(chave)
+            total = sum(getattr(objeto, campo) for objeto in grupo)
+            setattr(liquido, campo, getattr(liquido, campo) + total)
+            liquido.save()
+            for objeto in grupo:
+                composicoes.append(relacao.related_model(**{
+                    relacao.field.name: liquido,
+                    'content_type_id': objeto.content_type_id,
+                    'object_id': objeto.object_id,
+                    'valor': getattr(objeto, campo)
+                }))
+        relacao.related_model.objects.bulk_create(composicoes)
+    return restantes
+
+def desfazer_compensacoes(fundo, origens, data_referencia):
+    """ Fundo, Q, date -> None
+    Retira, dos valores líquidos do fundo com data de pagamento (provisões)
+    ou de início (CPRs) a partir da data de referência, as parcelas das
+    boletas de origem do filtro. Valores líquidos sem parcelas restantes são
+    apagados.
+    """
+    from django.db.models import Sum
+    for modelo, campo_data in ((BoletaProvisao, 'data_pagamento'), (BoletaCPR, 'data_inicio')):
+        relacao = modelo._meta.get_field('composicao')
+        nome = relacao.field.name
+        parcelas = relacao.related_model.objects.filter(origens, **{
+            nome + '__fundo': fundo, nome + '__' + campo_data + '__gte': data_referencia})
+        afetados = set(parcelas.values_list(nome + '_id', flat=True))
+        if not afetados:
+            continue
+        parcelas.delete()
+        totais = dict(relacao.related_model.objects.filter(**{nome + '_id__in': afetados}). \
+            values_list(nome + '_id').annotate(total=Sum('valor')))
+        for liquido in modelo.objects.filter(id__in=afetados):
+            if liquido.id not in totais:
+                liquido.delete()
+            else:
+                setattr(liquido, modelo.CAMPO_COMPENSADO, totais[liquido.id])
+                liquido.save(update_fields=[modelo.CAMPO_COMPENSADO])
+
+def marcar_derivado(tipo_id, objeto_id, derivado, existe, boleta=None):
+    """
+    Liga ou desliga, na boleta de origem, o bit do objeto derivado. A boleta
+    em memória, se houver, também é atualizada, para que as verificações
+    seguintes do fechamento já vejam o objeto criado.
+    """
+    if tipo_id == None or objeto_id == None:
+        return
+    modelo = ContentType.objects.get_for_id(tipo_id).model_class()
+    if modelo == None or not issubclass(modelo, PendenciaFechamento):
+        return
+    if existe:
+        valor = models.F('derivados').bitor(derivado)
+    else:
+        valor = models.F('derivados').bitand(PendenciaFechamento.DERIVADO_TODOS & ~derivado)
+    modelo.objects.filter(id=objeto_id).update(derivados=valor)
+    if isinstance(boleta, PendenciaFechamento) and boleta.id == objeto_id:
+        if existe:
+            boleta.derivados |= derivado
+        else:
+            boleta.derivados &= ~derivado
+
+def derivado_do_modelo(modelo):
+    return {
+        BoletaProvisao: PendenciaFechamento.DERIVADO_PROVISAO,
+        ComposicaoProvisao: PendenciaFechamento.DERIVADO_PROVISAO,
+        BoletaCPR: PendenciaFechamento.DERIVADO_CPR,
+        ComposicaoCPR: PendenciaFechamento.DERIVADO_CPR,
+        fm.Quantidade: PendenciaFechamento.DERIVADO_QUANTIDADE,
+        fm.Movimentacao: PendenciaFechamento.DERIVADO_MOVIMENTACAO,
+        BoletaPassivo: PendenciaFechamento.DERIVADO_PASSIVO,
+    }[modelo]
+
+@receiver(post_save, sender=BoletaProvisao)
+@receiver(post_save, sender=ComposicaoProvisao)
+@receiver(post_save, sender=BoletaCPR)
+@receiver(post_save, sender=ComposicaoCPR)
+@receiver(post_save, sender=BoletaPassivo)
+@receiver(post_save, sender=fm.Quantidade)
+@receiver(post_save, sender=fm.Movimentacao)
+def registrar_derivado(sender, instance, created, **kwargs):
+    """
+    Marca o objeto derivado criado na boleta que o originou.
+    """
+    if created:
+        boleta = sender._meta.get_field('content_object').get_cached_value(instance, None)
+        marcar_derivado(instance.content_type_id, instance.object_id, \
+            derivado_do_modelo(sender), True, boleta)
+
+@receiver(post_delete, sender=BoletaProvisao)
+@receiver(post_delete, sender=ComposicaoProvisao)
+@receiver(post_delete, sender=BoletaCPR)
+@receiver(post_delete, sender=ComposicaoCPR)
+@receiver(post_delete, sender=BoletaPassivo)
+@receiver(post_delete, sender=fm.Quantidade)
+@receiver(post_delete, sender=fm.Movimentacao)
+def remover_derivado(sender, instance, **kwargs):
+    """
+    Desmarca o objeto derivado apagado, se a boleta de origem não possuir
+    outro do mesmo tipo.
+    """
+    derivado = derivado_do_modelo(sender)
+    # Provisões e CPRs compensados contam como derivados pela composição.
+    modelos = [modelo for modelo in (BoletaProvisao, ComposicaoProvisao, BoletaCPR, \
+        ComposicaoCPR, BoletaPassivo, fm.Quantidade, fm.Movimentacao) \
+        if derivado_do_modelo(modelo) == derivado]
+    existe = any(modelo.objects.filter(content_type_id=instance.content_type_id, \
+        object_id=instance.object_id).exists() for modelo in modelos)
+    marcar_derivado(instance.content_type_id, instance.object_id, derivado, existe)
+
+@receiver(post_save, sender=mm.Preco)
+def enfileirar_cotizacao(sender, instance, **kwargs):
+    """
+    Enfileira as boletas que aguardam a cota gravada.
+    """
+    if instance.preco_fechamento != None and instance.deletado_em == None:
+        EventoCotizacao.enfileirar([(instance.ativo_id, instance.data_referencia)])
+
+@receiver(mm.precos_carregados)
+def enfileirar_cotizacoes_carregadas(sender, pares, **kwargs):
+    """
+    Enfileira as boletas que aguardam as cotas de uma carga em lote.
+    """
+    EventoCotizacao.enfileirar(pares)
+
+@receiver(m2m_changed, sender=BoletaPassivo.certificado_passivo.through)
+def registrar_certificado(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Mantém o bit de certificado das boletas de passivo ligadas ou desligadas
+    de certificados.
+    """
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if reverse:
+        boletas = list(BoletaPassivo.objects.filter(id__in=pk_set or []))
+    else:
+        boletas = [instance]
+    tipo_id = ContentType.objects.get_for_model(BoletaPassivo).id
+    for boleta in boletas:
+        existe = sender.objects.filter(boletapassivo_id=boleta.id).exists()
+        marcar_derivado(tipo_id, boleta.id, PendenciaFechamento.DERIVADO_CERTIFICADO, \
+            existe, boleta)
@@ -1,15 +1,19 @@
 import datetime
 import decimal
+from unittest import mock
+import pandas as pd
 from model_mommy import mommy
 from model_mommy.recipe import related, Recipe
 import pytest
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 from django.contrib.contenttypes.fields import GenericForeignKey, GenericRelation
 from django.contrib.contenttypes.models import ContentType
 from django.core.exceptions import ValidationError
-from django.db import models
+from django.db import connection, models
 import boletagem.models as bm
 import fundo.models as fm
+import mercado.models as mm
 import calendario.models as cm
 
 # Create your tests here.
@@ -528,6 +532,10 @@ class BoletaAcaoUnitTests(TestCase):
         # Data de movimentação do ativo casa com a data de operação
         self.assertEqual(movs.data, copia.data_operacao)
         self.assertEqual(movs.objeto_movimentacao, copia.acao)
+        # Custódia, corretora e ativo são gravados na movimentação
+        self.assertEqual(movs.custodia, copia.custodia)
+        self.assertEqual(movs.corretora, copia.corretora)
+        self.assertEqual(movs.ativo_id, copia.acao.id)
 
     def test_criar_quantidade(self):
         """
@@ -552,6 +560,10 @@ class BoletaAcaoUnitTests(TestCase):
         # Data de movimentação do ativo casa com a data de operação
         self.assertEqual(qtd.data, copia.data_operacao)
         self.assertEqual(qtd.objeto_quantidade, copia.acao)
+        # Custódia, corretora e ativo são gravados na quantidade
+        self.assertEqual(qtd.custodia, copia.custodia)
+        self.assertEqual(qtd.corretora, copia.corretora)
+        self.assertEqual(qtd.ativo_id, copia.acao.id)
 
     def test_criar_boleta_CPR(self):
         """
@@ -617,6 +629,161 @@ class BoletaAcaoUnitTests(TestCase):
         self.assertTrue(copia.relacao_quantidade.all().exists())
         self.assertTrue(copia.relacao_movimentacao.all().exists())
 
+    def test_derivados(self):
+        """
+        A máscara de objetos derivados acompanha a criação e a remoção dos
+        objetos, e o fechado() não consulta o banco.
+        """
+        copia = self.boleta
+        copia.id = None
+        copia.save()
+        self.assertEqual(copia.derivados, 0)
+        copia.fechar_boleta()
+        with self.assertNumQueries(0):
+            self.assertTrue(copia.fechado())
+        gravada = bm.BoletaAcao.objects.get(id=copia.id)
+        self.assertTrue(gravada.fechado())
+        copia.relacao_quantidade.all().delete()
+        gravada.refresh_from_db()
+        self.assertFalse(gravada.fechado())
+        self.assertTrue(gravada.possui(gravada.DERIVADO_PROVISAO, gravada.DERIVADO_CPR,
+            gravada.DERIVADO_MOVIMENTACAO))
+
+    def test_fechar_em_lote(self):
+        """
+        O fechamento em lote gera os mesmos objetos do fechamento boleta a
+        boleta, com um número de consultas que não depende da quantidade de
+        boletas.
+        """
+        self.boleta.fechar_boleta()
+        esperado = (self.boleta.boleta_provisao.get().financeiro,
+            self.boleta.boleta_CPR.get().valor_cheio,
+            self.boleta.relacao_quantidade.get().qtd,
+            self.boleta.relacao_movimentacao.get().valor)
+        for i in range(10):
+            copia = bm.BoletaAcao.objects.get(id=self.boleta.id)
+            copia.id = None
+            copia.save()
+        data = self.boleta.data_operacao
+        novas = bm.BoletaAcao.objects.exclude(id=self.boleta.id)
+        # Busca das boletas e dos fundos que compensam liquidações, um insert
+        # por modelo derivado, as atualizações da máscara e da pendência, a
+        # invalidação das posições e o savepoint.
+        with self.assertNumQueries(11):
+            bm.BoletaAcao.fechar_em_lote(bm.BoletaAcao.objects.all(), data)
+        for boleta in novas:
+            self.assertTrue(boleta.fechado())
+            self.assertTrue(boleta.fechada)
+            self.assertEqual((boleta.boleta_provisao.get().financeiro,
+                boleta.boleta_CPR.get().valor_cheio,
+                boleta.relacao_quantidade.get().qtd,
+                boleta.relacao_movimentacao.get().valor), esperado)
+        self.assertEqual(fm.Quantidade.objects.count(), 11)
+
+    def test_cpr_do_lote_pendente_na_data_de_inicio(self):
+        """
+        O bulk_create não passa pelo save: o CPR criado no fechamento em lote
+        precisa sair com a pendência calculada para ser fechado depois.
+        """
+        bm.BoletaAcao.fechar_em_lote(bm.BoletaAcao.objects.all(), self.boleta.data_operacao)
+        cpr = bm.BoletaCPR.objects.get()
+        self.assertFalse(cpr.fechada)
+        self.assertEqual(cpr.proxima_acao, cpr.data_inicio)
+        self.assertEqual(list(self.boleta.fundo.boletas_pendentes(bm.BoletaCPR,
+            cpr.data_inicio)), [cpr])
+
+    def test_montar_derivados_padrao(self):
+        cambio = mommy.make('boletagem.BoletaCambio')
+        self.assertEqual(cambio.montar_derivados(), [])
+
+class CompensacaoLiquidacoesTests(TestCase):
+    """
+    Testes da compensação de provisões e CPRs por caixa e data de
+    liquidação.
+    """
+    def setUp(self):
+        self.fundo = mommy.make('fundo.Fundo', compensar_liquidacoes=True)
+        self.caixa = mommy.make('ativos.Caixa')
+        self.outro_caixa = mommy.make('ativos.Caixa')
+        self.custodia = mommy.make('fundo.Custodiante')
+        self.corretora = mommy.make('fundo.Corretora')
+        self.acao = mommy.make('ativos.Acao', nome='PETR4', moeda=self.fundo.pais.moeda)
+        self.data = datetime.date(year=2018, month=10, day=2)
+        self.liquidacao = datetime.date(year=2018, month=10, day=5)
+        self.boletas = [self.boleta('C', 100, self.caixa),
+            self.boleta('V', 40, self.caixa),
+            self.boleta('C', 10, self.outro_caixa)]
+
+    def boleta(self, operacao, quantidade, caixa):
+        return mommy.make('boletagem.BoletaAcao',
+            acao=self.acao,
+            fundo=self.fundo,
+            caixa_alvo=caixa,
+            custodia=self.custodia,
+            corretora=self.corretora,
+            data_operacao=self.data,
+            data_liquidacao=self.liquidacao,
+            operacao=operacao,
+            quantidade=quantidade,
+            preco=decimal.Decimal('10'),
+            corretagem=decimal.Decimal('0')
+        )
+
+    def verificar_compensacao(self):
+        provisoes = bm.BoletaProvisao.objects.filter(fundo=self.fundo)
+        self.assertEqual(provisoes.count(), 2)
+        self.assertFalse(provisoes.exclude(content_type=None).exists())
+        self.assertEqual(provisoes.get(caixa_alvo=self.caixa).financeiro,
+            decimal.Decimal('-600.00'))
+        self.assertEqual(provisoes.get(caixa_alvo=self.outro_caixa).financeiro,
+            decimal.Decimal('-100.00'))
+        cpr = bm.BoletaCPR.objects.get(fundo=self.fundo)
+        self.assertEqual(cpr.valor_cheio, decimal.Decimal('-700.00'))
+        self.assertEqual(cpr.encontrar_custodiante(), self.custodia)
+        self.assertEqual(bm.ComposicaoProvisao.objects.count(), 3)
+        self.assertEqual(bm.ComposicaoCPR.objects.count(), 3)
+        for boleta in bm.BoletaAcao.objects.all():
+            self.assertTrue(boleta.fechado())
+
+    def test_compensa_no_fechamento_em_lote(self):
+        bm.BoletaAcao.fechar_em_lote(bm.BoletaAcao.objects.all(), self.data)
+        self.verificar_compensacao()
+
+    def test_compensa_boleta_a_boleta(self):
+        for boleta in self.boletas:
+            boleta.fechar_boleta()
+        self.verificar_compensacao()
+
+    def test_nao_compensa_cpr_em_outra_moeda(self):
+        self.acao = mommy.make('ativos.Acao', nome='AAPL')
+        estrangeira = self.boleta('C', 10, self.caixa)
+        bm.BoletaAcao.fechar_em_lote(bm.BoletaAcao.objects.all(), self.data)
+        self.assertEqual(bm.BoletaProvisao.objects.get(caixa_alvo=self.caixa).financeiro,
+            decimal.Decimal('-700.00'))
+        self.assertEqual(estrangeira.boleta_CPR.get().valor_cheio, decimal.Decimal('-100.00'))
+        self.assertEqual(bm.BoletaCPR.objects.get(content_type=None).valor_cheio,
+            decimal.Decimal('-700.00'))
+
+    def test_desfazer_compensacoes(self):
+        bm.BoletaAcao.fechar_em_lote(bm.BoletaAcao.objects.all(), self.data)
+        tipo = ContentType.objects.get_for_model(bm.BoletaAcao)
+        origens = models.Q(content_type_id=tipo.id,
+            object_id__in=[self.boletas[0].id, self.boletas[2].id])
+        bm.desfazer_compensacoes(self.fundo, origens, self.data)
+        provisao = bm.BoletaProvisao.objects.get(fundo=self.fundo)
+        self.assertEqual(provisao.financeiro, decimal.Decimal('400.00'))
+        self.assertEqual(bm.BoletaCPR.objects.get(fundo=self.fundo).valor_cheio,
+            decimal.Decimal('400.00'))
+        desfeita = bm.BoletaAcao.objects.get(id=self.boletas[0].id)
+        self.assertFalse(desfeita.possui(desfeita.DERIVADO_PROVISAO))
+        self.assertFalse(desfeita.possui(desfeita.DERIVADO_CPR))
+        mantida = bm.BoletaAcao.objects.get(id=self.boletas[1].id)
+        self.assertTrue(mantida.possui(mantida.DERIVADO_PROVISAO, mantida.DERIVADO_CPR))
+        # A boleta desfeita volta a compor o valor líquido ao ser fechada.
+        desfeita.fechar_boleta()
+        self.assertEqual(bm.BoletaProvisao.objects.get(fundo=self.fundo,
+            caixa_alvo=self.caixa).financeiro, decimal.Decimal('-600.00'))
+
 class BoletaRendaFixaLocalUnitTest(TestCase):
     """
     Classe de Unit Test de BoletaRendaFixaLocal
@@ -1312,6 +1479,35 @@ class BoletaFundoLocalUnitTest(TestCase):
         copia.fechar_boleta()
         self.assertTrue(copia.fechado())
 
+    def test_cota_gravada_depois_do_fechamento(self):
+        """
+        A boleta que aguarda a cota sai do fechamento diário e é enfileirada
+        quando a cota é gravada. A quantidade é criada na data de cotização,
+        já fechada, que é marcada para reprocessamento.
+        """
+        copia = self.boleta_sem_cota_sem_preco
+        copia.id = None
+        copia.save()
+        copia.fechar_boleta()
+        copia.registrar_fechamento(copia.data_cotizacao)
+        self.assertTrue(copia.fechada)
+        mommy.make('fundo.Carteira', fundo=copia.fundo, data=copia.data_liquidacao)
+        mommy.make('mercado.Preco',
+            ativo=copia.ativo,
+            preco_fechamento=1300,
+            data_referencia=copia.data_cotizacao
+        )
+        evento = bm.EventoCotizacao.objects.get(processado_em=None)
+        self.assertEqual(evento.boleta, copia)
+        self.assertEqual(bm.EventoCotizacao.processar(),
+            {copia.fundo_id: copia.data_cotizacao})
+        copia.refresh_from_db()
+        self.assertTrue(copia.fechado())
+        self.assertEqual(copia.relacao_quantidade.get().data, copia.data_cotizacao)
+        evento.refresh_from_db()
+        self.assertIsNotNone(evento.processado_em)
+        self.assertEqual(evento.reprocessar, copia.data_cotizacao)
+
     def test_cria_boleta_passivo(self):
         """
         Testa se, ao fechar a boleta com todas as informações necessárias,
@@ -2219,6 +2415,148 @@ class BoletaFundoOffshoreUnitTest(TestCase):
         cpr_cota = bm.BoletaCPR.objects.get(content_type__pk=tipo.id, object_id=boleta.id, valor_cheio=boleta.financeiro)
         self.assertEqual(cpr_cota.data_pagamento, None)
 
+    def test_fechar_em_lote_consultas_nao_dependem_do_numero_de_boletas(self):
+        """
+        O fechamento em lote carrega os preços e os CPRs das boletas de uma só
+        vez e grava os derivados e os estados em lote.
+        """
+        modelo = self.boleta_ativo_qualquer
+        mommy.make('mercado.Preco',
+            ativo=modelo.ativo,
+            data_referencia=modelo.data_cotizacao,
+            preco_fechamento=decimal.Decimal('1300').quantize(decimal.Decimal('1.000000'))
+        )
+        consultas = []
+        for total in (1, 5):
+            fundo = mommy.make('fundo.Fundo')
+            for _ in range(total):
+                modelo.id = None
+                modelo.fundo = fundo
+                modelo.preco = None
+                modelo.quantidade = None
+                modelo.save()
+            pendentes = bm.BoletaFundoOffshore.objects.filter(fundo=fundo)
+            with CaptureQueriesContext(connection) as contexto:
+                bm.BoletaFundoOffshore.fechar_em_lote(pendentes, modelo.data_cotizacao)
+            consultas.append(len(contexto.captured_queries))
+            # Transição 2: cotizada, pendente de liquidação.
+            for boleta in pendentes:
+                self.assertEqual(boleta.estado, bm.BoletaFundoOffshore.ESTADO[1][0])
+                self.assertEqual(boleta.preco, decimal.Decimal('1300'))
+                self.assertEqual(boleta.proxima_acao, boleta.data_liquidacao)
+                self.assertTrue(boleta.possui(boleta.DERIVADO_CPR, \
+                    boleta.DERIVADO_PROVISAO, boleta.DERIVADO_QUANTIDADE))
+            self.assertEqual(fm.Quantidade.objects.filter(fundo=fundo).count(), total)
+            cpr = bm.BoletaCPR.objects.filter(fundo=fundo).first()
+            self.assertEqual(cpr.proxima_acao, cpr.data_inicio)
+        self.assertEqual(consultas[0], consultas[1])
+
+    def test_cota_gravada_enfileira_boletas_aguardando(self):
+        """
+        A boleta pendente de informação de cotização não é procurada pelo
+        fechamento: a gravação da cota a enfileira, e a fila a conclui na
+        primeira data ainda não fechada do fundo.
+        """
+        boleta = self.boleta_estado_pendente_de_informacao_de_cota()
+        self.assertTrue(boleta.fechada)
+        self.assertIsNone(boleta.proxima_acao)
+        # Cota de outra data não enfileira a boleta.
+        mommy.make('mercado.Preco',
+            ativo=boleta.ativo,
+            data_referencia=boleta.data_cotizacao - datetime.timedelta(days=1),
+            preco_fechamento=decimal.Decimal('1200')
+        )
+        self.assertFalse(bm.EventoCotizacao.objects.exists())
+        preco = mommy.make('mercado.Preco',
+            ativo=boleta.ativo,
+            data_referencia=boleta.data_cotizacao,
+            preco_fechamento=decimal.Decimal('1300')
+        )
+        preco.save()
+        self.assertEqual(bm.EventoCotizacao.objects.filter(processado_em=None).count(), 1)
+
+        self.assertEqual(bm.EventoCotizacao.processar(), {boleta.fundo_id: None})
+        boleta.refresh_from_db()
+        self.assertEqual(boleta.estado, boleta.ESTADO[5][0])
+        self.assertEqual(boleta.preco, decimal.Decimal('1300'))
+        data = boleta.data_cotizacao + datetime.timedelta(days=1)
+        self.assertEqual(boleta.relacao_quantidade.get().data, data)
+        cpr = boleta.boleta_CPR.get(descricao__startswith="Cotização de ")
+        self.assertEqual(cpr.data_pagamento, data)
+        self.assertFalse(bm.EventoCotizacao.objects.filter(processado_em=None).exists())
+
+    def test_carga_de_precos_enfileira_boletas_aguardando(self):
+        boleta = self.boleta_estado_pendente_de_informacao_de_cota()
+        carregador = mm.CarregadorPrecos()
+        carregador.carregar_dataframe(pd.DataFrame({
+            'ativo': [boleta.ativo.nome],
+            'data': [boleta.data_cotizacao.isoformat()],
+            'preco_fechamento': ['1300'],
+        }))
+        evento = bm.EventoCotizacao.objects.get()
+        self.assertEqual(evento.boleta, boleta)
+        self.assertEqual(evento.fundo, boleta.fundo)
+
+    def test_preco_de_outro_ativo_nao_busca_boletas(self):
+        """
+        Preços de ativos que não são fundos não podem ser cotas: a fila só
+        confere o tipo do ativo, sem consultar as boletas.
+        """
+        self.boleta_estado_pendente_de_informacao_de_cota()
+        acao = mommy.make('ativos.Acao')
+        data = datetime.date(year=2018, month=10, day=15)
+        with self.assertNumQueries(1):
+            self.assertEqual(bm.EventoCotizacao.enfileirar([(acao.id, data)]), 0)
+        with CaptureQueriesContext(connection) as contexto:
+            mommy.make('mercado.Preco', ativo=acao, data_referencia=data,
+                preco_fechamento=decimal.Decimal('10'))
+        self.assertFalse(any('boletagem_boleta' in consulta['sql']
+            for consulta in contexto.captured_queries))
+        self.assertFalse(bm.EventoCotizacao.objects.exists())
+
+    def test_cota_gravada_durante_o_fechamento(self):
+        """
+        A cota gravada depois da carga de preços do fechamento em lote, mas
+        antes de a boleta ser gravada como aguardando a cota, não encontra a
+        boleta no sinal do Preco. O próprio fechamento a enfileira.
+        """
+        boleta = self.boleta_estado_pendente_de_cotizacao()
+        precos_nas_datas = mm.Preco.precos_nas_datas
+
+        def carregar_e_gravar_cota(pares, *args, **kwargs):
+            carregados = precos_nas_datas(pares, *args, **kwargs)
+            if not mm.Preco.objects.filter(ativo=boleta.ativo).exists():
+                mommy.make('mercado.Preco', ativo=boleta.ativo,
+                    data_referencia=boleta.data_cotizacao,
+                    preco_fechamento=decimal.Decimal('1300'))
+                self.assertFalse(bm.EventoCotizacao.objects.exists())
+            return carregados
+
+        with mock.patch.object(mm.Preco, 'precos_nas_datas',
+            side_effect=carregar_e_gravar_cota):
+            boleta.fechar_boleta(boleta.data_cotizacao)
+        boleta.refresh_from_db()
+        self.assertEqual(boleta.estado, boleta.ESTADO[2][0])
+        self.assertTrue(boleta.fechada)
+        evento = bm.EventoCotizacao.objects.get(processado_em=None)
+        self.assertEqual(evento.boleta, boleta)
+
+    def test_processar_fundo_sendo_fechado(self):
+        """
+        Os eventos de um fundo sendo fechado por outro processo ficam na fila.
+        """
+        boleta = self.boleta_estado_pendente_de_informacao_de_cota()
+        mommy.make('mercado.Preco', ativo=boleta.ativo,
+            data_referencia=boleta.data_cotizacao,
+            preco_fechamento=decimal.Decimal('1300'))
+        with mock.patch.object(fm.Fundo, 'travar_fechamento', return_value=False) as trava:
+            self.assertEqual(bm.EventoCotizacao.processar(), {})
+        trava.assert_called_with(boleta.data_cotizacao + datetime.timedelta(days=1))
+        boleta.refresh_from_db()
+        self.assertEqual(boleta.estado, boleta.ESTADO[2][0])
+        self.assertTrue(bm.EventoCotizacao.objects.filter(processado_em=None).exists())
+        self.assertEqual(bm.EventoCotizacao.processar(), {boleta.fundo_id: None})
+
     def boleta_estado_pendente_de_cotizacao(self):
         """
         Método auxiliar para colocar uma boleta no estado "Pendente de cotização."
@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import Feriado, Estado, Cidade, Calendario
+from .models import Feriado, Estado, Cidade, Calendario, RegraFeriado
 from import_export import resources, fields
 from import_export.admin import ImportExportModelAdmin
 from import_export.widgets import ForeignKeyWidget
@@ -96,3 +96,7 @@ class CalendarioResource(resources.ModelResource):
 class CalendarioAdmin(ImportExportModelAdmin):
     resource_class = CalendarioResource
     list_display = ('id', 'nome', 'pais', 'estado', 'cidade')
+
+@admin.register(RegraFeriado)
+class RegraFeriadoAdmin(ImportExportModelAdmin):
+    list_display = ('nome', 'tipo', 'pais', 'estado', 'cidade', 'mes', 'dia', 'dias_pascoa')
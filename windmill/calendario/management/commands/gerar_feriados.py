@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = 'Gera os feriados das regras cadastradas e os vincula aos calendários.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('ano_inicio', type=int)
+        parser.add_argument('ano_fim', type=int)
+
+    def handle(self, *args, **options):
+        import calendario.models as cm
+        criados = cm.RegraFeriado.gerar_feriados(options['ano_inicio'], options['ano_fim'])
+        self.stdout.write('%d feriados criados.' % criados)
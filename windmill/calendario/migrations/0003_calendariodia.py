@@ -0,0 +1,32 @@
+# Generated by Django 2.0 on 2019-02-11 10:12
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('calendario', '0002_calendario_nome'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CalendarioDia',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('data', models.DateField()),
+                ('ordinal', models.IntegerField()),
+                ('dia_util', models.BooleanField()),
+                ('dia_util_anterior', models.DateField()),
+                ('proximo_dia_util', models.DateField()),
+                ('fim_mes', models.BooleanField()),
+                ('fim_mes_util', models.BooleanField()),
+                ('calendario', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='dias', to='calendario.Calendario')),
+            ],
+            options={
+                'unique_together': {('calendario', 'data')},
+                'index_together': {('calendario', 'ordinal')},
+            },
+        ),
+    ]
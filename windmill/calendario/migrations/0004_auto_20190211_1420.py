@@ -0,0 +1,23 @@
+# Generated by Django 2.0 on 2019-02-11 14:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('calendario', '0003_calendariodia'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='calendario',
+            name='composicao',
+            field=models.ManyToManyField(blank=True, related_name='compostos', to='calendario.Calendario'),
+        ),
+        migrations.AddField(
+            model_name='calendario',
+            name='tipo_composicao',
+            field=models.CharField(choices=[('U', 'União'), ('I', 'Interseção')], default='U', max_length=1, verbose_name='Tipo de composição'),
+        ),
+    ]
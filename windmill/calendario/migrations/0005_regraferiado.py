@@ -0,0 +1,31 @@
+# Generated by Django 2.0 on 2019-02-12 09:47
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ativos', '0029_auto_20190207_1011'),
+        ('calendario', '0004_auto_20190211_1420'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RegraFeriado',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('nome', models.CharField(max_length=50)),
+                ('tipo', models.CharField(choices=[('Fixo', 'Fixo'), ('Páscoa', 'Relativo à Páscoa')], default='Fixo', max_length=10)),
+                ('mes', models.PositiveSmallIntegerField(blank=True, null=True)),
+                ('dia', models.PositiveSmallIntegerField(blank=True, null=True)),
+                ('dias_pascoa', models.SmallIntegerField(blank=True, null=True)),
+                ('ano_inicio', models.PositiveSmallIntegerField(blank=True, null=True)),
+                ('ano_fim', models.PositiveSmallIntegerField(blank=True, null=True)),
+                ('cidade', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, to='calendario.Cidade')),
+                ('estado', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, to='calendario.Estado')),
+                ('pais', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to='ativos.Pais')),
+            ],
+        ),
+    ]
@@ -1,12 +1,119 @@
 import datetime
+from functools import reduce
 from dateutil.relativedelta import relativedelta
+from dateutil.easter import easter
 from datetime import timedelta
 import numpy as np
 import pandas as pd
-from django.db import models
+from django.core.exceptions import ValidationError
+from django.db import models, transaction
+from django.db.models.signals import post_save, post_delete, pre_save, pre_delete, m2m_changed
+from django.dispatch import receiver
 
 # Create your models here.
 
+def para_datetime64(datas):
+    """
+    array-like Datetime -> np.ndarray datetime64[D]
+    Converte datas (date, datetime, strings, arrays do NumPy ou Series e
+    índices do pandas) para um vetor datetime64 com resolução de dia.
+    """
+    if isinstance(datas, np.ndarray) and np.issubdtype(datas.dtype, np.datetime64):
+        return datas.astype('datetime64[D]')
+    datas = pd.to_datetime(pd.Series(np.atleast_1d(np.asarray(datas, dtype=object))))
+    return datas.values.astype('datetime64[D]')
+
+# Índices de dias úteis já construídos, por id de calendário. O cache é local
+# ao processo: cada worker constrói o seu na primeira consulta e o descarta
+# quando os feriados do calendário mudam (ver receivers no fim do módulo).
+_cache_dias_uteis = {}
+# Calendários compostos cujo índice foi construído a partir de cada
+# calendário, para que a invalidação de um componente chegue até eles.
+_calendarios_compostos = {}
+
+class IndiceDiasUteis(object):
+    """
+    Representação em memória dos dias úteis de um calendário. Guarda o
+    numpy.busdaycalendar com os feriados do calendário e um vetor ordenado
+    com os ordinais (dias desde 1970-01-01) de todos os dias úteis, para que
+    deslocamentos e contagens de dias úteis não precisem consultar o banco
+    de dados.
+    """
+    # Segunda a sexta-feira são dias de trabalho.
+    DIAS_SEMANA = '1111100'
+    # Intervalo padrão, em anos, coberto pelas tabelas de dias úteis e de
+    # meses. Pode ser alterado com CALENDARIO_HORIZONTE nas configurações.
+    HORIZONTE = (1990, 2100)
+
+    def __init__(self, feriados):
+        from django.conf import settings
+        ano_inicio, ano_fim = getattr(settings, 'CALENDARIO_HORIZONTE', self.HORIZONTE)
+        self.feriados = np.unique(np.array(list(feriados), dtype='datetime64[D]'))
+        self.busdaycal = np.busdaycalendar(weekmask=self.DIAS_SEMANA,
+            holidays=self.feriados)
+        dias = np.arange(np.datetime64(str(ano_inicio) + '-01-01'),
+            np.datetime64(str(ano_fim + 1) + '-01-01'), dtype='datetime64[D]')
+        dias = dias[np.is_busday(dias, busdaycal=self.busdaycal)]
+        self.ordinais = dias.astype(np.int64)
+        # Tabela de meses: para cada mês do horizonte, o último dia útil e a
+        # quantidade de dias úteis.
+        self.meses = np.arange(np.datetime64(str(ano_inicio) + '-01'),
+            np.datetime64(str(ano_fim + 1) + '-01'), dtype='datetime64[M]')
+        inicio_meses = self.meses.astype('datetime64[D]')
+        inicio_meses_posteriores = (self.meses + 1).astype('datetime64[D]')
+        self.fins_mes_util = self.offset(inicio_meses_posteriores, -1)
+        self.dias_uteis_por_mes = self.count(inicio_meses, inicio_meses_posteriores)
+
+    def _posicoes_meses(self, datas):
+        """
+        Retorna os meses das datas e suas posições na tabela de meses, ou
+        None para as posições se alguma data estiver fora do horizonte.
+        """
+        meses = np.asarray(datas, dtype='datetime64[D]').astype('datetime64[M]')
+        posicoes = (meses - self.meses[0]).astype(np.int64)
+        if posicoes.size and (posicoes.min() < 0 or posicoes.max() >= len(self.meses)):
+            return meses, None
+        return meses, posicoes
+
+    def offset(self, datas, dias):
+        """
+        Equivalente ao np.busday_offset com roll='forward', usando os
+        feriados do índice.
+        """
+        return np.busday_offset(datas, dias, roll='forward',
+            busdaycal=self.busdaycal)
+
+    def count(self, datas_inicio, datas_fim):
+        """
+        Equivalente ao np.busday_count, usando os feriados do índice.
+        """
+        return np.busday_count(datas_inicio, datas_fim, busdaycal=self.busdaycal)
+
+    def dia_util(self, datas):
+        """
+        Retorna True para as datas que são dias úteis.
+        """
+        return np.is_busday(datas, busdaycal=self.busdaycal)
+
+    def fim_mes_util(self, datas):
+        """
+        Retorna o último dia útil do mês de cada data.
+        """
+        meses, posicoes = self._posicoes_meses(datas)
+        if posicoes is None:
+            return self.offset((meses + 1).astype('datetime64[D]'), -1)
+        return self.fins_mes_util[posicoes]
+
+    def dias_uteis_mes(self, datas):
+        """
+        Retorna a quantidade de dias úteis do mês de cada data.
+        """
+        meses, posicoes = self._posicoes_meses(datas)
+        if posicoes is None:
+            return self.count(meses.astype('datetime64[D]'),
+                (meses + 1).astype('datetime64[D]'))
+        return self.dias_uteis_por_mes[posicoes]
+
 
 class Feriado(models.Model):
     """
@@ -23,6 +130,136 @@ class Feriado(models.Model):
     def __str__(self):
         return str(self.data)
 
+class RegraFeriado(models.Model):
+    """
+    Regra para a geração de feriados recorrentes. Feriados fixos caem
+    sempre no mesmo dia e mês. Feriados móveis são definidos pela
+    quantidade de dias em relação ao domingo de Páscoa (ex.: Carnaval são
+    -48 e -47, Sexta-feira Santa -2 e Corpus Christi +60). Assim como o
+    Feriado, a regra é federal, estadual ou municipal conforme os campos
+    de país, estado e cidade preenchidos.
+    """
+    TIPO = (
+        ('Fixo', 'Fixo'),
+        ('Páscoa', 'Relativo à Páscoa')
+    )
+
+    nome = models.CharField(max_length=50)
+    tipo = models.CharField(max_length=10, choices=TIPO, default='Fixo')
+    pais = models.ForeignKey('ativos.pais', on_delete=models.PROTECT)
+    estado = models.ForeignKey('estado', on_delete=models.PROTECT, null=True, blank=True)
+    cidade = models.ForeignKey('cidade', on_delete=models.PROTECT, null=True, blank=True)
+    # Usados por feriados fixos
+    mes = models.PositiveSmallIntegerField(null=True, blank=True)
+    dia = models.PositiveSmallIntegerField(null=True, blank=True)
+    # Usado por feriados relativos à Páscoa
+    dias_pascoa = models.SmallIntegerField(null=True, blank=True)
+    # Anos de vigência da regra, inclusive.
+    ano_inicio = models.PositiveSmallIntegerField(null=True, blank=True)
+    ano_fim = models.PositiveSmallIntegerField(null=True, blank=True)
+
+    def __str__(self):
+        return self.nome
+
+    def clean(self):
+        if self.tipo == self.TIPO[0][0] and (self.mes is None or self.dia is None):
+            raise ValidationError('Feriados fixos precisam de dia e mês.')
+        if self.tipo == self.TIPO[1][0] and self.dias_pascoa is None:
+            raise ValidationError('Feriados móveis precisam dos dias em relação à Páscoa.')
+
+    def datas(self, ano_inicio, ano_fim):
+        """
+        int, int -> list
+        Retorna as datas do feriado entre os anos informados, inclusive,
+        respeitando a vigência da regra.
+        """
+        if self.ano_inicio is not None:
+            ano_inicio = max(ano_inicio, self.ano_inicio)
+        if self.ano_fim is not None:
+            ano_fim = min(ano_fim, self.ano_fim)
+        if self.tipo == self.TIPO[1][0]:
+            deslocamento = timedelta(days=self.dias_pascoa)
+            return [easter(ano) + deslocamento for ano in range(ano_inicio, ano_fim + 1)]
+        datas = []
+        for ano in range(ano_inicio, ano_fim + 1):
+            try:
+                datas.append(datetime.date(ano, self.mes, self.dia))
+            except ValueError:
+                # 29/02 em anos não bissextos
+                pass
+        return datas
+
+    @staticmethod
+    def gerar_feriados(ano_inicio, ano_fim, regras=None):
+        """
+        int, int, QuerySet -> int
+        Gera os feriados das regras entre os anos informados e os vincula aos
+        calendários cuja hierarquia os inclui (calendários de cidade recebem
+        feriados federais, estaduais e municipais; de estado, federais e
+        estaduais; de país, apenas federais). Feriados e vínculos já
+        existentes são mantidos. Tudo é gravado com inserções em lote, que
+        não disparam sinais, então os índices de dias úteis e os dias
+        materializados dos calendários afetados são atualizados ao final.
+        Retorna a quantidade de feriados criados.
+        """
+        if regras is None:
+            regras = RegraFeriado.objects.all()
+        # Feriados identificados por (país, estado, cidade, data)
+        datas_regras = {}
+        for regra in regras:
+            for data in regra.datas(ano_inicio, ano_fim):
+                datas_regras[(regra.pais_id, regra.estado_id, regra.cidade_id, data)] = None
+        if not datas_regras:
+            return 0
+        data_inicio = datetime.date(ano_inicio, 1, 1)
+        data_fim = datetime.date(ano_fim, 12, 31)
+
+        def feriados_existentes():
+            return {tuple(linha[1:]): linha[0] for linha in
+                Feriado.objects.filter(data__gte=data_inicio, data__lte=data_fim).\
+                values_list('id', 'pais_id', 'estado_id', 'cidade_id', 'data')}
+
+        with transaction.atomic():
+            existentes = feriados_existentes()
+            novos = [Feriado(pais_id=k[0], estado_id=k[1], cidade_id=k[2], data=k[3])
+                for k in datas_regras if k not in existentes]
+            Feriado.objects.bulk_create(novos, batch_size=2000)
+            # bulk_create não retorna os ids em todos os bancos de dados.
+            if novos:
+                existentes = feriados_existentes()
+            ids = [(k, existentes[k]) for k in datas_regras]
+
+            # Vínculos com os calendários, segundo a hierarquia.
+            Vinculo = Calendario.feriados.through
+            calendarios = list(Calendario.objects.exclude(pais=None, estado=None,
+                cidade=None).select_related('cidade__estado', 'estado'))
+            vinculados = set(Vinculo.objects.filter(
+                calendario__in=calendarios, feriado__data__gte=data_inicio,
+                feriado__data__lte=data_fim).values_list('calendario_id', 'feriado_id'))
+            vinculos = []
+            alterados = {}
+            for calendario in calendarios:
+                cidade_id = calendario.cidade_id
+                estado = calendario.estado or (calendario.cidade.estado if calendario.cidade else None)
+                estado_id = estado.id if estado else None
+                pais_id = calendario.pais_id or (estado.pais_id if estado else None)
+                for (pais, estado, cidade, data), feriado_id in ids:
+                    if cidade is not None:
+                        aplica = cidade == cidade_id
+                    elif estado is not None:
+                        aplica = estado == estado_id
+                    else:
+                        aplica = pais == pais_id
+                    if aplica and (calendario.id, feriado_id) not in vinculados:
+                        vinculos.append(Vinculo(calendario_id=calendario.id, feriado_id=feriado_id))
+                        alterados[calendario] = min(data, alterados.get(calendario, data))
+            Vinculo.objects.bulk_create(vinculos, batch_size=5000)
+
+        Calendario.invalidar_cache()
+        for calendario, data in alterados.items():
+            calendario.rematerializar_dias(data)
+        return len(novos)
+
 class Cidade(models.Model):
 
     nome = models.CharField(max_length=30)
@@ -46,12 +283,27 @@ class Calendario(models.Model):
     feriados federais, estaduais e municipais, calendários de estado incluem
     feriados federais e estaduais, e calendários de país incluem feriados
     federais apenas.
+
+    Calendários também podem ser compostos por outros calendários, para
+    operações que liquidam em mais de um mercado. Na união, um dia é
+    feriado se for feriado em qualquer um dos componentes. Na interseção,
+    apenas se for feriado em todos eles. Os feriados do próprio calendário
+    composto são sempre somados aos dos componentes.
     """
+    TIPO_COMPOSICAO = (
+        ('U', 'União'),
+        ('I', 'Interseção')
+    )
+
     nome = models.CharField(max_length=30, unique=True)
     feriados = models.ManyToManyField(Feriado)
     pais = models.ForeignKey('ativos.pais', on_delete=models.PROTECT, null=True, blank=True)
     estado = models.ForeignKey('estado', on_delete=models.PROTECT, null=True, blank=True)
     cidade = models.ForeignKey('cidade', on_delete=models.PROTECT, null=True, blank=True)
+    composicao = models.ManyToManyField('self', symmetrical=False, blank=True,
+        related_name='compostos')
+    tipo_composicao = models.CharField('Tipo de composição', max_length=1,
+        choices=TIPO_COMPOSICAO, default='U')
 
     def __str__(self):
         descricao = ''
@@ -59,10 +311,142 @@ class Calendario(models.Model):
             descricao = 'Calendário - Cidade: ' + self.cidade.nome
         elif self.estado != None:
             descricao = 'Calendário - Estado: ' + self.estado.nome
-        else:
+        elif self.pais != None:
             descricao = 'Calendário - País: ' + self.pais.nome
+        else:
+            descricao = 'Calendário - ' + self.nome
         return descricao
 
+    def componentes_ids(self):
+        """
+        Retorna os ids de todos os calendários dos quais este é composto,
+        direta ou indiretamente.
+        """
+        ids = set()
+        pendentes = [self.pk]
+        while pendentes:
+            novos = set(Calendario.composicao.through.objects.filter(
+                from_calendario_id__in=pendentes).values_list('to_calendario_id', flat=True))
+            pendentes = list(novos - ids)
+            ids |= novos
+        return ids
+
+    def indice_dias_uteis(self):
+        """
+        Retorna o IndiceDiasUteis do calendário. O índice é construído na
+        primeira chamada, com uma única consulta aos feriados, e reutilizado
+        até que os feriados do calendário sejam alterados.
+        """
+        indice = _cache_dias_uteis.get(self.pk)
+        if indice is None:
+            feriados = np.array(list(self.feriados.values_list('data', flat=True)),
+                dtype='datetime64[D]')
+            componentes = list(self.composicao.all()) if self.pk is not None else []
+            if componentes:
+                # Os feriados dos componentes vêm dos seus próprios índices,
+                # que também ficam em cache.
+                conjuntos = [c.indice_dias_uteis().feriados for c in componentes]
+                if self.tipo_composicao == self.TIPO_COMPOSICAO[0][0]:
+                    feriados = np.union1d(feriados, reduce(np.union1d, conjuntos))
+                else:
+                    feriados = np.union1d(feriados, reduce(np.intersect1d, conjuntos))
+                for componente in componentes:
+                    _calendarios_compostos.setdefault(componente.pk, set()).add(self.pk)
+            indice = IndiceDiasUteis(feriados)
+            if self.pk is not None:
+                _cache_dias_uteis[self.pk] = indice
+        return indice
+
+    @staticmethod
+    def invalidar_cache(calendario_id=None):
+        """
+        Descarta o índice de dias úteis do calendário informado e dos
+        calendários compostos por ele. Sem calendário, descarta os índices de
+        todos os calendários.
+        """
+        if calendario_id is None:
+            _cache_dias_uteis.clear()
+            _calendarios_compostos.clear()
+            return
+        pendentes = [calendario_id]
+        while pendentes:
+            calendario_id = pendentes.pop()
+            _cache_dias_uteis.pop(calendario_id, None)
+            pendentes.extend(_calendarios_compostos.pop(calendario_id, ()))
+
+    def materializar_dias(self, data_inicio=None, data_fim=None):
+        """
+        Datetime, Datetime -> int
+        Gera as linhas de CalendarioDia do calendário entre as datas de
+        início e fim, inclusive, substituindo as existentes no intervalo.
+        Sem datas, usa o horizonte do índice de dias úteis. Retorna a
+        quantidade de dias gerados.
+        """
+        indice = self.indice_dias_uteis()
+        if data_inicio is None:
+            data_inicio = indice.meses[0].astype('datetime64[D]')
+        if data_fim is None:
+            data_fim = (indice.meses[-1] + 1).astype('datetime64[D]') - 1
+        dias = np.arange(np.datetime64(data_inicio, 'D'),
+            np.datetime64(data_fim, 'D') + 1, dtype='datetime64[D]')
+        if not dias.size:
+            return 0
+        # Quantidade de dias úteis desde 01/01/1970 até a data, exclusive.
+        ordinais = indice.count(np.datetime64('1970-01-01'), dias)
+        dia_util = indice.dia_util(dias)
+        # Rolando para frente antes de voltar um dia útil, dias não úteis
+        # também resultam no último dia útil antes deles (e vice-versa).
+        anteriores = np.busday_offset(dias, -1, roll='forward', busdaycal=indice.busdaycal)
+        proximos = np.busday_offset(dias, 1, roll='backward', busdaycal=indice.busdaycal)
+        fim_mes = (dias + 1).astype('datetime64[M]') != dias.astype('datetime64[M]')
+        fim_mes_util = indice.fim_mes_util(dias) == dias
+
+        linhas = [CalendarioDia(calendario=self,
+                data=dia,
+                ordinal=ordinal,
+                dia_util=util,
+                dia_util_anterior=anterior,
+                proximo_dia_util=proximo,
+                fim_mes=fim,
+                fim_mes_util=fim_util)
+            for dia, ordinal, util, anterior, proximo, fim, fim_util in zip(
+                dias.astype(datetime.date), ordinais.tolist(), dia_util.tolist(),
+                anteriores.astype(datetime.date), proximos.astype(datetime.date),
+                fim_mes.tolist(), fim_mes_util.tolist())]
+        with transaction.atomic():
+            CalendarioDia.objects.filter(calendario=self,
+                data__gte=linhas[0].data, data__lte=linhas[-1].data).delete()
+            CalendarioDia.objects.bulk_create(linhas, batch_size=2000)
+        return len(linhas)
+
+    def rematerializar_dias(self, data_alterada=None):
+        """
+        Datetime -> int
+        Regenera as linhas de CalendarioDia já materializadas a partir do dia
+        útil anterior à data alterada. Os ordinais de todas as datas
+        posteriores mudam quando um feriado entra ou sai do calendário, por
+        isso o intervalo vai até a última data materializada. Calendários
+        nunca materializados são ignorados. Os calendários compostos por este
+        também são regenerados, recursivamente. Retorna a quantidade de linhas
+        geradas para este calendário.
+        """
+        intervalo = CalendarioDia.objects.filter(calendario=self).\
+            aggregate(inicio=models.Min('data'), fim=models.Max('data'))
+        geradas = 0
+        Calendario.invalidar_cache(self.pk)
+        if intervalo['fim'] is not None:
+            data_inicio = intervalo['inicio']
+            if data_alterada is not None:
+                # O dia útil anterior e os dias não úteis que o sucedem têm o
+                # próximo dia útil afetado pela alteração.
+                anterior = self.dia_trabalho(data_alterada, -1)
+                data_inicio = max(data_inicio, min(anterior, data_alterada))
+            geradas = self.materializar_dias(data_inicio, intervalo['fim'])
+        # A composição não tem ciclos, então a recursão termina.
+        for composto in self.compostos.all():
+            composto.rematerializar_dias(data_alterada)
+        return geradas
+
     def dia_trabalho_total(self, data_inicio, data_fim):
         """
         array-like Datetime, array-like Datetime -> array-like int
@@ -72,9 +456,7 @@ class Calendario(models.Model):
         # Data_fim + 1 dia para que a contagem de dias úteis fique igual à do
         # excel
         data_final = data_fim + datetime.timedelta(days=1)
-        feriados = list(self.feriados.filter(data__gte=data_inicio,
-            data__lte=data_final).values_list('data', flat=True))
-        return np.busday_count(data_inicio, data_final, holidays=feriados)
+        return self.indice_dias_uteis().count(data_inicio, data_final)
 
     def dia_trabalho(self, data_referencia, dias):
         """
@@ -82,11 +464,34 @@ class Calendario(models.Model):
         Retorna a data antes ou depois da data de referência, especificada pela
         variável 'dias'.
         """
-        feriados = list(self.feriados.filter(data__gte=data_referencia)
-            .values_list('data', flat=True))
+        return self.indice_dias_uteis().offset(data_referencia, dias).\
+            astype(datetime.datetime)
 
-        return np.busday_offset(data_referencia, dias, roll='forward',
-            holidays=feriados).astype(datetime.datetime)
+    def dia_util(self, data_referencia):
+        """
+        Datetime -> Boolean
+        Indica se a data de referência é um dia útil no calendário.
+        """
+        return bool(self.indice_dias_uteis().dia_util(data_referencia))
+
+    def dia_trabalho_total_lote(self, datas_inicio, datas_fim):
+        """
+        array-like Datetime, array-like Datetime -> np.ndarray int
+        Versão vetorizada de dia_trabalho_total: conta os dias úteis entre
+        cada par de datas de início, inclusive, e de fim, inclusive.
+        """
+        datas_final = para_datetime64(datas_fim) + np.timedelta64(1, 'D')
+        return self.indice_dias_uteis().count(para_datetime64(datas_inicio),
+            datas_final)
+
+    def dia_trabalho_lote(self, datas_referencia, dias):
+        """
+        array-like Datetime, array-like int -> np.ndarray datetime64[D]
+        Versão vetorizada de dia_trabalho. Datas e deslocamentos são
+        combinados seguindo as regras de broadcasting do NumPy.
+        """
+        return self.indice_dias_uteis().offset(para_datetime64(datas_referencia),
+            np.asarray(dias))
 
     def dias_corridos_total(self, data_inicio, data_fim):
         """
@@ -107,13 +512,8 @@ class Calendario(models.Model):
         """
         Retorna o último dia útil do mês da data de referência
         """
-        # Para somar um mês à data de referência
-        mes = relativedelta(months=+1)
-        # Para mudar o dia para o dia 1 do mês posterior
-        dia = relativedelta(day=1)
-        primeiro_dia_mes_posterior = data_referencia + mes + dia
-        # Anda um dia útil para trás para encontrar o último dia útil do mês
-        return self.dia_trabalho(primeiro_dia_mes_posterior, -1)
+        return self.indice_dias_uteis().fim_mes_util(data_referencia).\
+            astype(datetime.datetime)
 
 
     def fim_mes(self, data_referencia):
@@ -131,19 +531,194 @@ class Calendario(models.Model):
         """
         Retorna a quantidade de fim de meses que há entre as duas datas
         """
-        count = 0
-        mes = relativedelta(months=+1)
-        fim_do_mes = self.fim_mes(data_inicio)
-        while (fim_do_mes <= data_fim):
-            count += 1
-            fim_do_mes += mes
-        return count
+        meses = (data_fim.year - data_inicio.year)*12 + data_fim.month - data_inicio.month
+        # O mês da data de fim só é contado se ela for o último dia do mês.
+        if (data_fim + timedelta(days=1)).month != data_fim.month:
+            meses += 1
+        return max(meses, 0)
 
     def dias_uteis_mes(self, data_referencia):
         """
         Retorna a quantidade de dias úteis no mês da data de referencia
         """
-        mes_ant = relativedelta(months=-1)
-        ultimo_dia_mes_passado = self.fim_mes_util(data_referencia + mes_ant)
-        ultimo_dia_mes_corrente = self.fim_mes_util(data_referencia)
-        return self.dia_trabalho_total(ultimo_dia_mes_passado, ultimo_dia_mes_corrente) - 1
+        return int(self.indice_dias_uteis().dias_uteis_mes(data_referencia))
+
+    def fim_mes_util_lote(self, datas_referencia):
+        """
+        array-like Datetime -> np.ndarray datetime64[D]
+        Versão vetorizada de fim_mes_util.
+        """
+        return self.indice_dias_uteis().fim_mes_util(para_datetime64(datas_referencia))
+
+    def dias_uteis_mes_lote(self, datas_referencia):
+        """
+        array-like Datetime -> np.ndarray int
+        Versão vetorizada de dias_uteis_mes.
+        """
+        return self.indice_dias_uteis().dias_uteis_mes(para_datetime64(datas_referencia))
+
+    def conta_fim_mes_lote(self, datas_inicio, datas_fim):
+        """
+        array-like Datetime, array-like Datetime -> np.ndarray int
+        Versão vetorizada de conta_fim_mes: conta os fins de mês entre o fim
+        do mês da data de início e a data de fim, inclusive.
+        """
+        datas_fim = para_datetime64(datas_fim)
+        meses_inicio = para_datetime64(datas_inicio).astype('datetime64[M]')
+        meses_fim = datas_fim.astype('datetime64[M]')
+        # O mês da data de fim só é contado se ela for o último dia do mês.
+        fim_do_mes = (datas_fim + 1).astype('datetime64[M]') != meses_fim
+        contagem = (meses_fim - meses_inicio).astype(np.int64) + fim_do_mes
+        return np.maximum(contagem, 0)
+
+class CalendarioDia(models.Model):
+    """
+    Tabela materializada dos dias de um calendário, para que consultas
+    possam resolver dias úteis diretamente no banco de dados, com joins,
+    sem passar cada linha pelos métodos do Calendario. É gerada por
+    Calendario.materializar_dias e atualizada automaticamente quando os
+    feriados do calendário mudam.
+    """
+    calendario = models.ForeignKey('Calendario', on_delete=models.CASCADE,
+        related_name='dias')
+    data = models.DateField()
+    # Quantidade de dias úteis desde 01/01/1970 até a data, exclusive. O dia
+    # útil anterior a um dia útil tem o ordinal imediatamente menor.
+    ordinal = models.IntegerField()
+    dia_util = models.BooleanField()
+    dia_util_anterior = models.DateField()
+    proximo_dia_util = models.DateField()
+    fim_mes = models.BooleanField()
+    fim_mes_util = models.BooleanField()
+
+    class Meta:
+        unique_together = (('calendario', 'data'),)
+        index_together = (('calendario', 'ordinal'),)
+
+    def __str__(self):
+        return str(self.calendario) + ' - ' + str(self.data)
+
+    @staticmethod
+    def anotar(queryset, calendario, campo_data, campos=('dia_util_anterior',)):
+        """
+        QuerySet, Calendario, str, tuple -> QuerySet
+        Anota o queryset com os campos do CalendarioDia correspondente à
+        data em campo_data, com subconsultas, de modo que a consulta inteira
+        é resolvida em uma única instrução SQL. Ex.:
+            CalendarioDia.anotar(Preco.objects.all(), cal, 'data_referencia')
+        """
+        dias = CalendarioDia.objects.filter(calendario=calendario,
+            data=models.OuterRef(campo_data))
+        return queryset.annotate(**{campo: models.Subquery(dias.values(campo)[:1])
+            for campo in campos})
+
+"""
+Invalidação do cache de dias úteis
+"""
+
+@receiver(post_save, sender=Feriado)
+@receiver(post_delete, sender=Feriado)
+def invalidar_cache_feriado(sender, instance, **kwargs):
+    """
+    Um feriado pode pertencer a vários calendários, então todos os índices
+    são descartados.
+    """
+    Calendario.invalidar_cache()
+
+@receiver(post_save, sender=Calendario)
+@receiver(post_delete, sender=Calendario)
+def invalidar_cache_calendario(sender, instance, **kwargs):
+    Calendario.invalidar_cache(instance.pk)
+
+@receiver(m2m_changed, sender=Calendario.feriados.through)
+def invalidar_cache_feriados_calendario(sender, instance, action, reverse, **kwargs):
+    """
+    Descarta o índice quando feriados são adicionados ou removidos de um
+    calendário. Se a alteração partir do feriado, todos os índices são
+    descartados.
+    """
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        if reverse:
+            Calendario.invalidar_cache()
+        else:
+            Calendario.invalidar_cache(instance.pk)
+
+"""
+Regeneração incremental do CalendarioDia
+"""
+
+@receiver(pre_save, sender=Feriado)
+def guardar_data_anterior_feriado(sender, instance, **kwargs):
+    instance._data_anterior = None
+    if instance.pk is not None:
+        instance._data_anterior = Feriado.objects.filter(pk=instance.pk).\
+            values_list('data', flat=True).first()
+
+@receiver(post_save, sender=Feriado)
+def rematerializar_feriado_alterado(sender, instance, created, **kwargs):
+    if created:
+        return
+    data = instance.data
+    if getattr(instance, '_data_anterior', None) is not None:
+        data = min(data, instance._data_anterior)
+    for calendario in instance.calendario_set.all():
+        calendario.rematerializar_dias(data)
+
+@receiver(pre_delete, sender=Feriado)
+def guardar_calendarios_feriado(sender, instance, **kwargs):
+    # Os vínculos com os calendários são apagados junto com o feriado.
+    instance._calendarios = list(instance.calendario_set.all())
+
+@receiver(post_delete, sender=Feriado)
+def rematerializar_feriado_apagado(sender, instance, **kwargs):
+    for calendario in getattr(instance, '_calendarios', []):
+        calendario.rematerializar_dias(instance.data)
+
+@receiver(m2m_changed, sender=Calendario.feriados.through)
+def rematerializar_feriados_calendario(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if reverse:
+        # instance é o feriado, pk_set são os calendários.
+        calendarios = Calendario.objects.all()
+        if pk_set is not None:
+            calendarios = calendarios.filter(pk__in=pk_set)
+        for calendario in calendarios:
+            calendario.rematerializar_dias(instance.data)
+    elif pk_set:
+        data = Feriado.objects.filter(pk__in=pk_set).aggregate(
+            data=models.Min('data'))['data']
+        instance.rematerializar_dias(data)
+    else:
+        instance.rematerializar_dias()
+
+"""
+Calendários compostos
+"""
+
+@receiver(m2m_changed, sender=Calendario.composicao.through)
+def alterar_composicao_calendario(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Impede ciclos na composição e atualiza os índices e dias materializados
+    dos calendários compostos alterados.
+    """
+    if action == 'pre_add':
+        if reverse:
+            compostos, componentes = pk_set, [instance.pk]
+        else:
+            compostos, componentes = [instance.pk], pk_set
+        for composto in compostos:
+            for componente in componentes:
+                calendario = Calendario.objects.get(pk=componente)
+                if composto == componente or composto in calendario.componentes_ids():
+                    raise ValidationError('Composição de calendários circular.')
+    elif action in ('post_add', 'post_remove', 'post_clear'):
+        if reverse:
+            Calendario.invalidar_cache()
+            compostos = instance.compostos.all()
+            if pk_set is not None:
+                compostos = Calendario.objects.filter(pk__in=pk_set)
+            for composto in compostos:
+                composto.rematerializar_dias()
+        else:
+            instance.rematerializar_dias()
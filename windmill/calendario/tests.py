@@ -1,3 +1,248 @@
+import datetime
+from django.core.exceptions import ValidationError
 from django.test import TestCase
+from model_mommy import mommy
+import calendario.models as cm
 
-# Create your tests here.
+class CalendarioUnitTests(TestCase):
+    """
+    Testes das funções de dias úteis do calendário.
+    """
+    def setUp(self):
+        self.calendario = mommy.make('calendario.Calendario')
+        self.feriado = mommy.make('calendario.Feriado',
+            data=datetime.date(year=2018, month=11, day=15)
+        )
+        self.calendario.feriados.add(self.feriado)
+
+    def test_dia_trabalho_pula_feriado(self):
+        # 14/11/2018 é quarta, 15/11/2018 é feriado.
+        data = datetime.date(year=2018, month=11, day=14)
+        self.assertEqual(self.calendario.dia_trabalho(data, 1),
+            datetime.date(year=2018, month=11, day=16))
+        self.assertEqual(self.calendario.dia_trabalho(
+            datetime.date(year=2018, month=11, day=16), -1), data)
+
+    def test_dia_trabalho_total(self):
+        inicio = datetime.date(year=2018, month=11, day=12)
+        fim = datetime.date(year=2018, month=11, day=16)
+        self.assertEqual(self.calendario.dia_trabalho_total(inicio, fim), 4)
+
+    def test_sem_consultas_apos_construir_indice(self):
+        data = datetime.date(year=2018, month=11, day=14)
+        self.calendario.dia_trabalho(data, 1)
+        with self.assertNumQueries(0):
+            self.calendario.dia_trabalho(data, -10)
+            self.calendario.dia_trabalho_total(data, data + datetime.timedelta(days=30))
+            self.calendario.dia_util(data)
+
+    def test_invalida_cache_ao_adicionar_feriado(self):
+        data = datetime.date(year=2018, month=11, day=19)
+        self.assertTrue(self.calendario.dia_util(data))
+        novo_feriado = mommy.make('calendario.Feriado', data=data)
+        self.calendario.feriados.add(novo_feriado)
+        self.assertFalse(self.calendario.dia_util(data))
+
+    def test_invalida_cache_ao_alterar_feriado(self):
+        self.calendario.dia_util(self.feriado.data)
+        self.feriado.data = datetime.date(year=2018, month=11, day=20)
+        self.feriado.save()
+        self.assertTrue(self.calendario.dia_util(datetime.date(year=2018, month=11, day=15)))
+        self.assertFalse(self.calendario.dia_util(datetime.date(year=2018, month=11, day=20)))
+
+    def test_lote_equivale_escalar(self):
+        datas = [datetime.date(year=2018, month=11, day=14) + datetime.timedelta(days=i)
+            for i in range(0, 90, 7)]
+        lote = self.calendario.dia_trabalho_lote(datas, 3)
+        total = self.calendario.dia_trabalho_total_lote(datas[0], datas)
+        fim_mes = self.calendario.fim_mes_util_lote(datas)
+        uteis = self.calendario.dias_uteis_mes_lote(datas)
+        for i, data in enumerate(datas):
+            self.assertEqual(lote[i].astype(datetime.date),
+                self.calendario.dia_trabalho(data, 3))
+            self.assertEqual(total[i],
+                self.calendario.dia_trabalho_total(datas[0], data))
+            self.assertEqual(fim_mes[i].astype(datetime.date),
+                self.calendario.fim_mes_util(data))
+            self.assertEqual(uteis[i], self.calendario.dias_uteis_mes(data))
+
+    def test_conta_fim_mes_lote(self):
+        inicio = datetime.date(year=2018, month=1, day=15)
+        fins = [datetime.date(year=2018, month=1, day=30),
+            datetime.date(year=2018, month=1, day=31),
+            datetime.date(year=2018, month=3, day=30),
+            datetime.date(year=2018, month=12, day=31)]
+        self.assertEqual(list(self.calendario.conta_fim_mes_lote(inicio, fins)),
+            [0, 1, 2, 12])
+
+    def test_tabela_de_meses(self):
+        data = datetime.date(year=2018, month=11, day=5)
+        self.assertEqual(self.calendario.fim_mes_util(data),
+            datetime.date(year=2018, month=11, day=30))
+        # Novembro de 2018: 22 dias de semana, menos o feriado do dia 15.
+        self.assertEqual(self.calendario.dias_uteis_mes(data), 21)
+        # Fevereiro de 2018 termina numa quarta, e o acúmulo não deve
+        # escorregar para o dia 28 dos meses seguintes.
+        self.assertEqual(self.calendario.conta_fim_mes(
+            datetime.date(year=2018, month=1, day=15),
+            datetime.date(year=2018, month=3, day=30)), 2)
+        with self.assertNumQueries(0):
+            self.calendario.fim_mes_util(data)
+            self.calendario.dias_uteis_mes(data)
+
+    def test_fora_do_horizonte(self):
+        data = datetime.date(year=1900, month=12, day=10)
+        self.assertEqual(self.calendario.fim_mes_util(data),
+            datetime.date(year=1900, month=12, day=31))
+        self.assertEqual(self.calendario.dias_uteis_mes(data), 21)
+
+class CalendarioDiaUnitTests(TestCase):
+    """
+    Testes da tabela materializada de dias do calendário.
+    """
+    def setUp(self):
+        self.calendario = mommy.make('calendario.Calendario')
+        self.feriado = mommy.make('calendario.Feriado',
+            data=datetime.date(year=2018, month=11, day=15)
+        )
+        self.calendario.feriados.add(self.feriado)
+        self.calendario.materializar_dias(datetime.date(year=2018, month=11, day=1),
+            datetime.date(year=2018, month=12, day=31))
+
+    def test_materializa_dias(self):
+        dias = cm.CalendarioDia.objects.filter(calendario=self.calendario)
+        self.assertEqual(dias.count(), 61)
+        feriado = dias.get(data=datetime.date(year=2018, month=11, day=15))
+        self.assertFalse(feriado.dia_util)
+        self.assertEqual(feriado.dia_util_anterior, datetime.date(year=2018, month=11, day=14))
+        self.assertEqual(feriado.proximo_dia_util, datetime.date(year=2018, month=11, day=16))
+        sexta = dias.get(data=datetime.date(year=2018, month=11, day=16))
+        quarta = dias.get(data=datetime.date(year=2018, month=11, day=14))
+        self.assertEqual(sexta.ordinal, quarta.ordinal + 1)
+        self.assertTrue(dias.get(data=datetime.date(year=2018, month=11, day=30)).fim_mes_util)
+        self.assertTrue(dias.get(data=datetime.date(year=2018, month=12, day=31)).fim_mes)
+        self.assertFalse(dias.get(data=datetime.date(year=2018, month=12, day=30)).fim_mes_util)
+
+    def test_regenera_ao_adicionar_feriado(self):
+        natal = mommy.make('calendario.Feriado',
+            data=datetime.date(year=2018, month=12, day=25))
+        self.calendario.feriados.add(natal)
+        dias = cm.CalendarioDia.objects.filter(calendario=self.calendario)
+        self.assertEqual(dias.count(), 61)
+        self.assertFalse(dias.get(data=natal.data).dia_util)
+        self.assertEqual(dias.get(data=datetime.date(year=2018, month=12, day=24)).proximo_dia_util,
+            datetime.date(year=2018, month=12, day=26))
+        self.assertEqual(dias.get(data=datetime.date(year=2018, month=12, day=26)).ordinal,
+            dias.get(data=datetime.date(year=2018, month=12, day=24)).ordinal + 1)
+
+    def test_regenera_ao_apagar_feriado(self):
+        self.feriado.delete()
+        dia = cm.CalendarioDia.objects.get(calendario=self.calendario,
+            data=datetime.date(year=2018, month=11, day=15))
+        self.assertTrue(dia.dia_util)
+
+    def test_anotar(self):
+        feriados = cm.CalendarioDia.anotar(cm.Feriado.objects.all(),
+            self.calendario, 'data', ('dia_util_anterior', 'proximo_dia_util'))
+        with self.assertNumQueries(1):
+            feriado = feriados.get(pk=self.feriado.pk)
+        self.assertEqual(feriado.dia_util_anterior, datetime.date(year=2018, month=11, day=14))
+        self.assertEqual(feriado.proximo_dia_util, datetime.date(year=2018, month=11, day=16))
+
+class CalendarioCompostoUnitTests(TestCase):
+    """
+    Testes de calendários compostos por outros calendários.
+    """
+    def setUp(self):
+        self.brasil = mommy.make('calendario.Calendario')
+        self.eua = mommy.make('calendario.Calendario')
+        # 15/11/2018 é feriado no Brasil, 22/11/2018 nos EUA e 25/12/2018
+        # nos dois.
+        for calendario, datas in ((self.brasil, (15, 25)), (self.eua, (22, 25))):
+            for dia in datas:
+                mes = 12 if dia == 25 else 11
+                calendario.feriados.add(mommy.make('calendario.Feriado',
+                    data=datetime.date(year=2018, month=mes, day=dia)))
+        self.uniao = mommy.make('calendario.Calendario', tipo_composicao='U')
+        self.uniao.composicao.add(self.brasil, self.eua)
+        self.intersecao = mommy.make('calendario.Calendario', tipo_composicao='I')
+        self.intersecao.composicao.add(self.brasil, self.eua)
+
+    def test_uniao_e_intersecao(self):
+        for data in (datetime.date(year=2018, month=11, day=15),
+            datetime.date(year=2018, month=11, day=22)):
+            self.assertFalse(self.uniao.dia_util(data))
+            self.assertTrue(self.intersecao.dia_util(data))
+        natal = datetime.date(year=2018, month=12, day=25)
+        self.assertFalse(self.uniao.dia_util(natal))
+        self.assertFalse(self.intersecao.dia_util(natal))
+
+    def test_invalida_composto_ao_alterar_componente(self):
+        data = datetime.date(year=2018, month=11, day=20)
+        self.assertTrue(self.uniao.dia_util(data))
+        self.eua.feriados.add(mommy.make('calendario.Feriado', data=data))
+        self.assertFalse(self.uniao.dia_util(data))
+
+    def test_reutiliza_indices_componentes(self):
+        self.brasil.indice_dias_uteis()
+        self.eua.indice_dias_uteis()
+        # Consultas apenas dos feriados próprios e dos componentes do
+        # composto.
+        with self.assertNumQueries(2):
+            self.uniao.indice_dias_uteis()
+
+    def test_rematerializa_composto_ao_alterar_componente(self):
+        inicio = datetime.date(year=2018, month=11, day=1)
+        fim = datetime.date(year=2018, month=12, day=31)
+        self.uniao.materializar_dias(inicio, fim)
+        data = datetime.date(year=2018, month=11, day=20)
+        self.assertTrue(cm.CalendarioDia.objects.get(calendario=self.uniao, data=data).dia_util)
+        feriado = mommy.make('calendario.Feriado', data=data)
+        self.eua.feriados.add(feriado)
+        dias = cm.CalendarioDia.objects.filter(calendario=self.uniao)
+        self.assertFalse(dias.get(data=data).dia_util)
+        self.assertEqual(dias.get(data=datetime.date(year=2018, month=11, day=19)).proximo_dia_util,
+            datetime.date(year=2018, month=11, day=21))
+        feriado.delete()
+        self.assertTrue(dias.get(data=data).dia_util)
+
+    def test_composicao_circular(self):
+        with self.assertRaises(ValidationError):
+            self.brasil.composicao.add(self.uniao)
+
+class RegraFeriadoUnitTests(TestCase):
+    """
+    Testes da geração de feriados a partir de regras.
+    """
+    def setUp(self):
+        self.brasil = mommy.make('ativos.Pais')
+        self.sp = mommy.make('calendario.Estado', pais=self.brasil)
+        self.rj = mommy.make('calendario.Estado', pais=self.brasil)
+        self.cal_brasil = mommy.make('calendario.Calendario', pais=self.brasil)
+        self.cal_sp = mommy.make('calendario.Calendario', estado=self.sp)
+        self.cal_rj = mommy.make('calendario.Calendario', estado=self.rj)
+        mommy.make('calendario.RegraFeriado', tipo='Fixo', pais=self.brasil,
+            mes=11, dia=15, ano_inicio=None, ano_fim=None)
+        mommy.make('calendario.RegraFeriado', tipo='Páscoa', pais=self.brasil,
+            dias_pascoa=60, ano_inicio=None, ano_fim=None)
+        mommy.make('calendario.RegraFeriado', tipo='Fixo', pais=self.brasil,
+            estado=self.sp, mes=7, dia=9, ano_inicio=None, ano_fim=None)
+
+    def test_gerar_feriados(self):
+        criados = cm.RegraFeriado.gerar_feriados(2018, 2019)
+        self.assertEqual(criados, 6)
+        # Corpus Christi de 2018 foi em 31/05.
+        corpus_christi = datetime.date(year=2018, month=5, day=31)
+        revolucao = datetime.date(year=2018, month=7, day=9)
+        self.assertFalse(self.cal_brasil.dia_util(corpus_christi))
+        self.assertTrue(self.cal_brasil.dia_util(revolucao))
+        self.assertFalse(self.cal_sp.dia_util(revolucao))
+        self.assertFalse(self.cal_sp.dia_util(corpus_christi))
+        self.assertTrue(self.cal_rj.dia_util(revolucao))
+        self.assertEqual(self.cal_sp.feriados.count(), 6)
+
+    def test_gerar_feriados_nao_duplica(self):
+        cm.RegraFeriado.gerar_feriados(2018, 2018)
+        self.assertEqual(cm.RegraFeriado.gerar_feriados(2018, 2019), 3)
+        self.assertEqual(cm.Feriado.objects.count(), 6)
+        self.assertEqual(self.cal_brasil.feriados.count(), 4)
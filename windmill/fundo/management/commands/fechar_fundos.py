@@ -0,0 +1,19 @@
+import datetime
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = 'Fecha os fundos em uma data, em paralelo, respeitando os investimentos entre eles.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('data', help='Data de referência no formato AAAA-MM-DD.')
+        parser.add_argument('--fundos', nargs='*', type=int,
+            help='Ids dos fundos a fechar. Por padrão, todos.')
+        parser.add_argument('--processos', type=int, default=None)
+
+    def handle(self, *args, **options):
+        import fundo.models as fm
+        data = datetime.datetime.strptime(options['data'], '%Y-%m-%d').date()
+        fechamento = fm.FechamentoFundos(options['fundos'], options['processos'])
+        for fundo, resultado in fechamento.fechar(data).items():
+            self.stdout.write('%s: %s' % (fm.Fundo.objects.get(id=fundo), resultado))
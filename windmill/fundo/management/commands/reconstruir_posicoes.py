@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = 'Reconstrói as posições dos fundos na última data fechada, a partir de todas as quantidades.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fundos', nargs='*', type=int,
+            help='Ids dos fundos a reconstruir. Por padrão, todos.')
+
+    def handle(self, *args, **options):
+        import fundo.models as fm
+        fundos = fm.Fundo.objects.all()
+        if options['fundos']:
+            fundos = fundos.filter(id__in=options['fundos'])
+        for fundo in fundos:
+            data = fundo.ultima_data_fechada()
+            datas = [data] if data is not None else []
+            gravadas = fm.Posicao.reconstruir(fundo, datas)
+            self.stdout.write('%s: %s posições em %s' % (fundo, gravadas, data))
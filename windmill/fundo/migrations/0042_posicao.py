@@ -0,0 +1,32 @@
+# Generated by Django 2.0 on 2019-02-12 10:14
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('fundo', '0041_auto_20190206_1036'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Posicao',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('data', models.DateField()),
+                ('tipo_id', models.PositiveIntegerField()),
+                ('qtd', models.DecimalField(decimal_places=6, max_digits=20)),
+                ('corretora', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to='fundo.Corretora')),
+                ('custodia', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to='fundo.Custodiante')),
+                ('fundo', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='fundo.Fundo')),
+                ('tipo_quantidade', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='posicao_ativo', to='contenttypes.ContentType')),
+            ],
+            options={
+                'verbose_name_plural': 'Posições',
+                'unique_together': {('fundo', 'data', 'tipo_quantidade', 'tipo_id', 'custodia', 'corretora')},
+            },
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 2.0 on 2019-02-12 16:40
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ativos', '0029_auto_20190207_1011'),
+        ('fundo', '0042_posicao'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='movimentacao',
+            name='ativo',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='movimentacoes', to='ativos.Ativo'),
+        ),
+        migrations.AddField(
+            model_name='movimentacao',
+            name='corretora',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='movimentacoes', to='fundo.Corretora'),
+        ),
+        migrations.AddField(
+            model_name='movimentacao',
+            name='custodia',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='movimentacoes', to='fundo.Custodiante'),
+        ),
+        migrations.AddField(
+            model_name='quantidade',
+            name='ativo',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='quantidades', to='ativos.Ativo'),
+        ),
+        migrations.AddField(
+            model_name='quantidade',
+            name='corretora',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='quantidades', to='fundo.Corretora'),
+        ),
+        migrations.AddField(
+            model_name='quantidade',
+            name='custodia',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='quantidades', to='fundo.Custodiante'),
+        ),
+    ]
@@ -0,0 +1,84 @@
+# Generated by Django 2.0 on 2019-02-12 16:45
+
+from django.db import migrations
+
+# Boletas cuja corretora está na própria boleta. Nas demais, a corretora é a
+# do caixa alvo.
+BOLETAS_COM_CORRETORA = ('boletaacao', 'boletarendafixalocal', 'boletarendafixaoffshore')
+
+
+def custodia_corretora(apps, registro):
+    """
+    Busca a custódia e a corretora da boleta que originou a quantidade ou
+    movimentação, da mesma forma que o fechamento fazia antes dos campos
+    serem gravados no registro.
+    """
+    ContentType = apps.get_model('contenttypes', 'ContentType')
+    BoletaProvisao = apps.get_model('boletagem', 'BoletaProvisao')
+    Caixa = apps.get_model('ativos', 'Caixa')
+
+    tipo = ContentType.objects.get(id=registro.content_type_id)
+    modelo = apps.get_model(tipo.app_label, tipo.model)
+    boleta = modelo.objects.filter(id=registro.object_id).first()
+    if boleta is None:
+        return None, None
+    if tipo.model == 'provento':
+        # A boleta de provisão do provento aponta para o mesmo objeto.
+        provisao = BoletaProvisao.objects.filter(content_type_id=registro.content_type_id, \
+            object_id=registro.object_id, fundo_id=registro.fundo_id).first()
+        if provisao is None:
+            return None, None
+        caixa = Caixa.objects.get(id=provisao.caixa_alvo_id)
+        return caixa.custodia_id, caixa.corretora_id
+    if tipo.model == 'boletaprovisao':
+        caixa = Caixa.objects.get(id=boleta.caixa_alvo_id)
+        return caixa.custodia_id, caixa.corretora_id
+    if tipo.model in BOLETAS_COM_CORRETORA:
+        return boleta.custodia_id, boleta.corretora_id
+    caixa = Caixa.objects.get(id=boleta.caixa_alvo_id)
+    return boleta.custodia_id, caixa.corretora_id
+
+
+def preencher(apps, schema_editor):
+    """
+    Preenche custódia, corretora e ativo das quantidades e movimentações.
+    Registros cuja custódia não pode ser encontrada não formariam vértices
+    no fechamento, então a migração falha listando os seus ids para que
+    sejam corrigidos antes. Corretora vazia é válida.
+    """
+    ContentType = apps.get_model('contenttypes', 'ContentType')
+    Ativo = apps.get_model('ativos', 'Ativo')
+    tipos_ativo = set(ContentType.objects.filter(app_label='ativos').values_list('id', flat=True))
+    ids_ativos = set(Ativo.objects.values_list('id', flat=True))
+    sem_custodia = dict()
+
+    for nome_modelo, campo_tipo in (('Quantidade', 'tipo_quantidade_id'), \
+        ('Movimentacao', 'tipo_movimentacao_id')):
+        modelo = apps.get_model('fundo', nome_modelo)
+        for registro in modelo.objects.filter(custodia__isnull=True).iterator():
+            custodia_id, corretora_id = custodia_corretora(apps, registro)
+            if custodia_id is None:
+                sem_custodia.setdefault(nome_modelo, []).append(registro.id)
+                continue
+            ativo_id = None
+            if getattr(registro, campo_tipo) in tipos_ativo and registro.tipo_id in ids_ativos:
+                ativo_id = registro.tipo_id
+            modelo.objects.filter(id=registro.id).update(custodia_id=custodia_id, \
+                corretora_id=corretora_id, ativo_id=ativo_id)
+
+    if sem_custodia:
+        raise ValueError('Registros sem custódia encontrada: %s' % \
+            '; '.join('%s %s' % (nome, sorted(ids)) for nome, ids in sorted(sem_custodia.items())))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fundo', '0043_auto_20190212_1640'),
+        ('boletagem', '0058_auto_20190207_1011'),
+        ('mercado', '0007_auto_20190206_1245'),
+    ]
+
+    operations = [
+        migrations.RunPython(preencher, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.0 on 2019-02-15 10:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fundo', '0044_preencher_custodia_corretora_ativo'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='fundo',
+            name='compensar_liquidacoes',
+            field=models.BooleanField(default=False),
+        ),
+    ]
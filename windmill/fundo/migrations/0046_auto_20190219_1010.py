@@ -0,0 +1,19 @@
+# Generated by Django 2.0 on 2019-02-19 10:10
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fundo', '0045_auto_20190215_1010'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='posicao',
+            name='corretora',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, to='fundo.Corretora'),
+        ),
+    ]
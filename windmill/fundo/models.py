@@ -18,6 +18,7 @@ from django.db.models import Sum
 from django.contrib.contenttypes.fields import GenericForeignKey, GenericRelation
 from django.contrib.contenttypes.models import ContentType
 from phonenumber_field.modelfields import PhoneNumberField
+import numpy as np
 import pandas as pd
 import datetime
 
@@ -134,6 +135,9 @@ class Fundo(BaseModel):
     calendario = models.ForeignKey('calendario.Calendario', on_delete=models.PROTECT)
     # indica quando terminará o próximo exercício social do fundo.
     data_exercicio_social = models.DateField(null=True, blank=True)
+    # Indica se as provisões e CPRs das operações do fundo são compensados
+    # por caixa e data de liquidação, em vez de criados um por boleta.
+    compensar_liquidacoes = models.BooleanField(default=False)
 
     class Meta:
         ordering = ['nome']
@@ -207,7 +211,10 @@ class Fundo(BaseModel):
                             fundo = vertice.fundo,
                             data = data_referencia,
                             content_object = provento,
-                            objeto_movimentacao = provento.ativo
+                            objeto_movimentacao = provento.ativo,
+                            custodia = caixa.custodia,
+                            corretora = caixa.corretora,
+                            ativo = provento.ativo
                         )
                         mov.full_clean()
                         mov.save()
@@ -220,6 +227,9 @@ class Fundo(BaseModel):
                             data = provento.data_ex,
                             content_object = provento,
                             objeto_quantidade = provento.ativo,
+                            custodia = vertice.custodia,
+                            corretora = vertice.corretora,
+                            ativo = provento.ativo,
                         )
                         qtd.save()
                     # Direito de subscrição
@@ -264,7 +274,7 @@ class Fundo(BaseModel):
     Fechamento do fundo
     """
 
-    def fechar_fundo(self, data_referencia):
+    def fechar_fundo(self, data_referencia, estado=None):
         """
         FECHAMENTO DE FUNDO
         Para fazer o fechamento de um fundo em uma determinada data de referência, é
@@ -309,10 +319,148 @@ class Fundo(BaseModel):
             - Cálculo da cota, considerando PL e movimentações feitas.
             - Atualização do número de cotas, caso tenha havido uma alteração
         devido à movimentação.
+        Em fechamentos de vários dias seguidos, estado é o EstadoFechamento
+        carregado do dia anterior.
         """
         self.zeragem_de_caixa(data_referencia)
         self.fechar_boletas_do_fundo(data_referencia)
-        self.criar_vertices(data_referencia)
+        self.criar_vertices(data_referencia, estado)
+
+    def dias_fechamento(self, data_inicio, data_fim):
+        """ date, date -> list
+        Retorna os dias úteis do calendário do fundo entre as datas, inclusive.
+        """
+        indice = self.calendario.indice_dias_uteis()
+        dias = np.arange(np.datetime64(data_inicio, 'D'),
+            np.datetime64(data_fim, 'D') + 1, dtype='datetime64[D]')
+        return list(dias[indice.dia_util(dias)].astype(datetime.date))
+
+    def fechar_fundo_periodo(self, data_inicio, data_fim):
+        """ date, date -> list
+        Fecha o fundo em todos os dias úteis entre as datas de início e fim,
+        em ordem. O estado do fechamento (posições já resolvidas, câmbios
+        configurados e últimos preços) é mantido em memória de um dia para
+        o outro, de modo que cada dia só consulta o que mudou desde o dia
+        anterior. Retorna os dias fechados.
+        """
+        estado = EstadoFechamento(self)
+        dias = self.dias_fechamento(data_inicio, data_fim)
+        for dia in dias:
+            self.fechar_fundo(dia, estado)
+        return dias
+
+    def ultima_data_fechada(self):
+        """ -> date
+        Retorna a última data em que o fundo foi fechado, pela sua carteira
+        ou, se a carteira ainda não tiver sido consolidada, pelos vértices.
+        """
+        datas = [Carteira.objects.filter(fundo=self).aggregate(data=models.Max('data'))['data'],
+            Vertice.objects.filter(fundo=self).aggregate(data=models.Max('data'))['data']]
+        datas = [data for data in datas if data is not None]
+        return max(datas) if datas else None
+
+    def fechar_fundo_pendentes(self, data_fim=None):
+        """ date -> list
+        Modo de recuperação: fecha, em ordem, todos os dias úteis desde o
+        dia seguinte à última data fechada até a data de fim (por padrão, o
+        dia útil anterior a hoje). Fundos nunca fechados começam pela data de
+        início do fundo. Retorna os dias fechados.
+        """
+        if data_fim is None:
+            data_fim = self.calendario.dia_trabalho(datetime.date.today(), -1)
+        ultima = self.ultima_data_fechada()
+        if ultima is not None:
+            data_inicio = ultima + datetime.timedelta(days=1)
+        elif self.data_de_inicio is not None:
+            data_inicio = self.data_de_inicio
+        else:
+            raise ValueError("Fundo sem data de início nem fechamentos anteriores: " + self.nome)
+        if data_inicio > data_fim:
+            return []
+        return self.fechar_fundo_periodo(data_inicio, data_fim)
+
+    def travar_fechamento(self, data_referencia):
+        """ date -> Boolean
+        Deve ser chamado dentro de uma transação. No PostgreSQL, obtém uma
+        trava consultiva (advisory lock) da transação para o par fundo/data,
+        de modo que dois processos nunca fechem o mesmo fundo na mesma data.
+        Retorna False se outro processo já possuir a trava. Em outros bancos,
+        retorna sempre True.
+        """
+        from django.db import connection
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT pg_try_advisory_xact_lock(%s, %s)',
+                    [self.id, data_referencia.toordinal()])
+                return cursor.fetchone()[0]
+        return True
+
+    def fechar_fundo_exclusivo(self, data_referencia):
+        """ date -> Boolean
+        Faz o fechamento do fundo em uma transação, com a trava de
+        travar_fechamento: fecha o fundo, calcula a cota e a publica como
+        preço dos ativos geridos pelo fundo, para que os fundos que investem
+        nele a encontrem. Se outro processo já estiver fechando o fundo,
+        retorna False sem fazer nada.
+        """
+        from django.db import transaction
+        with transaction.atomic():
+            if self.travar_fechamento(data_referencia) == False:
+                return False
+            self.fechar_fundo(data_referencia)
+            self.calcular_cota(data_referencia)
+            self.publicar_cota(data_referencia)
+        return True
+
+    def publicar_cota(self, data_referencia):
+        """ date -> Decimal
+        Grava a cota da carteira do fundo na data como preço de fechamento
+        dos Fundo_Local e Fundo_Offshore geridos pelo fundo. Retorna a cota,
+        ou None se o fundo não tiver carteira com cota na data.
+        """
+        import ativos.models as am
+        import mercado.models as mm
+        cota = Carteira.objects.filter(fundo=self, data=data_referencia).\
+            exclude(cota=None).values_list('cota', flat=True).first()
+        if cota is None:
+            return None
+        for modelo in (am.Fundo_Local, am.Fundo_Offshore):
+            for ativo in modelo.objects.filter(gestao=self).values_list('id', flat=True):
+                mm.Preco.all_objects.update_or_create(ativo_id=ativo,
+                    data_referencia=data_referencia,
+                    defaults={'preco_fechamento': cota, 'deletado_em': None})
+        return cota
+
+    def simular_fechamento(self, data_referencia):
+        """ date -> (DataFrame, Carteira)
+        Fechamento de teste: executa o fechamento completo (boletas,
+        zeragem, vértices e cota) em uma transação que é sempre desfeita ao
+        final, de modo que nada é gravado no banco. Retorna os vértices que
+        seriam criados e a carteira que seria gerada, não salva. Só são
+        considerados os vértices criados pela simulação, então em uma data
+        já fechada os vértices gravados não entram na carteira simulada.
+        Não usa a trava de travar_fechamento, mas as boletas e pendências
+        alteradas ficam travadas até o fim da transação: um fechamento real
+        do fundo ao mesmo tempo espera a simulação terminar.
+        """
+        from django.db import transaction
+        import ativos.models as am
+        with transaction.atomic():
+            ultimo_id = Vertice.objects.aggregate(id=models.Max('id'))['id'] or 0
+            self.fechar_fundo(data_referencia)
+            vertices = pd.DataFrame(list(Vertice.objects.filter(fundo=self, \
+                data=data_referencia, id__gt=ultimo_id).values('object_id', \
+                'content_type_id', 'custodia_id', 'corretora_id', 'quantidade', 'preco', \
+                'data_preco', 'cambio', 'valor', 'movimentacao', 'fundo', 'data')))
+            carteira = None
+            if not vertices.empty:
+                nomes = dict(am.Ativo.objects.filter(id__in=vertices['object_id'].\
+                    tolist()).values_list('id', 'nome'))
+                vertices['nome'] = vertices['object_id'].map(nomes)
+                carteira = Carteira()
+                carteira.calcular(vertices)
+            transaction.set_rollback(True)
+        return vertices, carteira
 
     def fechar_boletas_do_fundo(self, data_referencia):
         """
@@ -338,6 +486,30 @@ class Fundo(BaseModel):
         self.fechar_boletas_CPR(data_referencia)
         self.fechar_boletas_provisao(data_referencia)
 
+    def boletas_pendentes(self, modelo, data_referencia, janela=None, ativo=None):
+        """ Model, date, Q, Ativo -> QuerySet
+        Busca, pelo índice de pendências das boletas (proxima_acao e fechada),
+        as boletas do modelo com ação no fundo até a data de referência, de
+        modo que o custo do fechamento acompanhe o movimento do dia e não o
+        tamanho do histórico. A janela é a condição em que o fechamento
+        processa a boleta na data: boletas pendentes que já passaram da janela
+        não têm mais o que fazer e são marcadas como fechadas.
+            Com o ativo, busca as boletas pendentes em que o ativo negociado é
+        o fundo, pelo índice (ativo, fechada, proxima_acao). A pendência dessas
+        boletas segue o fechamento do fundo investidor, então as que estão
+        fora da janela apenas não são retornadas.
+        """
+        if ativo is not None:
+            pendentes = modelo.objects.filter(ativo=ativo, fechada=False, \
+                proxima_acao__lte=data_referencia)
+            return pendentes if janela is None else pendentes.filter(janela)
+        pendentes = modelo.objects.filter(fundo=self, fechada=False, \
+            proxima_acao__lte=data_referencia)
+        if janela is None:
+            return pendentes
+        pendentes.exclude(janela).update(fechada=True, proxima_acao=None)
+        return pendentes.filter(janela)
+
     def fechar_boletas_acao(self, data_referencia):
         """
         Pega todas as boletas de ação do fundo, para a data de referência, e
@@ -345,88 +517,80 @@ class Fundo(BaseModel):
         movimentações e vértice do CPR
         """
         from boletagem.models import BoletaAcao
-        boletas = BoletaAcao.objects.filter(fundo=self, data_operacao=data_referencia)
-        if boletas:
-            for boleta in boletas:
-                boleta.fechar_boleta()
+        BoletaAcao.fechar_em_lote(self.boletas_pendentes(BoletaAcao, \
+            data_referencia, models.Q(data_operacao=data_referencia)), data_referencia)
 
     def fechar_boletas_rf_local(self, data_referencia):
         from boletagem.models import BoletaRendaFixaLocal
-        for boleta in BoletaRendaFixaLocal.objects.filter(fundo=self, data_operacao=data_referencia):
+        for boleta in self.boletas_pendentes(BoletaRendaFixaLocal, data_referencia, \
+            models.Q(data_operacao=data_referencia)):
             boleta.fechar_boleta()
+            boleta.registrar_fechamento(data_referencia)
 
     def fechar_boletas_rf_off(self, data_referencia):
         from boletagem.models import BoletaRendaFixaOffshore
-        for boleta in BoletaRendaFixaOffshore.objects.filter(fundo=self,\
-            data_operacao=data_referencia):
+        for boleta in self.boletas_pendentes(BoletaRendaFixaOffshore, data_referencia, \
+            models.Q(data_operacao=data_referencia)):
             boleta.fechar_boleta()
+            boleta.registrar_fechamento(data_referencia)
+
+    @staticmethod
+    def janela_cotizacao_liquidacao(data_referencia):
+        """ date -> Q
+        Boletas de fundo com cotização anterior à liquidação, ou com
+        liquidação anterior à cotização, cuja janela contém a data.
+        """
+        return models.Q(data_cotizacao__lte=data_referencia, \
+            data_liquidacao__gte=data_referencia) | \
+            models.Q(data_cotizacao__gte=data_referencia, \
+            data_liquidacao__lte=data_referencia)
 
     def fechar_boletas_fundo_local(self, data_referencia):
         from boletagem.models import BoletaFundoLocal
-        # Busca as boletas que possuem cotização anterior à liquidação
-        for boleta in BoletaFundoLocal.objects.filter(fundo=self, \
-            data_cotizacao__lte=data_referencia, \
-            data_liquidacao__gte=data_referencia):
-            boleta.fechar_boleta()
-
-        # Busca as boletas que possuem data de liquidação anterior à cotização.
-        for boleta in BoletaFundoLocal.objects.filter(fundo=self, \
-            data_cotizacao__gte=data_referencia, \
-            data_liquidacao__lte=data_referencia):
+        janela = self.janela_cotizacao_liquidacao(data_referencia)
+        for boleta in self.boletas_pendentes(BoletaFundoLocal, data_referencia, janela):
             boleta.fechar_boleta()
+            boleta.registrar_fechamento(data_referencia)
 
     def fechar_boletas_fundo_local_como_ativo(self, data_referencia):
         """
-        Busca BoletaFundoLocal em que o ativo negociado é o fundo
+        Busca BoletaFundoLocal pendentes em que o ativo negociado é o fundo
         """
         from boletagem.models import BoletaFundoLocal
         from ativos.models import Fundo_Local
         # Busca o ativo correspondente ao fundo local
-        fundo = Fundo_Local.objects.filter(gestao=self)
-        if fundo.count() > 0:
-            fundo = fundo[0]
-            for boleta in BoletaFundoLocal.objects.filter(ativo=fundo, \
-                data_cotizacao__lte=data_referencia, \
-                data_liquidacao__gte=data_referencia):
-                boleta.fechar_boleta()
-
-            for boleta in BoletaFundoLocal.objects.filter(ativo=fundo, \
-                data_cotizacao__gte=data_referencia, \
-                data_liquidacao__lte=data_referencia):
-                boleta.fechar_boleta()
+        fundo = Fundo_Local.objects.filter(gestao=self).first()
+        if fundo is None:
+            return
+        for boleta in self.boletas_pendentes(BoletaFundoLocal, data_referencia, \
+            self.janela_cotizacao_liquidacao(data_referencia), ativo=fundo):
+            boleta.fechar_boleta()
 
     def fechar_boletas_fundo_offshore(self, data_referencia):
         from boletagem.models import BoletaFundoOffshore
-        for boleta in BoletaFundoOffshore.objects.filter(fundo=self).\
-            exclude(estado=BoletaFundoOffshore.ESTADO[5][0]):
-            boleta.fechar_boleta(data_referencia)
+        BoletaFundoOffshore.fechar_em_lote(self.boletas_pendentes( \
+            BoletaFundoOffshore, data_referencia), data_referencia)
 
     def fechar_boletas_fundo_off_como_ativo(self, data_referencia):
         """
-        Busca BoletaFundoOffshore em que o ativo negociado é o fundo
+        Busca BoletaFundoOffshore pendentes em que o ativo negociado é o fundo
         """
         from boletagem.models import BoletaFundoOffshore
         from ativos.models import Fundo_Offshore
-        # Busca o ativo correspondente ao fundo local
+        # Busca o ativo correspondente ao fundo offshore
         fundo = Fundo_Offshore.objects.filter(gestao=self).first()
-
-        for boleta in BoletaFundoOffshore.objects.filter(ativo=fundo, \
-            data_cotizacao__lte=data_referencia, \
-            data_liquidacao__gte=data_referencia):
-            boleta.fechar_boleta()
-
-        for boleta in BoletaFundoOffshore.objects.filter(ativo=fundo, \
-            data_cotizacao__gte=data_referencia, \
-            data_liquidacao__lte=data_referencia):
-            boleta.fechar_boleta()
+        if fundo is None:
+            return
+        for boleta in self.boletas_pendentes(BoletaFundoOffshore, data_referencia, \
+            self.janela_cotizacao_liquidacao(data_referencia), ativo=fundo):
+            boleta.fechar_boleta(data_referencia)
 
     def fechar_boletas_passivo(self, data_referencia):
         from boletagem.models import BoletaPassivo
-        boletas_passivo = BoletaPassivo.objects.filter(fundo=self, \
-            data_cotizacao__gte=data_referencia)
-        if boletas_passivo:
-            for boleta in boletas_passivo:
-                boleta.fechar_boleta()
+        for boleta in self.boletas_pendentes(BoletaPassivo, data_referencia, \
+            models.Q(data_cotizacao__gte=data_referencia)):
+            boleta.fechar_boleta()
+            boleta.registrar_fechamento(data_referencia)
 
     def fechar_boletas_emprestimo(self, data_referencia):
         """
@@ -434,29 +598,32 @@ class Fundo(BaseModel):
         boletas cuja data de liquidação é igual à data de referência.
         """
         from boletagem.models import BoletaEmprestimo
-        for boleta in BoletaEmprestimo.objects.filter(fundo=self, \
-            data_liquidacao=None):
+        for boleta in self.boletas_pendentes(BoletaEmprestimo, data_referencia, \
+            models.Q(data_liquidacao=None)):
             boleta.fechar_boleta(data_referencia)
+            boleta.registrar_fechamento(data_referencia)
 
     def fechar_boletas_cambio(self, data_referencia):
         from boletagem.models import BoletaCambio
-        for boleta in BoletaCambio.objects.filter(fundo=self, \
-            data_operacao=data_referencia):
+        for boleta in self.boletas_pendentes(BoletaCambio, data_referencia, \
+            models.Q(data_operacao=data_referencia)):
             boleta.fechar_boleta()
+            boleta.registrar_fechamento(data_referencia)
 
     def fechar_boletas_CPR(self, data_referencia):
         from boletagem.models import BoletaCPR
-        for boleta in BoletaCPR.objects.filter(fundo=self, \
-            data_inicio__lte=data_referencia, \
-            data_pagamento__gte=data_referencia):
+        for boleta in self.boletas_pendentes(BoletaCPR, data_referencia, \
+            models.Q(data_inicio__lte=data_referencia, \
+            data_pagamento__gte=data_referencia)):
             boleta.fechar_boleta(data_referencia)
+            boleta.registrar_fechamento(data_referencia)
 
     def fechar_boletas_provisao(self, data_referencia):
         from boletagem.models import BoletaProvisao
-        # Busca boletas com estado pendente.
-        for boleta in BoletaProvisao.objects.filter(fundo=self):
-            if boleta.fechado() == False:
-                boleta.fechar_boleta(data_referencia)
+        # A quantidade e a movimentação da provisão são datadas no pagamento,
+        # que é a próxima ação da boleta.
+        BoletaProvisao.fechar_em_lote(self.boletas_pendentes(BoletaProvisao, \
+            data_referencia), data_referencia)
 
     """
     Criação de vértices:
@@ -465,35 +632,39 @@ class Fundo(BaseModel):
         - Juntar todas as movimentações com data igual à data de fechamento.
     """
 
-    def juntar_quantidades(self, data_referencia):
+    def juntar_quantidades(self, data_referencia, estado=None):
         """ datetime -> DataFrame
         Junta as quantidades dos diferentes tipos de ativos e retorna o
-        dataframe com todos os ativos.
+        dataframe com todos os ativos. Se houver uma Posicao do fundo em uma
+        data anterior, parte dela e busca apenas as quantidades posteriores.
+        Ao final, grava a Posicao do fundo na data de referência.
         """
         import ativos.models as am
 
-        tipo_objeto = ContentType.objects.get_for_model(am.Acao)
-        carteira = self.juntar_quantidades_ativo(data_referencia, tipo_objeto)
-
-        tipo_objeto = ContentType.objects.get_for_model(am.Renda_Fixa)
-        carteira = carteira.append(self.juntar_quantidades_ativo(data_referencia, tipo_objeto))
-
-        tipo_objeto = ContentType.objects.get_for_model(am.Caixa)
-        carteira = carteira.append(self.juntar_quantidades_ativo(data_referencia, tipo_objeto))
-
-        tipo_objeto = ContentType.objects.get_for_model(am.Fundo_Local)
-        carteira = carteira.append(self.juntar_quantidades_ativo(data_referencia, tipo_objeto))
-
-        tipo_objeto = ContentType.objects.get_for_model(am.Fundo_Offshore)
-        carteira = carteira.append(self.juntar_quantidades_ativo(data_referencia, tipo_objeto))
-
+        data_posicao = None
+        if estado is None:
+            data_posicao = Posicao.objects.filter(fundo=self, \
+                data__lt=data_referencia).aggregate(data=models.Max('data'))['data']
+
+        carteira = pd.DataFrame()
+        for modelo in (am.Acao, am.Renda_Fixa, am.Caixa, am.Fundo_Local, am.Fundo_Offshore):
+            tipo_objeto = ContentType.objects.get_for_model(modelo)
+            carteira = carteira.append(self.juntar_quantidades_ativo(data_referencia, \
+                tipo_objeto, estado, data_posicao))
+
+        if data_posicao is not None:
+            carteira = carteira.append(Posicao.quantidades(self, data_posicao, \
+                data_referencia), sort=False)
+        Posicao.gravar(self, data_referencia, carteira)
         return carteira
 
-    def juntar_quantidades_ativo(self, data_referencia, object_type):
+    def juntar_quantidades_ativo(self, data_referencia, object_type, estado=None, desde=None):
         """ datetime -> DataFrame
         Busca, no banco de dados, todas as quantidades de um tipo de ativo
         com data menor ou igual à data de referência, e devolve
-        as quantidades.
+        as quantidades. Com um EstadoFechamento, busca apenas as quantidades
+        que ainda não foram carregadas em dias anteriores. Com a data desde,
+        busca apenas as quantidades posteriores a ela.
         """
         import ativos.models as am
         pd.set_option('display.max_columns', 10)
@@ -505,52 +676,24 @@ class Fundo(BaseModel):
         # values('tipo_id', 'data', 'fundo').annotate(posicao=Sum('qtd'))
         resultado = Quantidade.objects.filter(data__lte=data_referencia, \
         fundo=self, tipo_quantidade=object_type)
-
-        if resultado:
-            """
-            Buscando as informações de custódia de cada ativo
-            """
-            import boletagem.models as bm
-            dicionario_boleta_custodia = []
-            for qtd in resultado:
-                if type(qtd.content_object) != bm.BoletaProvisao:
-                    if type(qtd.content_object) == bm.BoletaAcao or \
-                        type(qtd.content_object) == bm.BoletaRendaFixaLocal or \
-                        type(qtd.content_object) == bm.BoletaRendaFixaOffshore:
-                        dicionario_boleta_custodia.append({'id':qtd.id, \
-                            'custodia_id':qtd.content_object.custodia_id, \
-                            'corretora_id':qtd.content_object.corretora.id})
-                    else:
-                        dicionario_boleta_custodia.append({'id':qtd.id, \
-                        'custodia_id':qtd.content_object.custodia_id, \
-                        'corretora_id':qtd.content_object.caixa_alvo.corretora.id})
-
-                else:
-                    # Caso seja uma boleta de provisão
-                    dicionario_boleta_custodia.append({'id':qtd.id, \
-                    'custodia_id':qtd.content_object.caixa_alvo.custodia.id, \
-                    'corretora_id':qtd.content_object.caixa_alvo.corretora.id})
-            # Dataframe de boletas com custódia
-            # Possui id_quantidade(id), id_custodia
-            custodia = pd.DataFrame(dicionario_boleta_custodia)
-            # Possui id_quantidade(id), id_ativo(tipo_id)
-            resultado = pd.DataFrame(list(resultado.values('id', 'tipo_id', 'object_id', 'qtd', 'fundo', 'tipo_quantidade_id')))
-            # Possui id_ativo (id)
-            ativos = pd.DataFrame(list(am.Ativo.objects.all().values('id', 'nome', 'moeda')))
-            # Juntando quantidades com suas respectivas corretoras e custódias
-            resultado = resultado.merge(custodia, right_on='id', left_on='id')
-            # Juntando quantidades com os nomes das ações.
-            """
-            Este último join abaixo pode vir a ser removido futuramente.
-            """
-            resultado = resultado.merge(ativos, right_on='id', \
-                left_on='tipo_id').drop(['id_y', 'object_id'], axis=1)
-
+        if desde is not None:
+            resultado = resultado.filter(data__gt=desde)
+        if estado is not None:
+            resultado = estado.quantidades_novas(resultado, object_type, data_referencia)
+
+        # Custódia, corretora e ativo já estão gravados na quantidade, então
+        # todas as informações vêm de uma única consulta.
+        resultado = pd.DataFrame(list(resultado.values('id', 'tipo_id', 'qtd', \
+            'fundo', 'tipo_quantidade_id', 'custodia_id', 'corretora_id', \
+            'ativo__nome', 'ativo__moeda')))
+        resultado.rename(columns={'id':'id_x', 'ativo__nome':'nome', \
+            'ativo__moeda':'moeda'}, inplace=True)
+
+        if estado is not None:
+            resultado = estado.acumular_quantidades(object_type, resultado, data_referencia)
+        if not resultado.empty:
             resultado['data'] = data_referencia
-
-            return resultado
-        else:
-            return pd.DataFrame()
+        return resultado
 
     def juntar_movimentacoes(self, data_referencia):
         """
@@ -584,254 +727,193 @@ class Fundo(BaseModel):
         mov = Movimentacao.objects.filter(data=data_referencia, fundo=self,\
             tipo_movimentacao=object_type)
 
-        if mov:
-            # Transformando o resultado em dataframe
-            df_mov = pd.DataFrame(list(mov.values('id', 'data', 'fundo', 'valor', 'tipo_id', 'tipo_movimentacao_id')))
-            # buscando a custodia dos ativos movimentados
-            import boletagem.models as bm
-            import ativos.models as am
-            import mercado.models as mm
-            dicionario_boleta_custodia = []
-            for m in mov:
-                if type(m.content_object) != bm.BoletaProvisao:
-                    if type(m.content_object) == bm.BoletaAcao or \
-                        type(m.content_object) == bm.BoletaRendaFixaLocal or \
-                        type(m.content_object) == bm.BoletaRendaFixaOffshore:
-                        dicionario_boleta_custodia.append({'id':m.id, \
-                            'custodia_id':m.content_object.custodia_id, \
-                            'corretora_id':m.content_object.corretora.id,\
-                            'descricao':m.__str__()})
-                    elif type(m.content_object) == mm.Provento:
-                        # No caso de provento, como a boleta de provisao possuirá
-                        # a mesma referência da movimentação, podemos buscar pela
-                        # boleta de provisão que aponta para o provento.
-                        provisao = bm.BoletaProvisao.objects.get(content_type=m.content_type, \
-                            object_id=m.object_id)
-                        dicionario_boleta_custodia.append({'id':m.id, \
-                            'custodia_id':provisao.caixa_alvo.custodia.id, \
-                            'corretora_id':provisao.caixa_alvo.corretora.id,\
-                            'descricao':m.__str__()})
-                    else:
-                        dicionario_boleta_custodia.append({'id':m.id, \
-                        'custodia_id':m.content_object.custodia_id, \
-                        'corretora_id':m.content_object.caixa_alvo.corretora.id, \
-                        'descricao':m.__str__()})
-                    # dicionario_boleta_custodia.append({'id':m.id, 'custodia_id':m.content_object.custodia_id, 'descricao':m.__str__()})
-                else:
-                    dicionario_boleta_custodia.append({'id':m.id, \
-                    'custodia_id':m.content_object.caixa_alvo.custodia.id, \
-                    'corretora_id':m.content_object.caixa_alvo.corretora.id, \
-                    'descricao':m.content_object.descricao})
-            # Dataframe de boletas com custódia
-            # Possui id_quantidade(id), id_custodia
-            custodia = pd.DataFrame(dicionario_boleta_custodia)
-            # Possui id_ativo (id)
-            ativos = pd.DataFrame(list(am.Ativo.objects.all().values('id', 'nome', 'moeda')))
-
-            df_mov = df_mov.merge(custodia, right_on='id', left_on='id')
-            """
-            Este último join pode vir a ser removido futuramente.
-            """
-            df_mov = df_mov.merge(ativos, right_on='id', \
-                left_on='tipo_id').drop(['id_y'], axis=1)
-
+        # Custódia, corretora e ativo já estão gravados na movimentação, então
+        # todas as informações vêm de uma única consulta.
+        df_mov = pd.DataFrame(list(mov.values('id', 'data', 'fundo', 'valor', \
+            'tipo_id', 'tipo_movimentacao_id', 'custodia_id', 'corretora_id', \
+            'ativo__nome', 'ativo__moeda')))
+        df_mov.rename(columns={'id':'id_x', 'ativo__nome':'nome', \
+            'ativo__moeda':'moeda'}, inplace=True)
+        if not df_mov.empty:
             df_mov['data'] = data_referencia
-            return df_mov
-
-        else:
-            return pd.DataFrame()
+        return df_mov
 
-    def criar_vertices(self, data_referencia):
+    def criar_vertices(self, data_referencia, estado=None):
         """ Date -> None
         Recebe uma data de referência, junta as quantidades e movimentações
         de ativos e cria os vértices da carteira baseado nas quantidades e
-        movimentações, retorna uma lista de id de todos os vértices criados
+        movimentações. As posições são consolidadas de forma vetorizada, os
+        dados de referência vêm de consultas únicas e os vértices e seus
+        casamentos são gravados com bulk_create, de modo que o número de
+        consultas não depende do número de ativos da carteira.
         """
-        import ativos.models as am
         import mercado.models as mm
-        import configuracao.models as cm
-        import math
 
-        carteira_qtd = self.juntar_quantidades(data_referencia)
+        carteira_qtd = self.juntar_quantidades(data_referencia, estado)
         carteira_mov = self.juntar_movimentacoes(data_referencia)
-        df_cambios = self.buscar_cambios(data_referencia)
-
-        lista_qtds = pd.DataFrame()
-        if carteira_qtd.empty == False:
-            # Antes de criar os vértices, precisamos consolidar as quantidades e
-            # ver quais ativos já estão com posição zerada, consolidando o dataframe
-            # por tipo_id (id do ativo) e custodia_id(id da custódia do ativo.)
-
-            carteira_qtd_completa = (carteira_qtd.groupby(['nome', 'fundo', \
-                'data', 'custodia_id', 'corretora_id', 'tipo_id', 'id_x',\
-                'tipo_quantidade_id', 'moeda'])['qtd'].sum().to_frame())
-
-            carteira_qtd_consolidada = (carteira_qtd.groupby(['nome', 'fundo', \
-                'data', 'custodia_id', 'corretora_id', 'tipo_id', \
-                'tipo_quantidade_id', 'moeda'])['qtd'].sum().to_frame())
-            carteira_qtd_completa.reset_index(inplace=True)
-
-            lista_qtds = carteira_qtd_consolidada[carteira_qtd_consolidada['qtd'] != 0].merge(carteira_qtd_completa, how='inner', \
-                left_on=['nome', 'fundo', 'data', 'custodia_id', 'corretora_id', \
-                'tipo_id', 'tipo_quantidade_id', 'moeda'], \
-                right_on=['nome', 'fundo', 'data', 'custodia_id', 'corretora_id', \
-                'tipo_id', 'tipo_quantidade_id', 'moeda'])[['id_x', 'nome', 'fundo', 'data', 'custodia_id', \
-                    'corretora_id', 'tipo_id', 'qtd_x', 'tipo_quantidade_id', 'moeda']]
-
-            lista_qtds.rename(columns={'id_x':'id_qtd', 'qtd_x':'qtd'}, inplace=True)
-            lista_qtds.set_index(['nome', 'fundo', 'data', 'custodia_id', \
-                'corretora_id', 'tipo_id', 'moeda'], inplace=True)
-
-        lista_movs = pd.DataFrame()
-        if carteira_mov.empty == False:
-            carteira_mov_completa = (carteira_mov.groupby(['nome', 'fundo', \
-                'data', 'custodia_id', 'corretora_id', 'tipo_id', 'id_x', \
-                'tipo_movimentacao_id', 'moeda'])['valor'].sum().to_frame())
-
-            carteira_mov_consolidada = (carteira_mov.groupby(['nome', 'fundo', \
-                'data', 'custodia_id', 'corretora_id', 'tipo_id', \
-                'tipo_movimentacao_id', 'moeda'])['valor'].sum().to_frame())
-
-            carteira_mov_completa.reset_index(inplace=True)
-
-            # Lista que encontra as posições que não possuem posição zerada.
-            # Compara a carteira com as posições consolidadadas vs a carteira aberta
-            # exaustivamente.
-            lista_movs = carteira_mov_consolidada[carteira_mov_consolidada['valor'] != 0].merge(carteira_mov_completa, how='inner', \
-                left_on=['nome', 'fundo', 'data', 'custodia_id', 'corretora_id', \
-                'tipo_id', 'moeda'], \
-                right_on=['nome', 'fundo', 'data', 'custodia_id', 'corretora_id', \
-                'tipo_id', 'moeda'])[['id_x', 'nome', 'fundo', 'data', 'custodia_id', \
-                    'corretora_id', 'tipo_id', 'valor_x', 'tipo_movimentacao_id', 'moeda']]
-
-            lista_movs.rename(columns={'id_x':'id_mov', 'valor_x':'mov'}, inplace=True)
-
-            lista_movs.set_index(['nome', 'fundo', 'data', 'custodia_id', \
-                'corretora_id', 'tipo_id', 'moeda'], inplace=True)
-
-        # Juntando lista de qtd e mov
-        lista_vertices = pd.DataFrame()
-        if lista_movs.empty == False and lista_qtds.empty == False:
-            lista_vertices = lista_movs.join(lista_qtds, how='outer')
-        elif lista_movs.empty == True:
-            lista_qtds['mov'] = decimal.Decimal('0')
-            lista_qtds['id_mov'] = decimal.Decimal('0')
-            lista_qtds['tipo_movimentacao_id'] = lista_qtds['tipo_quantidade_id']
-            lista_vertices = lista_qtds.copy()
-        elif lista_qtds.empty == True:
-            lista_movs['qtd'] = decimal.Decimal('0')
-            lista_movs['id_qtd'] = decimal.Decimal('0')
-            lista_movs['tipo_quantidade_id'] = lista_movs['tipo_movimentacao_id']
-            lista_vertices = lista_movs.copy()
-        df_tipo_objeto = lista_vertices['tipo_movimentacao_id'].fillna(lista_vertices['tipo_quantidade_id']).to_frame()
-        df_tipo_objeto.rename(columns={'tipo_movimentacao_id':'tipo_objeto_id'}, inplace=True)
-        lista_vertices = lista_vertices.merge(df_tipo_objeto, how='inner', left_index=True, right_index=True).drop_duplicates()
-        lista_vertices = lista_vertices.drop(['tipo_movimentacao_id','tipo_quantidade_id'], axis=1)
-        lista_vertices.fillna(decimal.Decimal('0'), inplace=True)
-        lista_vertices = lista_vertices.join(df_cambios, on='moeda')
-        lista_vertices.fillna(decimal.Decimal('1'), inplace=True)
-        lista_vertices.reset_index('moeda', inplace=True)
-        lista_vertices = lista_vertices.drop(['moeda', 'moeda_destino'], axis=1)
-        lista_vertices.rename(columns={'preco_fechamento':'cambio'}, inplace=True)
-
-        index_list = lista_vertices.index.tolist()
-        index_names = lista_vertices.index.names
-
-        lista_vertice_id = list()
-
-        # Set pega os objetos distintos do index_list para criar os vértices.
-        # Desta forma, não há double counting de vértices
-        for ativo in set(index_list):
-            # Criando o vértice com os valores
-            vertice = dict()
-            index_values = lista_vertices.loc[ativo].index.tolist()[0]
-            for i, valor in enumerate(index_values):
-                vertice[index_names[i]] = valor
-            ativo_vertice = am.Ativo.objects.get(id=vertice['tipo_id'])
-
-            preco = mm.Preco.objects.filter(data_referencia__lte=vertice['data'].date(),\
-                ativo=ativo_vertice).order_by('-data_referencia').first()
-            preco_fechamento = 0
-
-            if preco == None:
-                preco_fechamento = decimal.Decimal(1)
-            else:
-                preco_fechamento = decimal.Decimal(preco.preco_fechamento).quantize(decimal.Decimal('1.000000'))
-
-            fundo = Fundo.objects.get(id=vertice['fundo'])
-
-            corretora = Corretora.objects.get(id=vertice['corretora_id'])
-
-            custodia = Custodiante.objects.get(id=vertice['custodia_id'])
-
-            quantidade = decimal.Decimal(lista_vertices.loc[ativo]['qtd'].values[0])
-
-            movimentacao = decimal.Decimal(lista_vertices.loc[ativo]['mov'].values[0])
-
-            content_type = ContentType.objects.get_for_id(lista_vertices.loc[ativo]['tipo_objeto_id'].values[0])
-
-            cambio = lista_vertices.loc[ativo]['cambio'].values[0]
-
-            novo_vertice = Vertice(
-                fundo=fundo,
-                custodia=custodia,
-                corretora=corretora,
+        df_cambios = self.buscar_cambios(data_referencia, estado)
+
+        # Um vértice por ativo, custódia e corretora.
+        chave = ['tipo_id', 'custodia_id', 'corretora_id']
+        qtds, casamentos_qtd = self.consolidar_posicoes(carteira_qtd, chave, \
+            'qtd', 'tipo_quantidade_id')
+        movs, casamentos_mov = self.consolidar_posicoes(carteira_mov, chave, \
+            'valor', 'tipo_movimentacao_id')
+        if qtds.empty and movs.empty:
+            return
+
+        # Quantidades e movimentações são inteiros escalados (PontoFixo). O
+        # reindex com fill_value mantém as colunas em int64.
+        indice = qtds.index.union(movs.index)
+        quantidades = qtds['qtd'].reindex(indice, fill_value=0).values.astype(np.int64)
+        movimentacoes = movs['valor'].reindex(indice, fill_value=0).values.astype(np.int64)
+        tipos = movs['tipo_objeto_id'].reindex(indice).\
+            fillna(qtds['tipo_objeto_id'].reindex(indice)).values
+        moedas = movs['moeda'].reindex(indice).fillna(qtds['moeda'].reindex(indice)).values
+
+        # Câmbio da moeda de cada ativo para a moeda do fundo. Ativos sem
+        # câmbio configurado ficam com câmbio 1.
+        cambios = df_cambios['preco_fechamento'].to_dict() if not df_cambios.empty else {}
+
+        # Últimos preços disponíveis de todos os ativos da carteira, em uma
+        # única consulta.
+        ids_ativos = set(indice.get_level_values('tipo_id'))
+        if estado is not None:
+            precos = estado.ultimos_precos(ids_ativos, data_referencia)
+        else:
+            precos = mm.Preco.ultimos_precos(ids_ativos, data_referencia)
+        precos = precos.to_dict('index')
+
+        data = pd.Timestamp(data_referencia).date()
+        ativos = indice.get_level_values('tipo_id')
+        preco_ativos = [precos.get(ativo) for ativo in ativos]
+        datas_preco = [data if preco is None else preco['data_referencia'] \
+            for preco in preco_ativos]
+        # Preços com 6 casas, como o campo de Vertice. Os câmbios entram nos
+        # produtos com as 8 casas do Preco; só o valor, a movimentação e o
+        # câmbio gravado no vértice são arredondados.
+        preco_fechamento = PontoFixo.de_decimais([decimal.Decimal(1) if preco is None \
+            else preco['preco_fechamento'] for preco in preco_ativos], 6)
+        cambio = PontoFixo.de_decimais([cambios.get(moeda, decimal.Decimal('1')) \
+            for moeda in moedas], 8)
+        valores = PontoFixo.multiplicar([preco_fechamento, quantidades, cambio], \
+            [6, 6, 8], 2)
+        movimentacoes = PontoFixo.multiplicar([movimentacoes, cambio], [6, 8], 6)
+        cambio = PontoFixo.multiplicar([cambio], [8], 6)
+
+        colunas = zip(indice, PontoFixo.para_decimais(quantidades, 6), \
+            PontoFixo.para_decimais(movimentacoes, 6), PontoFixo.para_decimais(valores, 2), \
+            PontoFixo.para_decimais(preco_fechamento, 6), PontoFixo.para_decimais(cambio, 6), \
+            tipos, datas_preco)
+        novos_vertices = []
+        for (tipo_id, custodia_id, corretora_id), quantidade, movimentacao, valor, \
+            preco, cambio_ativo, tipo_objeto_id, data_preco in colunas:
+            novos_vertices.append(Vertice(
+                fundo_id=self.id,
+                custodia_id=int(custodia_id),
+                corretora_id=int(corretora_id) or None,
                 quantidade=quantidade,
-                movimentacao=movimentacao*cambio,
-                valor=preco_fechamento*quantidade*cambio,
-                data=vertice['data'].date(),
-                content_type=content_type,
-                object_id=vertice['tipo_id'],
-                preco=preco_fechamento,
-                cambio=cambio
-            )
-            novo_vertice.save()
-            vertice_id = novo_vertice.id
-
-            # Criando os itens de casamento entre quantidade e vértice
-            # Tuplas = (quantidade_id, vertice_id)
-
-            for id in lista_vertices.loc[ativo]['id_qtd'].drop_duplicates():
-                if id != 0:
-                    cas_qtd_vert = CasamentoVerticeQuantidade(
-                        vertice=novo_vertice,
-                        quantidade=Quantidade.objects.get(id=id)
-                    )
-                    cas_qtd_vert.save()
+                movimentacao=movimentacao,
+                valor=valor,
+                data=data,
+                content_type_id=int(tipo_objeto_id),
+                object_id=int(tipo_id),
+                preco=preco,
+                data_preco=data_preco,
+                cambio=cambio_ativo
+            ))
+        Vertice.objects.bulk_create(novos_vertices)
+
+        # Bancos que não devolvem os ids do bulk_create (SQLite) precisam
+        # de uma consulta para encontrar os vértices criados.
+        if any(vertice.id is None for vertice in novos_vertices):
+            ids = dict()
+            for vertice in Vertice.objects.filter(fundo=self, data=data).\
+                order_by('id').values('id', 'object_id', 'custodia_id', 'corretora_id'):
+                ids[(vertice['object_id'], vertice['custodia_id'], \
+                    vertice['corretora_id'])] = vertice['id']
+            for vertice in novos_vertices:
+                vertice.id = ids[(vertice.object_id, vertice.custodia_id, \
+                    vertice.corretora_id)]
+        # As chaves dos casamentos usam SEM_CORRETORA no lugar de None.
+        ids_vertices = {(vertice.object_id, vertice.custodia_id, \
+            vertice.corretora_id or Posicao.SEM_CORRETORA): vertice.id \
+            for vertice in novos_vertices}
+
+        # Criando os itens de casamento entre quantidade e vértice, e entre
+        # movimentação e vértice.
+        CasamentoVerticeQuantidade.objects.bulk_create([
+            CasamentoVerticeQuantidade(vertice_id=ids_vertices[chave_vertice], \
+                quantidade_id=id_qtd) for chave_vertice, id_qtd in casamentos_qtd])
+        CasamentoVerticeMovimentacao.objects.bulk_create([
+            CasamentoVerticeMovimentacao(vertice_id=ids_vertices[chave_vertice], \
+                movimentacao_id=id_mov) for chave_vertice, id_mov in casamentos_mov])
 
-            for id in lista_vertices.loc[ativo]['id_mov'].drop_duplicates():
-                if id != 0:
-                    cas_mov_vert = CasamentoVerticeMovimentacao(
-                        vertice=novo_vertice,
-                        movimentacao=Movimentacao.objects.get(id=id)
-                    )
-                    cas_mov_vert.save()
-
-    def buscar_cambios(self, data_referencia):
+    @staticmethod
+    def consolidar_posicoes(carteira, chave, campo, campo_tipo):
+        """ DataFrame, list, str, str -> (DataFrame, list)
+        Consolida as quantidades ou movimentações da carteira pela chave,
+        descartando as posições zeradas. Retorna o dataframe consolidado,
+        indexado pela chave, com o valor consolidado em inteiros escalados
+        (PontoFixo, 6 casas), o tipo do objeto e a moeda, e a lista de
+        casamentos (chave, id) das linhas que compõem as posições não
+        zeradas. Linhas com id 0 vêm de Posicao e não possuem casamento.
+        Linhas sem custódia levantam ValueError com os seus ids, e linhas
+        sem corretora formam posições com Posicao.SEM_CORRETORA na chave.
+        """
+        if carteira.empty:
+            vazio = pd.DataFrame(columns=chave + [campo, 'tipo_objeto_id', 'moeda'])
+            vazio[campo] = vazio[campo].astype(np.int64)
+            return vazio.set_index(chave), []
+        carteira = Posicao.preparar_chave(carteira, \
+            'Quantidades' if campo == 'qtd' else 'Movimentações')
+        # Valores de quantidades e movimentações possuem 6 casas decimais.
+        carteira[campo] = PontoFixo.de_decimais(carteira[campo], 6)
+        PontoFixo.verificar_soma(carteira[campo].values)
+        consolidado = carteira.groupby(chave).agg({campo: 'sum', \
+            campo_tipo: 'first', 'moeda': 'first'})
+        consolidado.rename(columns={campo_tipo: 'tipo_objeto_id'}, inplace=True)
+        consolidado = consolidado[consolidado[campo] != 0]
+
+        abertas = set(consolidado.index.tolist())
+        casamentos = []
+        for linha in carteira[carteira['id_x'] != 0][chave + ['id_x']].\
+            drop_duplicates().itertuples(index=False):
+            chave_vertice = tuple(int(valor) for valor in linha[:len(chave)])
+            if chave_vertice in abertas:
+                casamentos.append((chave_vertice, int(linha[-1])))
+        return consolidado, casamentos
+
+    def buscar_cambios(self, data_referencia, estado=None):
         """ date -> DataFrame
         Busca os valores dos cambios na data de referencia. Recebe uma data
         de referência e devolve um dataframe com os câmbios, e os códigos das
-        moedas de origem e destino do câmbio.
+        moedas de origem e destino do câmbio. Com um EstadoFechamento, a
+        configuração de câmbios do fundo é lida uma única vez.
         """
         import configuracao.models as cm
         import mercado.models as mm
         import ativos.models as am
 
-        # Buscando os câmbios do dia
-        configuracao = cm.ConfigCambio.objects.get(fundo=self)
-
-        cambios_padrao = configuracao.cambio.all()
+        if estado is not None and estado.cambios is not None:
+            cambios_padrao, df_cambios = estado.cambios
+        else:
+            # Buscando os câmbios do dia
+            configuracao = cm.ConfigCambio.objects.get(fundo=self)
+            cambios_padrao = list(configuracao.cambio.all())
+            # Pegando todos os ativos do tipo cambio
+            cambios = am.Cambio.objects.all()
+            df_cambios = pd.DataFrame(list(cambios.values('id', 'moeda_origem',\
+                'moeda_destino')))
+            df_cambios.set_index('id', inplace=True)
+            if estado is not None:
+                estado.cambios = (cambios_padrao, df_cambios)
         # Preço de fechamento dos cambios padrões na data referencia
         preco_cambios = mm.Preco.objects.filter(ativo__in=cambios_padrao, \
             data_referencia=data_referencia).exclude(preco_fechamento=None)
         df_precos = pd.DataFrame(list(preco_cambios.values('ativo',\
             'preco_fechamento')))
         df_precos.set_index('ativo', inplace=True)
-        # Pegando todos os ativos do tipo cambio
-        cambios = am.Cambio.objects.all()
-        df_cambios = pd.DataFrame(list(cambios.values('id', 'moeda_origem',\
-            'moeda_destino')))
-        df_cambios.set_index('id', inplace=True)
         df_preco_cambios = df_cambios.join(df_precos, how='inner')
         df_preco_cambios.set_index('moeda_origem', inplace=True)
         return df_preco_cambios
@@ -885,9 +967,6 @@ class Fundo(BaseModel):
         v_ativos = vertices.merge(ativos, left_on='object_id', right_on='id').drop(['object_id'], axis=1)
         v_cpr = vertices.merge(boletas, left_on='object_id', right_on='id').drop(['object_id'], axis=1)
 
-        import pdb
-        pdb.set_trace()
-
         # print('LISTA DE VÉRTICES:')
         # vertices = vertices.merge(boletas, left_on='object_id', right_on='id').drop(['id'], axis=1)
         return vertices
@@ -897,46 +976,328 @@ class Fundo(BaseModel):
         Dada uma data, busca os vértices relevantes para a data, calcula o PL
         e a cota do dia.
         """
-        vertices = self.consolidar_vertices(data_referencia)
-        carteira = Carteira()
-        carteira.inicializar(vertices)
-        carteira.save()
+        Carteira.calcular_carteiras(data_referencia, [self])
 
     def reprocessar_cota(self, data_referencia):
+        """ date -> list
+        Reprocessa o fundo a partir de uma data já fechada, sem refazer todo
+        o histórico: desfaz o fechamento da data em diante com
+        desfazer_fechamento e fecha novamente, em ordem, os dias até a última
+        data fechada. As carteiras apagadas são recalculadas. Tudo ocorre em
+        uma única transação, com a trava de travar_fechamento. Retorna os dias
+        fechados novamente, ou None se o fundo estiver sendo fechado por
+        outro processo.
+        """
+        from django.db import transaction
+        ultima = self.ultima_data_fechada()
+        if ultima is None or data_referencia > ultima:
+            return []
+        with transaction.atomic():
+            if self.travar_fechamento(data_referencia) == False:
+                return None
+            datas_carteira = list(Carteira.objects.filter(fundo=self, \
+                data__gte=data_referencia).values_list('data', flat=True))
+            self.desfazer_fechamento(data_referencia)
+            dias = self.fechar_fundo_periodo(data_referencia, ultima)
+            for data in datas_carteira:
+                Carteira.calcular_carteiras(data, [self])
+        return dias
+
+    def desfazer_fechamento(self, data_referencia):
+        """ date -> None
+        Processo inverso do fechamento, a partir da data de referência,
+        inclusive. Segue a linhagem dos objetos criados no fechamento e apaga
+        apenas o que foi derivado dele, em operações de conjunto:
+            1) Carteiras, casamentos, vértices e posições.
+            2) Quantidades e movimentações criadas por boletas, guardando as
+            boletas de origem.
+            3) CPRs e provisões criados pelas boletas de origem, com data de
+            início ou de pagamento a partir da data, suas parcelas nos valores
+            compensados, e provisões de zeragem. Provisões mantidas voltam a
+            ficar pendentes.
+            4) Certificados gerados ou consumidos pelas boletas de passivo
+            cotizadas a partir da data, da mais recente à mais antiga.
+            5) Estado das boletas de fundo offshore e pendências de
+            fechamento das boletas.
+        Os dados das boletas de operação não são alterados, apenas seu estado
+        e sua pendência. Deve ser chamado dentro de uma transação.
+        """
+        import boletagem.models as bm
+
+        Carteira.objects.filter(fundo=self, data__gte=data_referencia).delete()
+        vertices = Vertice.objects.filter(fundo=self, data__gte=data_referencia)
+        CasamentoVerticeQuantidade.objects.filter(vertice__in=vertices).delete()
+        CasamentoVerticeMovimentacao.objects.filter(vertice__in=vertices).delete()
+        vertices.delete()
+        Posicao.objects.filter(fundo=self, data__gte=data_referencia).delete()
+
+        # Quantidades de proventos não são refeitas pelo fechamento.
+        quantidades = Quantidade.objects.filter(fundo=self, \
+            data__gte=data_referencia, content_type__app_label='boletagem')
+        movimentacoes = Movimentacao.objects.filter(fundo=self, \
+            data__gte=data_referencia, content_type__app_label='boletagem')
+        origens = set(quantidades.values_list('content_type_id', 'object_id'))
+        origens |= set(movimentacoes.values_list('content_type_id', 'object_id'))
+        quantidades.delete()
+        movimentacoes.delete()
+
+        passivos = bm.BoletaPassivo.objects.filter(fundo=self).filter( \
+            models.Q(data_cotizacao__gte=data_referencia) | \
+            models.Q(data_liquidacao__gte=data_referencia))
+        tipo_passivo = ContentType.objects.get_for_model(bm.BoletaPassivo).id
+        origens |= {(tipo_passivo, id) for id in passivos.values_list('id', flat=True)}
+
+        por_tipo = {}
+        for tipo, id in origens:
+            por_tipo.setdefault(tipo, []).append(id)
+        zeragem = models.Q(estado=bm.BoletaProvisao.ESTADO[2][0], \
+            content_type__isnull=True, descricao__startswith="Zeragem ")
+        derivadas = models.Q(pk__in=[])
+        for tipo, ids in por_tipo.items():
+            derivadas |= models.Q(content_type_id=tipo, object_id__in=ids)
+        bm.desfazer_compensacoes(self, derivadas, data_referencia)
+        bm.BoletaProvisao.objects.filter(derivadas | zeragem, fundo=self, \
+            data_pagamento__gte=data_referencia).delete()
+        bm.BoletaProvisao.objects.filter(fundo=self, data_pagamento__gte=data_referencia, \
+            estado=bm.BoletaProvisao.ESTADO[1][0]).update(estado=bm.BoletaProvisao.ESTADO[0][0])
+        bm.BoletaCPR.objects.filter(derivadas, fundo=self, \
+            data_inicio__gte=data_referencia).delete()
+
+        for boleta in passivos.filter(data_cotizacao__gte=data_referencia).\
+            order_by('-data_cotizacao', '-id'):
+            boleta.desfazer_certificado()
+
+        tipo_offshore = ContentType.objects.get_for_model(bm.BoletaFundoOffshore).id
+        for boleta in bm.BoletaFundoOffshore.objects.filter(fundo=self).filter( \
+            models.Q(data_cotizacao__gte=data_referencia) | \
+            models.Q(data_liquidacao__gte=data_referencia) | \
+            models.Q(id__in=por_tipo.get(tipo_offshore, []))):
+            boleta.reabrir(data_referencia)
+
+        for modelo in (bm.BoletaAcao, bm.BoletaRendaFixaLocal, bm.BoletaRendaFixaOffshore, \
+            bm.BoletaFundoLocal, bm.BoletaFundoOffshore, bm.BoletaEmprestimo, \
+            bm.BoletaCambio, bm.BoletaCPR, bm.BoletaProvisao, bm.BoletaPassivo):
+            modelo.reabrir_pendencias(self, data_referencia)
+
+class PontoFixo(object):
+    """
+    Aritmética decimal exata sobre arrays de inteiros escalados. Um valor com
+    n casas decimais é guardado como o inteiro valor * 10^n em um array
+    int64, de modo que somas e agrupamentos rodam em código vetorizado do
+    NumPy/pandas ao invés de objetos Decimal. Produtos são calculados em
+    precisão estendida (inteiros de até 192 bits, emulados com limbs de 32
+    bits) e arredondados uma única vez, com ROUND_HALF_EVEN, como o quantize
+    dos Decimal e dos DecimalField. A conversão para Decimal só é feita na
+    fronteira com os modelos.
+    """
+    BASE = np.uint64(2**32)
+    MASCARA = np.uint64(2**32 - 1)
+    # Maior potência de 10 usada em cada passo da divisão, menor que 2^32.
+    PASSO_DIVISAO = 9
+    LIMITE = 2**63
+
+    @staticmethod
+    def de_decimais(valores, casas):
+        """ iterable Decimal, int -> np.ndarray
+        Converte os valores para inteiros escalados por 10^casas,
+        arredondando com ROUND_HALF_EVEN. Valores vazios viram zero.
+        """
+        inteiros = []
+        for valor in valores:
+            if valor is None or (isinstance(valor, float) and np.isnan(valor)):
+                inteiros.append(0)
+                continue
+            inteiro = int(decimal.Decimal(valor).scaleb(casas).\
+                to_integral_value(rounding=decimal.ROUND_HALF_EVEN))
+            if abs(inteiro) >= PontoFixo.LIMITE:
+                raise OverflowError('Valor %s não cabe em ponto fixo com %s casas.' % (valor, casas))
+            inteiros.append(inteiro)
+        return np.array(inteiros, dtype=np.int64)
+
+    @staticmethod
+    def para_decimais(inteiros, casas):
+        """ np.ndarray, int -> list
+        Converte inteiros escalados por 10^casas de volta para Decimal, com
+        exatamente o número de casas informado.
+        """
+        return [decimal.Decimal(int(inteiro)).scaleb(-casas) for inteiro in inteiros]
+
+    @staticmethod
+    def somar(valores):
+        """ np.ndarray -> int
+        Soma inteiros escalados, verificando o limite do int64.
+        """
+        PontoFixo.verificar_soma(valores)
+        return int(np.sum(valores, dtype=np.int64))
+
+    @staticmethod
+    def verificar_soma(valores):
+        """ np.ndarray -> None
+        Levanta OverflowError se a soma dos valores puder passar do limite do
+        int64, que o NumPy não verifica.
         """
-        Na ordem do fechamento, atualizar as boletas de CPR, provisão,
-        Quantidades, Movimentações e Vértices com data igual à data de
-        referencia.
-
-        REPROCESSAMENTO ALTERNATIVO: DELETAR TUDO E REFAZER:
-
-        Dada uma data de referência, para reprocessar a cota, é necessário
-        fazer o processo inverso do fechamento.
-        Na ordem:
-            1) Deletar a Carteira.
-            2) Deletar os vértices com data igual à data de referência.
-            3) A partir das boletas de provisão:
-                1) Buscar as quantidades criadas e deletá-las
-                2) Buscar as movimentações criadas e deleta-las
-            4) A partir das boletas de CPR:
-                1) (Os vértices criados já foram deletados no passo anterior)
-            5) A partir das boletas de passivo:
-                Em caso de aporte:
-                    1) Apagar o certificado de passivo criado e ligado à boleta
-                Em caso de resgate: A partir da diferença do número de cotas
-                da carteira do dia anterior ao resgate e posterior ao resgtate,
-                conseguimos o número de cotas resgatadas. Desfaz o resgate,
-                reatribuindo cotas aos certificados ligados à boleta de passivo,
-                partindo do certificado mais recente até o mais antigo.
-                Em caso de resgate total: A partir da quantidade de cotas da
-                carteira anterior, conseguimos o número de cotas resgatadas.
-                Então fazemos como um resgate normal.
-                    2) Apagar as boletas de provisão e CPR criadas.
-            6) Apaga boletas de passivo que possuam content_object ligadas a
-            ela, pois são boletas frutos do fechamento de outras boletas.
-            7)
-        """
-        pass
+        if np.abs(np.asarray(valores, dtype=np.float64)).sum() >= PontoFixo.LIMITE / 2:
+            raise OverflowError('Soma em ponto fixo excede o limite do int64.')
+
+    @staticmethod
+    def multiplicar(fatores, casas_fatores, casas_resultado):
+        """ list np.ndarray, list int, int -> np.ndarray
+        Multiplica elemento a elemento os arrays de inteiros escalados e
+        arredonda o produto exato para casas_resultado casas decimais com
+        ROUND_HALF_EVEN. Levanta OverflowError se o resultado não couber em
+        int64.
+        """
+        fatores = [np.asarray(fator, dtype=np.int64) for fator in fatores]
+        deslocamento = sum(casas_fatores) - casas_resultado
+        if deslocamento < 0 or deslocamento > 18:
+            raise ValueError('Diferença de casas decimais não suportada: %s' % deslocamento)
+        negativo = np.zeros(fatores[0].shape, dtype=bool)
+        limbs = None
+        for fator in fatores:
+            negativo ^= fator < 0
+            absoluto = np.abs(fator).astype(np.uint64)
+            if limbs is None:
+                limbs = [absoluto & PontoFixo.MASCARA, absoluto >> np.uint64(32)]
+            else:
+                limbs = PontoFixo._multiplicar_limbs(limbs, absoluto)
+
+        # Divisão por 10^deslocamento em passos menores que 2^32. O resto
+        # total é acumulado para o arredondamento.
+        resto = np.zeros(fatores[0].shape, dtype=np.uint64)
+        divisor_acumulado = 1
+        while deslocamento > 0:
+            passo = min(deslocamento, PontoFixo.PASSO_DIVISAO)
+            limbs, resto_passo = PontoFixo._dividir_limbs(limbs, 10**passo)
+            resto = resto + resto_passo * np.uint64(divisor_acumulado)
+            divisor_acumulado *= 10**passo
+            deslocamento -= passo
+
+        # O resultado precisa caber em 63 bits.
+        if any((limb != 0).any() for limb in limbs[2:]) or \
+            (limbs[1] >= np.uint64(2**31)).any():
+            raise OverflowError('Produto em ponto fixo excede o limite do int64.')
+        quociente = (limbs[0] | (limbs[1] << np.uint64(32))).astype(np.int64)
+
+        # ROUND_HALF_EVEN
+        dobro = resto * np.uint64(2)
+        divisor = np.uint64(divisor_acumulado)
+        arredonda = (dobro > divisor) | ((dobro == divisor) & (quociente % 2 == 1))
+        quociente = quociente + arredonda.astype(np.int64)
+        return np.where(negativo, -quociente, quociente)
+
+    @staticmethod
+    def _multiplicar_limbs(limbs, fator):
+        """
+        Multiplica um inteiro em limbs de 32 bits por um uint64 menor que
+        2^63. Cada produto parcial de 32x32 bits mais o transporte cabe em
+        64 bits.
+        """
+        partes = (fator & PontoFixo.MASCARA, fator >> np.uint64(32))
+        resultado = [np.zeros(fator.shape, dtype=np.uint64) for _ in range(len(limbs) + 2)]
+        for deslocamento, parte in enumerate(partes):
+            transporte = np.zeros(fator.shape, dtype=np.uint64)
+            for i, limb in enumerate(limbs):
+                total = limb * parte + transporte + resultado[i + deslocamento]
+                # limb * parte <= (2^32 - 1)^2, então a soma com dois valores
+                # menores que 2^32 não transborda.
+                resultado[i + deslocamento] = total & PontoFixo.MASCARA
+                transporte = total >> np.uint64(32)
+            j = len(limbs) + deslocamento
+            while j < len(resultado):
+                total = resultado[j] + transporte
+                resultado[j] = total & PontoFixo.MASCARA
+                transporte = total >> np.uint64(32)
+                j += 1
+        while len(resultado) > 2 and not resultado[-1].any():
+            resultado.pop()
+        return resultado
+
+    @staticmethod
+    def _dividir_limbs(limbs, divisor):
+        """
+        Divide um inteiro em limbs de 32 bits por um divisor menor que 2^32,
+        retornando o quociente em limbs e o resto.
+        """
+        divisor = np.uint64(divisor)
+        quociente = [None] * len(limbs)
+        resto = np.zeros(limbs[0].shape, dtype=np.uint64)
+        for i in reversed(range(len(limbs))):
+            atual = (resto << np.uint64(32)) | limbs[i]
+            quociente[i] = atual // divisor
+            resto = atual % divisor
+        return quociente, resto
+
+class EstadoFechamento(object):
+    """
+    Estado de um fechamento de vários dias seguidos de um mesmo fundo,
+    levado em memória de um dia para o outro por Fundo.fechar_fundo_periodo:
+        - Quantidades já carregadas, com custódia e corretora resolvidas,
+        por tipo de ativo. A cada dia, só as quantidades criadas desde a
+        última carga ou com data posterior ao dia anterior são buscadas.
+        - Configuração de câmbios do fundo.
+        - Último preço conhecido de cada ativo da carteira, atualizado apenas
+        com os preços do período entre o dia anterior e o dia fechado. Os
+        ativos que não estavam na carteira do dia anterior são consultados
+        por inteiro.
+    """
+    def __init__(self, fundo):
+        self.fundo = fundo
+        # tipo de ativo -> (DataFrame de quantidades, maior id, data da carga)
+        self.quantidades = {}
+        self.cambios = None
+        self.precos = None
+        self.data_precos = None
+
+    def quantidades_novas(self, quantidades, tipo, data_referencia):
+        """ QuerySet, ContentType, date -> QuerySet
+        Restringe as quantidades às que ainda não foram carregadas.
+        """
+        if tipo.id not in self.quantidades:
+            return quantidades
+        _, maior_id, data_carga = self.quantidades[tipo.id]
+        return quantidades.filter(models.Q(id__gt=maior_id) | models.Q(data__gt=data_carga))
+
+    def acumular_quantidades(self, tipo, novas, data_referencia):
+        """ ContentType, DataFrame, date -> DataFrame
+        Junta as quantidades novas às já carregadas e retorna todas elas.
+        """
+        anteriores, maior_id, _ = self.quantidades.get(tipo.id, (pd.DataFrame(), 0, None))
+        if novas.empty:
+            todas = anteriores
+        else:
+            todas = pd.concat([anteriores, novas], sort=False).\
+                drop_duplicates('id_x', keep='last').reset_index(drop=True)
+            maior_id = max(maior_id, int(novas['id_x'].max()))
+        self.quantidades[tipo.id] = (todas, maior_id, data_referencia)
+        return todas.copy()
+
+    def ultimos_precos(self, ativos, data_referencia):
+        """ iterable int, date -> DataFrame
+        Equivalente ao Preco.ultimos_precos, partindo dos preços do dia
+        anterior.
+        """
+        import mercado.models as mm
+        ativos = set(ativos)
+        if self.precos is None:
+            self.precos = mm.Preco.ultimos_precos(ativos, data_referencia)
+        else:
+            conhecidos = ativos & set(self.precos.index)
+            novos = ativos - conhecidos
+            recentes = mm.Preco.objects.filter(ativo__in=conhecidos,
+                data_referencia__gt=self.data_precos,
+                data_referencia__lte=data_referencia).exclude(preco_fechamento=None).\
+                order_by('data_referencia')
+            recentes = mm.Preco._dataframe_precos(recentes, 'preco_fechamento')
+            recentes = recentes[~recentes.index.duplicated(keep='last')]
+            partes = [self.precos.drop(recentes.index), recentes]
+            if novos:
+                partes.append(mm.Preco.ultimos_precos(novos, data_referencia))
+            self.precos = pd.concat(partes, sort=False)
+        # Só os ativos pedidos ficam atualizados até a data. Um ativo que
+        # saia da carteira e volte é buscado de novo, como os novos.
+        self.precos = self.precos[self.precos.index.isin(ativos)]
+        self.data_precos = data_referencia
+        return self.precos
 
 class Administradora(models.Model):
     """
@@ -1109,6 +1470,32 @@ class Carteira(BaseModel):
         ordering = ['fundo']
         verbose_name_plural = 'Carteiras'
 
+    def calcular(self, df_vertices):
+        """
+        Calcula a data, o PL, a movimentação e a cota da carteira a partir
+        dos vértices, sem salvar. O dataFrame segue o formato de inicializar.
+        Se o fundo ainda não possuir cotas, a cota fica vazia.
+        """
+        # Como no agrupamento por fundo e data, vale o primeiro par.
+        fundo = df_vertices['fundo'].min()
+        df_vertices = df_vertices[df_vertices['fundo'] == fundo]
+        self.data = df_vertices['data'].min()
+        df_vertices = df_vertices[df_vertices['data'] == self.data]
+        self.fundo = Fundo.objects.get(id=fundo)
+        # Somas exatas em ponto fixo, arredondadas para 2 casas com
+        # ROUND_HALF_EVEN.
+        valor = PontoFixo.somar(PontoFixo.de_decimais(df_vertices['valor'], 2))
+        movimentacao = PontoFixo.somar(PontoFixo.de_decimais(df_vertices['movimentacao'], 6))
+        self.pl = PontoFixo.para_decimais([valor], 2)[0]
+        self.movimentacao = PontoFixo.para_decimais(PontoFixo.multiplicar( \
+            [np.array([movimentacao])], [6], 2), 2)[0]
+        # Buscar todos os certificados para ver quantas cotas o fundo possui
+        total_cotas = CertificadoPassivo.total_cotas_aplicadas(fundo=self.fundo,\
+            data_referencia=self.data)
+        self.cota = None
+        if total_cotas:
+            self.cota = decimal.Decimal(self.pl/total_cotas).quantize(decimal.Decimal('1.00000000'))
+
     def inicializar(self, df_vertices):
         """
         Recebe os vértices de um fundo, e cria a carteira. O dataFrame deve
@@ -1117,27 +1504,57 @@ class Carteira(BaseModel):
         movimentação ('movimentacao')
         """
 
-        consolidado = df_vertices.groupby(['fundo', 'data'])[['valor', \
-            'movimentacao']].sum()
-        consolidado.reset_index(inplace=True)
-        self.data = consolidado['data'][0]
-        self.fundo = Fundo.objects.get(id=consolidado['fundo'][0])
-        self.pl = decimal.Decimal(consolidado['valor'][0]).quantize(decimal.Decimal('1.00'))
-        self.movimentacao = decimal.Decimal(consolidado['movimentacao'][0]).quantize(decimal.Decimal('1.00'))
-        # Buscar todos os certificados para ver quantas cotas o fundo possui
-        total_cotas = CertificadoPassivo.total_cotas_aplicadas(fundo=self.fundo,\
-            data_referencia=self.data)
-        self.cota = decimal.Decimal(self.pl/total_cotas).quantize(decimal.Decimal('1.00000000'))
-
+        self.calcular(df_vertices)
         self.save()
         vertices = Vertice.objects.filter(fundo=self.fundo, data=self.data)
-        for vertice in vertices:
-            self.vertices.add(vertice)
-
-        import pdb
-        pdb.set_trace()
+        Carteira.vertices.through.objects.bulk_create([
+            Carteira.vertices.through(carteira_id=self.id, vertice_id=vertice)
+            for vertice in vertices.values_list('id', flat=True)])
 
-        self.save()
+    @staticmethod
+    def calcular_carteiras(data_referencia, fundos=None):
+        """ date, list -> int
+        Cria, na data de referência, as carteiras de todos os fundos com
+        vértices na data (ou apenas dos fundos informados), em um número fixo
+        de consultas: o PL e a movimentação vêm de uma agregação dos vértices
+        por fundo, o total de cotas de uma agregação dos certificados de
+        passivo, e as carteiras e suas ligações com os vértices são inseridas
+        em lote. Carteiras já existentes na data são substituídas. Fundos sem
+        cotas aplicadas não têm cota e ficam sem carteira. Retorna o número de
+        carteiras criadas.
+        """
+        from django.db import transaction
+        vertices = Vertice.objects.filter(data=data_referencia)
+        if fundos is not None:
+            vertices = vertices.filter(fundo__in=fundos)
+        totais = list(vertices.order_by().values('fundo').annotate( \
+            pl=Sum('valor'), movimentacao=Sum('movimentacao')))
+        ids = [total['fundo'] for total in totais]
+        cotas = dict(CertificadoPassivo.objects.filter(fundo__in=ids, \
+            data__lte=data_referencia).order_by().values('fundo').annotate( \
+            total=Sum('cotas_aplicadas')).values_list('fundo', 'total'))
+        carteiras = []
+        for total in totais:
+            if not cotas.get(total['fundo']):
+                continue
+            pl = decimal.Decimal(total['pl']).quantize(decimal.Decimal('1.00'), \
+                rounding=decimal.ROUND_HALF_EVEN)
+            carteiras.append(Carteira(fundo_id=total['fundo'], data=data_referencia,
+                pl=pl,
+                movimentacao=decimal.Decimal(total['movimentacao']).quantize( \
+                    decimal.Decimal('1.00'), rounding=decimal.ROUND_HALF_EVEN),
+                cota=(pl/cotas[total['fundo']]).quantize(decimal.Decimal('1.00000000'))))
+        with transaction.atomic():
+            Carteira.objects.filter(fundo__in=ids, data=data_referencia).delete()
+            Carteira.objects.bulk_create(carteiras)
+            # bulk_create não devolve os ids em todos os bancos.
+            ids_carteiras = dict(Carteira.objects.filter(fundo__in=ids, \
+                data=data_referencia).values_list('fundo', 'id'))
+            Carteira.vertices.through.objects.bulk_create([
+                Carteira.vertices.through(carteira_id=ids_carteiras[fundo], vertice_id=vertice)
+                for vertice, fundo in vertices.filter(fundo__in=list(ids_carteiras)).\
+                    values_list('id', 'fundo')])
+        return len(carteiras)
 
     def pl_nao_gerido(self, data_referencia):
         """
@@ -1256,6 +1673,15 @@ class Quantidade(BaseModel):
     tipo_id = models.PositiveIntegerField()
     objeto_quantidade = GenericForeignKey('tipo_quantidade', 'tipo_id')
 
+    # Custódia, corretora e ativo desnormalizados a partir da boleta, para
+    # que as posições possam ser agregadas sem percorrer as boletas.
+    custodia = models.ForeignKey('Custodiante', null=True, blank=True,
+        on_delete=models.PROTECT, related_name='quantidades')
+    corretora = models.ForeignKey('Corretora', null=True, blank=True,
+        on_delete=models.PROTECT, related_name='quantidades')
+    ativo = models.ForeignKey('ativos.Ativo', null=True, blank=True,
+        on_delete=models.PROTECT, related_name='quantidades')
+
     def __str__(self):
         return 'Ativo: %s' % (self.content_object.__str__()) + \
             '\nQuantidade: %s' % (self.qtd)
@@ -1283,9 +1709,143 @@ class Movimentacao(BaseModel):
     tipo_id = models.PositiveIntegerField()
     objeto_movimentacao = GenericForeignKey('tipo_movimentacao', 'tipo_id')
 
+    # Custódia, corretora e ativo desnormalizados a partir da boleta, para
+    # que as posições possam ser agregadas sem percorrer as boletas.
+    custodia = models.ForeignKey('Custodiante', null=True, blank=True,
+        on_delete=models.PROTECT, related_name='movimentacoes')
+    corretora = models.ForeignKey('Corretora', null=True, blank=True,
+        on_delete=models.PROTECT, related_name='movimentacoes')
+    ativo = models.ForeignKey('ativos.Ativo', null=True, blank=True,
+        on_delete=models.PROTECT, related_name='movimentacoes')
+
     def __str__(self):
         return '%s' % (self.content_object.__str__())
 
+class Posicao(models.Model):
+    """
+    Fotografia das posições em aberto de um fundo em uma data, consolidadas
+    por ativo, custódia e corretora. A posição de uma data é gerada a partir
+    da posição anterior mais as quantidades do período, de modo que o
+    fechamento lê apenas as posições em aberto, qualquer que seja a idade
+    do fundo. Alterações em quantidades apagam as posições a partir da data
+    alterada, que são regeneradas nos próximos fechamentos.
+    """
+    fundo = models.ForeignKey('Fundo', on_delete=models.CASCADE)
+    data = models.DateField()
+    tipo_quantidade = models.ForeignKey(ContentType, on_delete=models.PROTECT,
+        related_name='posicao_ativo')
+    tipo_id = models.PositiveIntegerField()
+    objeto_quantidade = GenericForeignKey('tipo_quantidade', 'tipo_id')
+    custodia = models.ForeignKey('Custodiante', on_delete=models.PROTECT)
+    # Como nos vértices, a posição pode não ter corretora.
+    corretora = models.ForeignKey('Corretora', on_delete=models.PROTECT, \
+        blank=True, null=True)
+    qtd = models.DecimalField(decimal_places=6, max_digits=20)
+
+    # Corretora vazia nas chaves dos DataFrames, já que o agrupamento do
+    # pandas descarta as chaves nulas.
+    SEM_CORRETORA = 0
+
+    class Meta:
+        unique_together = (('fundo', 'data', 'tipo_quantidade', 'tipo_id', \
+            'custodia', 'corretora'),)
+        verbose_name_plural = 'Posições'
+
+    def __str__(self):
+        return '%s - %s: %s' % (self.fundo, self.data, self.qtd)
+
+    @staticmethod
+    def preparar_chave(carteira, nome='Quantidades'):
+        """ DataFrame, str -> DataFrame
+        Prepara a custódia e a corretora das linhas para o agrupamento em
+        posições. Linhas sem custódia não formam posição nem vértice, e
+        levantam ValueError com os seus ids (coluna id_x). Linhas sem
+        corretora formam uma posição sem corretora, com SEM_CORRETORA na
+        chave.
+        """
+        sem_custodia = carteira['custodia_id'].isnull()
+        if sem_custodia.any():
+            ids = carteira.loc[sem_custodia, 'id_x'] if 'id_x' in carteira.columns else []
+            raise ValueError('%s sem custódia: %s' % (nome, sorted(int(id) for id in ids)))
+        carteira = carteira.copy()
+        carteira['custodia_id'] = carteira['custodia_id'].astype(np.int64)
+        carteira['corretora_id'] = carteira['corretora_id'].\
+            fillna(Posicao.SEM_CORRETORA).astype(np.int64)
+        return carteira
+
+    @staticmethod
+    def quantidades(fundo, data_posicao, data_referencia):
+        """ Fundo, date, date -> DataFrame
+        Retorna as posições do fundo na data da posição no mesmo formato das
+        quantidades de Fundo.juntar_quantidades_ativo. As linhas não
+        correspondem a uma quantidade específica, então seu id é 0.
+        """
+        import ativos.models as am
+        posicoes = pd.DataFrame(list(Posicao.objects.filter(fundo=fundo, \
+            data=data_posicao).values('tipo_id', 'qtd', 'fundo', \
+            'tipo_quantidade_id', 'custodia_id', 'corretora_id')))
+        if posicoes.empty:
+            return pd.DataFrame()
+        ativos = pd.DataFrame(list(am.Ativo.objects.filter(id__in=\
+            posicoes['tipo_id'].tolist()).values('id', 'nome', 'moeda')))
+        posicoes = posicoes.merge(ativos, right_on='id', left_on='tipo_id').\
+            drop(['id'], axis=1)
+        posicoes['id_x'] = 0
+        posicoes['data'] = data_referencia
+        return posicoes
+
+    @staticmethod
+    def gravar(fundo, data_referencia, quantidades):
+        """ Fundo, date, DataFrame -> None
+        Consolida as quantidades e grava as posições em aberto do fundo na
+        data de referência, substituindo as existentes.
+        """
+        from django.db import transaction
+        colunas = ['tipo_quantidade_id', 'tipo_id', 'custodia_id', 'corretora_id']
+        posicoes = []
+        if not quantidades.empty:
+            quantidades = Posicao.preparar_chave(quantidades)
+            quantidades = quantidades[colunas].assign(qtd=PontoFixo.\
+                de_decimais(quantidades['qtd'], 6))
+            PontoFixo.verificar_soma(quantidades['qtd'].values)
+            consolidado = quantidades.groupby(colunas)['qtd'].sum()
+            consolidado = consolidado[consolidado != 0]
+            for chave, qtd in zip(consolidado.index, \
+                PontoFixo.para_decimais(consolidado.values, 6)):
+                chave = dict(zip(colunas, (int(valor) for valor in chave)))
+                if chave['corretora_id'] == Posicao.SEM_CORRETORA:
+                    chave['corretora_id'] = None
+                posicoes.append(Posicao(fundo=fundo, data=data_referencia, \
+                    qtd=qtd, **chave))
+        with transaction.atomic():
+            Posicao.objects.filter(fundo=fundo, data=data_referencia).delete()
+            Posicao.objects.bulk_create(posicoes)
+
+    @staticmethod
+    def reconstruir(fundo, datas):
+        """ Fundo, iterable date -> int
+        Regenera as posições do fundo nas datas informadas diretamente das
+        quantidades, sem partir de posições anteriores. Usado em auditorias.
+        As posições das demais datas são mantidas. Retorna a quantidade de
+        posições gravadas.
+        """
+        colunas = ['tipo_quantidade_id', 'tipo_id', 'custodia_id', 'corretora_id']
+        datas = sorted(set(datas))
+        if not datas:
+            return 0
+        # As somas por chave não guardam os ids das quantidades.
+        sem_custodia = list(Quantidade.objects.filter(fundo=fundo, custodia=None, \
+            data__lte=datas[-1]).order_by('id').values_list('id', flat=True))
+        if sem_custodia:
+            raise ValueError('Quantidades sem custódia: %s' % sem_custodia)
+        gravadas = 0
+        for data in datas:
+            consolidado = pd.DataFrame(list(Quantidade.objects.filter(fundo=fundo, \
+                data__lte=data).values(*colunas).annotate(qtd=Sum('qtd'))))
+            Posicao.gravar(fundo, data, consolidado)
+            gravadas += Posicao.objects.filter(fundo=fundo, data=data).count()
+        return gravadas
+
 class CasamentoVerticeQuantidade(BaseModel):
     """
     Relaciona o ID dos Vértices e das Quantidades, para que seja possível
@@ -1348,8 +1908,192 @@ class CertificadoPassivo(BaseModel):
         """ Fundo, date -> decimal
         Dado um fundo, e uma data, busca o total de cotas aplicadas no fundo
         """
-        certificados = CertificadoPassivo.objects.filter(fundo=fundo, \
-            data__lte=data_referencia)
-        df_cert = pd.DataFrame(list(certificados.values('data', 'fundo', \
-            'cotas_aplicadas')))
-        return df_cert.groupby(['data','fundo'])['cotas_aplicadas'].sum()[0]
+        total = CertificadoPassivo.objects.filter(fundo=fundo, \
+            data__lte=data_referencia).aggregate(total=Sum('cotas_aplicadas'))['total']
+        return total if total is not None else decimal.Decimal(0)
+
+
+def _fechar_fundo_em_processo(fundo_id, data_referencia):
+    """
+    Executado nos processos do FechamentoFundos. As conexões herdadas do
+    processo pai não podem ser compartilhadas, então são descartadas antes
+    do fechamento.
+    """
+    from django.db import connections
+    connections.close_all()
+    try:
+        fechado = Fundo.objects.get(id=fundo_id).fechar_fundo_exclusivo(data_referencia)
+        return FechamentoFundos.FECHADO if fechado else FechamentoFundos.EM_ANDAMENTO
+    finally:
+        connections.close_all()
+
+class FechamentoFundos(object):
+    """
+    Orquestra o fechamento diário de vários fundos. Um fundo que investe em
+    outro fundo gerido (por meio de um Fundo_Local ou Fundo_Offshore cuja
+    gestão é o fundo investido, ou como cotista, pelo Cotista.fundo_cotista)
+    só é fechado depois do fundo investido, pois depende da sua cota, que
+    fechar_fundo_exclusivo publica como preço do ativo gerido. Fundos
+    independentes entre si são fechados em paralelo, em um pool de processos.
+    """
+    FECHADO = 'Fechado'
+    EM_ANDAMENTO = 'Em andamento em outro processo'
+    DEPENDENCIA_FALHOU = 'Dependência não fechada'
+
+    def __init__(self, fundos=None, processos=None):
+        import os
+        if fundos is None:
+            fundos = Fundo.objects.all()
+        self.fundos = [getattr(fundo, 'id', fundo) for fundo in fundos]
+        self.processos = processos if processos is not None else os.cpu_count()
+
+    def dependencias(self, data_referencia):
+        """ date -> dict
+        Retorna, para cada fundo, o conjunto de fundos geridos em que ele
+        investe na data de referência.
+        """
+        import ativos.models as am
+        import boletagem.models as bm
+        dependencias = {fundo: set() for fundo in self.fundos}
+        # Fundos que possuem cotas de fundos geridos em carteira
+        for modelo in (am.Fundo_Local, am.Fundo_Offshore):
+            geridos = dict(modelo.objects.exclude(gestao=None).values_list('id', 'gestao_id'))
+            if not geridos:
+                continue
+            posicoes = Quantidade.objects.filter(fundo_id__in=self.fundos,
+                data__lte=data_referencia,
+                tipo_quantidade=ContentType.objects.get_for_model(modelo),
+                tipo_id__in=geridos).values('fundo_id', 'tipo_id').\
+                annotate(total=Sum('qtd')).exclude(total=0)
+            for posicao in posicoes:
+                dependencias[posicao['fundo_id']].add(geridos[posicao['tipo_id']])
+        # Fundos que são cotistas de outros fundos
+        cotistas = dict(Cotista.objects.exclude(fundo_cotista=None).\
+            values_list('id', 'fundo_cotista_id'))
+        if cotistas:
+            investidos = set(CertificadoPassivo.objects.filter(cotista_id__in=cotistas,
+                data__lte=data_referencia, cotas_aplicadas__gt=0).\
+                values_list('cotista_id', 'fundo_id'))
+            investidos |= set(bm.BoletaPassivo.objects.filter(cotista_id__in=cotistas,
+                data_cotizacao=data_referencia).values_list('cotista_id', 'fundo_id'))
+            for cotista, fundo in investidos:
+                if cotistas[cotista] in dependencias:
+                    dependencias[cotistas[cotista]].add(fundo)
+        # Apenas dependências entre os fundos sendo fechados importam.
+        for fundo in dependencias:
+            dependencias[fundo] &= set(self.fundos)
+            dependencias[fundo].discard(fundo)
+        return dependencias
+
+    def ordem(self, dependencias):
+        """ dict -> list
+        Ordena topologicamente os fundos. Lança ValueError se houver
+        investimentos circulares.
+        """
+        pendentes = {fundo: set(deps) for fundo, deps in dependencias.items()}
+        ordem = []
+        while pendentes:
+            prontos = sorted(f for f, deps in pendentes.items() if not deps)
+            if not prontos:
+                raise ValueError("Investimento circular entre os fundos: " +
+                    str(sorted(pendentes)))
+            for fundo in prontos:
+                del pendentes[fundo]
+            for deps in pendentes.values():
+                deps.difference_update(prontos)
+            ordem.extend(prontos)
+        return ordem
+
+    def fechar(self, data_referencia):
+        """ date -> dict
+        Fecha todos os fundos na data de referência, respeitando as
+        dependências. Retorna o resultado do fechamento de cada fundo. Se o
+        fechamento de um fundo falhar, os fundos que dependem dele não são
+        fechados.
+        """
+        from django.db import connection
+        dependencias = self.dependencias(data_referencia)
+        ordem = self.ordem(dependencias)
+        # Bancos sqlite não podem ser compartilhados entre processos (e o de
+        # testes fica em memória), então o fechamento é sequencial.
+        if self.processos <= 1 or connection.vendor == 'sqlite':
+            return self._fechar_sequencial(ordem, dependencias, data_referencia)
+        return self._fechar_paralelo(ordem, dependencias, data_referencia)
+
+    def _fechar_sequencial(self, ordem, dependencias, data_referencia):
+        resultados = {}
+        for fundo in ordem:
+            if any(resultados[d] != self.FECHADO for d in dependencias[fundo]):
+                resultados[fundo] = self.DEPENDENCIA_FALHOU
+                continue
+            try:
+                fechado = Fundo.objects.get(id=fundo).fechar_fundo_exclusivo(data_referencia)
+                resultados[fundo] = self.FECHADO if fechado else self.EM_ANDAMENTO
+            except Exception as erro:
+                resultados[fundo] = repr(erro)
+        return resultados
+
+    def _fechar_paralelo(self, ordem, dependencias, data_referencia):
+        from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+        from django.db import connections
+        resultados = {}
+        pendentes = {fundo: set(dependencias[fundo]) for fundo in ordem}
+        # Os processos filhos não podem herdar conexões abertas.
+        connections.close_all()
+        with ProcessPoolExecutor(max_workers=self.processos) as executor:
+            em_execucao = {}
+            while pendentes or em_execucao:
+                prontos = [f for f in ordem if f in pendentes and not pendentes[f]]
+                for fundo in prontos:
+                    del pendentes[fundo]
+                    em_execucao[executor.submit(_fechar_fundo_em_processo, fundo,
+                        data_referencia)] = fundo
+                if not em_execucao:
+                    break
+                concluidos, _ = wait(em_execucao, return_when=FIRST_COMPLETED)
+                for futuro in concluidos:
+                    fundo = em_execucao.pop(futuro)
+                    try:
+                        resultados[fundo] = futuro.result()
+                    except Exception as erro:
+                        resultados[fundo] = repr(erro)
+                    if resultados[fundo] == self.FECHADO:
+                        for deps in pendentes.values():
+                            deps.discard(fundo)
+                    else:
+                        # Os fundos que dependem deste, direta ou
+                        # indiretamente, não podem ser fechados.
+                        falhas = [fundo]
+                        while falhas:
+                            falha = falhas.pop()
+                            for dependente in [f for f, deps in pendentes.items() if falha in deps]:
+                                del pendentes[dependente]
+                                resultados[dependente] = self.DEPENDENCIA_FALHOU
+                                falhas.append(dependente)
+        return resultados
+
+
+"""
+Invalidação das posições
+"""
+
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.dispatch import receiver
+
+@receiver(pre_save, sender=Quantidade)
+def guardar_data_anterior_quantidade(sender, instance, **kwargs):
+    instance._data_anterior = None
+    if instance.pk is not None:
+        instance._data_anterior = Quantidade.objects.filter(pk=instance.pk).\
+            values_list('data', flat=True).first()
+
+@receiver(post_save, sender=Quantidade)
+@receiver(post_delete, sender=Quantidade)
+def invalidar_posicoes(sender, instance, **kwargs):
+    """
+    Apaga as posições do fundo a partir da data da quantidade alterada.
+    """
+    data = instance.data
+    if getattr(instance, '_data_anterior', None) is not None:
+        data = min(data, instance._data_anterior)
+    Posicao.objects.filter(fundo_id=instance.fundo_id, data__gte=data).delete()
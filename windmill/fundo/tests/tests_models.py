@@ -2,11 +2,13 @@ import datetime
 import decimal
 from model_mommy import mommy
 import pytest
+import pandas as pd
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 from django.contrib.contenttypes.fields import GenericForeignKey, GenericRelation
 from django.contrib.contenttypes.models import ContentType
 from django.core.exceptions import ValidationError
-from django.db import models
+from django.db import connection, models
 import ativos.models as am
 import boletagem.models as bm
 import fundo.models as fm
@@ -3488,3 +3490,603 @@ class ItatiaiaTests(TestCase):
         self.itatiaia.criar_vertices(self.data_carteira_3)
         self.itatiaia.consolidar_vertices(self.data_carteira_3)
         self.itatiaia.calcular_cota(self.data_carteira_3)
+
+class FechamentoFundosTests(TestCase):
+    """
+    Testes do grafo de dependências do fechamento de vários fundos.
+    """
+    def setUp(self):
+        self.data = datetime.date(year=2018, month=11, day=14)
+        self.master = mommy.make('fundo.Fundo')
+        self.feeder = mommy.make('fundo.Fundo')
+        self.cotista = mommy.make('fundo.Fundo')
+        self.independente = mommy.make('fundo.Fundo')
+        # O feeder investe no master por meio do ativo de fundo local.
+        ativo_master = mommy.make('ativos.Fundo_Local', gestao=self.master)
+        mommy.make('fundo.Quantidade', fundo=self.feeder, data=self.data,
+            qtd=decimal.Decimal('100'), objeto_quantidade=ativo_master,
+            content_object=ativo_master)
+        # O fundo cotista tem cotas do feeder.
+        cotista = mommy.make('fundo.Cotista', fundo_cotista=self.cotista)
+        mommy.make('fundo.CertificadoPassivo', cotista=cotista, fundo=self.feeder,
+            data=self.data, cotas_aplicadas=decimal.Decimal('10'))
+        self.fechamento = fm.FechamentoFundos([self.master, self.feeder,
+            self.cotista, self.independente])
+
+    def test_dependencias(self):
+        dependencias = self.fechamento.dependencias(self.data)
+        self.assertEqual(dependencias[self.feeder.id], {self.master.id})
+        self.assertEqual(dependencias[self.cotista.id], {self.feeder.id})
+        self.assertEqual(dependencias[self.master.id], set())
+        self.assertEqual(dependencias[self.independente.id], set())
+        # Antes da data das posições, não há dependências.
+        anteriores = self.fechamento.dependencias(self.data - datetime.timedelta(days=1))
+        self.assertEqual(anteriores[self.feeder.id], set())
+
+    def test_ordem(self):
+        ordem = self.fechamento.ordem(self.fechamento.dependencias(self.data))
+        self.assertLess(ordem.index(self.master.id), ordem.index(self.feeder.id))
+        self.assertLess(ordem.index(self.feeder.id), ordem.index(self.cotista.id))
+        with self.assertRaises(ValueError):
+            self.fechamento.ordem({1: {2}, 2: {1}})
+
+    def test_falha_interrompe_dependentes(self):
+        # Sem configurações de câmbio, o fechamento do master falha.
+        fechamento = fm.FechamentoFundos([self.master, self.feeder, self.cotista])
+        resultados = fechamento.fechar(self.data)
+        self.assertNotEqual(resultados[self.master.id], fechamento.FECHADO)
+        self.assertEqual(resultados[self.feeder.id], fechamento.DEPENDENCIA_FALHOU)
+        self.assertEqual(resultados[self.cotista.id], fechamento.DEPENDENCIA_FALHOU)
+
+    def test_investidor_usa_cota_do_fundo_investido(self):
+        import mercado.models as mm
+        custodia = mommy.make('fundo.Custodiante')
+        corretora = mommy.make('fundo.Corretora')
+        master = mommy.make('fundo.Fundo', calendario=mommy.make('calendario.Calendario'))
+        feeder = mommy.make('fundo.Fundo', calendario=mommy.make('calendario.Calendario'))
+        cambio = mommy.make('ativos.Cambio')
+        mommy.make('mercado.Preco', ativo=cambio, data_referencia=self.data,
+            preco_fechamento=decimal.Decimal('3.7'))
+        for fundo in (master, feeder):
+            mommy.make('configuracao.ConfigCambio', fundo=fundo).cambio.add(cambio)
+        # O master tem 100 ações a 10 e 100 cotas: cota de 10.
+        acao = mommy.make('ativos.Acao')
+        mommy.make('mercado.Preco', ativo=acao, data_referencia=self.data,
+            preco_fechamento=decimal.Decimal('10'))
+        mommy.make('fundo.Quantidade', fundo=master, data=self.data,
+            qtd=decimal.Decimal('100'), objeto_quantidade=acao, content_object=acao,
+            custodia=custodia, corretora=corretora, ativo=acao)
+        mommy.make('fundo.CertificadoPassivo', fundo=master, data=self.data,
+            cotas_aplicadas=decimal.Decimal('100'))
+        # O feeder tem 50 cotas do master, ainda sem preço na data.
+        ativo_master = mommy.make('ativos.Fundo_Local', gestao=master)
+        mommy.make('fundo.Quantidade', fundo=feeder, data=self.data,
+            qtd=decimal.Decimal('50'), objeto_quantidade=ativo_master,
+            content_object=ativo_master, custodia=custodia, corretora=corretora,
+            ativo=ativo_master)
+        fechamento = fm.FechamentoFundos([feeder, master])
+        self.assertEqual(fechamento.fechar(self.data),
+            {master.id: fechamento.FECHADO, feeder.id: fechamento.FECHADO})
+        self.assertEqual(mm.Preco.objects.get(ativo=ativo_master,
+            data_referencia=self.data).preco_fechamento, decimal.Decimal('10'))
+        vertice = fm.Vertice.objects.get(fundo=feeder, object_id=ativo_master.id)
+        self.assertEqual(vertice.valor, decimal.Decimal('500'))
+
+class EstadoFechamentoTests(TestCase):
+    """
+    Testes do estado mantido entre os dias de um fechamento por período.
+    """
+    def setUp(self):
+        self.fundo = mommy.make('fundo.Fundo',
+            calendario=mommy.make('calendario.Calendario'))
+        self.acao = mommy.make('ativos.Acao')
+        self.outra = mommy.make('ativos.Acao')
+        self.data = datetime.date(year=2018, month=11, day=14)
+        self.estado = fm.EstadoFechamento(self.fundo)
+
+    def test_ultimos_precos_incrementais(self):
+        mommy.make('mercado.Preco', ativo=self.acao, data_referencia=self.data,
+            preco_fechamento=decimal.Decimal('10'))
+        precos = self.estado.ultimos_precos([self.acao.id], self.data)
+        self.assertEqual(precos.loc[self.acao.id, 'preco_fechamento'], decimal.Decimal('10'))
+        seguinte = self.data + datetime.timedelta(days=1)
+        mommy.make('mercado.Preco', ativo=self.acao, data_referencia=seguinte,
+            preco_fechamento=decimal.Decimal('11'))
+        mommy.make('mercado.Preco', ativo=self.outra, data_referencia=self.data,
+            preco_fechamento=decimal.Decimal('5'))
+        precos = self.estado.ultimos_precos([self.acao.id, self.outra.id], seguinte)
+        self.assertEqual(precos.loc[self.acao.id, 'preco_fechamento'], decimal.Decimal('11'))
+        self.assertEqual(precos.loc[self.acao.id, 'data_referencia'], seguinte)
+        self.assertEqual(precos.loc[self.outra.id, 'preco_fechamento'], decimal.Decimal('5'))
+
+    def test_ultimos_precos_ativo_que_volta_a_carteira(self):
+        mommy.make('mercado.Preco', ativo=self.acao, data_referencia=self.data,
+            preco_fechamento=decimal.Decimal('10'))
+        self.estado.ultimos_precos([self.acao.id], self.data)
+        # A ação fica fora da carteira no dia seguinte, mas tem preço nele.
+        seguinte = self.data + datetime.timedelta(days=1)
+        mommy.make('mercado.Preco', ativo=self.acao, data_referencia=seguinte,
+            preco_fechamento=decimal.Decimal('11'))
+        self.estado.ultimos_precos([self.outra.id], seguinte)
+        terceiro = seguinte + datetime.timedelta(days=1)
+        precos = self.estado.ultimos_precos([self.acao.id], terceiro)
+        self.assertEqual(precos.loc[self.acao.id, 'preco_fechamento'], decimal.Decimal('11'))
+        self.assertEqual(precos.loc[self.acao.id, 'data_referencia'], seguinte)
+
+    def test_quantidades_novas(self):
+        tipo = ContentType.objects.get_for_model(am.Acao)
+        antiga = mommy.make('fundo.Quantidade', fundo=self.fundo, data=self.data,
+            qtd=decimal.Decimal('100'), objeto_quantidade=self.acao,
+            content_object=self.acao)
+        quantidades = fm.Quantidade.objects.filter(fundo=self.fundo)
+        self.assertEqual(self.estado.quantidades_novas(quantidades, tipo, self.data).count(), 1)
+        self.estado.acumular_quantidades(tipo, pd.DataFrame({'id_x': [antiga.id],
+            'qtd': [antiga.qtd]}), self.data)
+        self.assertEqual(self.estado.quantidades_novas(quantidades, tipo, self.data).count(), 0)
+        nova = mommy.make('fundo.Quantidade', fundo=self.fundo, data=self.data,
+            qtd=decimal.Decimal('50'), objeto_quantidade=self.acao,
+            content_object=self.acao)
+        self.assertEqual(list(self.estado.quantidades_novas(quantidades, tipo,
+            self.data).values_list('id', flat=True)), [nova.id])
+        todas = self.estado.acumular_quantidades(tipo, pd.DataFrame({'id_x': [nova.id],
+            'qtd': [nova.qtd]}), self.data)
+        self.assertEqual(todas['qtd'].sum(), decimal.Decimal('150'))
+
+    def test_dias_pendentes(self):
+        dias = self.fundo.dias_fechamento(self.data, self.data + datetime.timedelta(days=6))
+        # 17 e 18/11/2018 são sábado e domingo.
+        self.assertEqual(len(dias), 5)
+        self.assertIsNone(self.fundo.ultima_data_fechada())
+        mommy.make('fundo.Vertice', fundo=self.fundo, data=self.data,
+            content_object=self.acao)
+        self.assertEqual(self.fundo.ultima_data_fechada(), self.data)
+        self.assertEqual(self.fundo.fechar_fundo_pendentes(self.data), [])
+
+class PosicaoTests(TestCase):
+    """
+    Testes das posições consolidadas usadas como ponto de partida do
+    fechamento.
+    """
+    def setUp(self):
+        self.fundo = mommy.make('fundo.Fundo')
+        self.acao = mommy.make('ativos.Acao')
+        self.custodia = mommy.make('fundo.Custodiante')
+        self.corretora = mommy.make('fundo.Corretora')
+        self.tipo = ContentType.objects.get_for_model(am.Acao)
+        self.data = datetime.date(year=2018, month=11, day=14)
+
+    def quantidades(self, qtds):
+        return pd.DataFrame({'tipo_quantidade_id': self.tipo.id,
+            'tipo_id': self.acao.id, 'custodia_id': self.custodia.id,
+            'corretora_id': self.corretora.id, 'qtd': qtds})
+
+    def test_gravar_consolida(self):
+        fm.Posicao.gravar(self.fundo, self.data,
+            self.quantidades([decimal.Decimal('100'), decimal.Decimal('-30')]))
+        posicao = fm.Posicao.objects.get(fundo=self.fundo, data=self.data)
+        self.assertEqual(posicao.qtd, decimal.Decimal('70'))
+        fm.Posicao.gravar(self.fundo, self.data,
+            self.quantidades([decimal.Decimal('100'), decimal.Decimal('-100')]))
+        self.assertFalse(fm.Posicao.objects.filter(fundo=self.fundo).exists())
+
+    def test_juntar_quantidades_parte_da_posicao(self):
+        fm.Posicao.gravar(self.fundo, self.data,
+            self.quantidades([decimal.Decimal('100')]))
+        seguinte = self.data + datetime.timedelta(days=1)
+        carteira = self.fundo.juntar_quantidades(seguinte)
+        self.assertEqual(len(carteira), 1)
+        self.assertEqual(carteira['qtd'].sum(), decimal.Decimal('100'))
+        self.assertEqual(list(carteira['id_x']), [0])
+        self.assertEqual(fm.Posicao.objects.get(fundo=self.fundo,
+            data=seguinte).qtd, decimal.Decimal('100'))
+
+    def test_quantidade_invalida_posicoes(self):
+        seguinte = self.data + datetime.timedelta(days=1)
+        for data in (self.data, seguinte):
+            fm.Posicao.gravar(self.fundo, data,
+                self.quantidades([decimal.Decimal('100')]))
+        quantidade = mommy.make('fundo.Quantidade', fundo=self.fundo,
+            data=seguinte, qtd=decimal.Decimal('10'),
+            objeto_quantidade=self.acao, content_object=self.acao)
+        self.assertEqual(list(fm.Posicao.objects.filter(fundo=self.fundo).\
+            values_list('data', flat=True)), [self.data])
+        quantidade.data = self.data
+        quantidade.save()
+        self.assertFalse(fm.Posicao.objects.filter(fundo=self.fundo).exists())
+
+    def test_juntar_quantidades_ativo_em_uma_consulta(self):
+        for _ in range(3):
+            mommy.make('fundo.Quantidade', fundo=self.fundo, data=self.data,
+                qtd=decimal.Decimal('10'), objeto_quantidade=self.acao,
+                content_object=self.acao, custodia=self.custodia,
+                corretora=self.corretora, ativo=self.acao)
+        with self.assertNumQueries(1):
+            carteira = self.fundo.juntar_quantidades_ativo(self.data, self.tipo)
+        self.assertEqual(carteira['qtd'].sum(), decimal.Decimal('30'))
+        self.assertEqual(set(carteira['custodia_id']), {self.custodia.id})
+        self.assertEqual(set(carteira['nome']), {self.acao.nome})
+
+    def test_reconstruir(self):
+        for data in (self.data, self.data + datetime.timedelta(days=1)):
+            mommy.make('fundo.Quantidade', fundo=self.fundo, data=data,
+                qtd=decimal.Decimal('10'), objeto_quantidade=self.acao,
+                content_object=self.acao, custodia=self.custodia,
+                corretora=self.corretora, ativo=self.acao)
+        gravadas = fm.Posicao.reconstruir(self.fundo,
+            [self.data, self.data + datetime.timedelta(days=1)])
+        self.assertEqual(gravadas, 2)
+        self.assertEqual(list(fm.Posicao.objects.filter(fundo=self.fundo).\
+            order_by('data').values_list('qtd', flat=True)),
+            [decimal.Decimal('10'), decimal.Decimal('20')])
+        # Reconstruir só a última data mantém as posições anteriores.
+        fm.Posicao.reconstruir(self.fundo, [self.data + datetime.timedelta(days=1)])
+        self.assertEqual(fm.Posicao.objects.filter(fundo=self.fundo).count(), 2)
+
+    def test_posicao_sem_corretora(self):
+        quantidades = self.quantidades([decimal.Decimal('100'), decimal.Decimal('-30')])
+        quantidades['corretora_id'] = None
+        fm.Posicao.gravar(self.fundo, self.data, quantidades)
+        posicao = fm.Posicao.objects.get(fundo=self.fundo, data=self.data)
+        self.assertIsNone(posicao.corretora)
+        self.assertEqual(posicao.qtd, decimal.Decimal('70'))
+
+    def test_quantidade_sem_custodia(self):
+        quantidade = mommy.make('fundo.Quantidade', fundo=self.fundo, data=self.data,
+            qtd=decimal.Decimal('10'), objeto_quantidade=self.acao,
+            content_object=self.acao, ativo=self.acao)
+        with self.assertRaisesRegex(ValueError, str(quantidade.id)):
+            self.fundo.juntar_quantidades(self.data)
+        with self.assertRaisesRegex(ValueError, str(quantidade.id)):
+            fm.Posicao.reconstruir(self.fundo, [self.data])
+
+class CriarVerticesTests(TestCase):
+    """
+    Testes da criação de vértices em lote.
+    """
+    def setUp(self):
+        self.fundo = mommy.make('fundo.Fundo',
+            calendario=mommy.make('calendario.Calendario'))
+        self.custodia = mommy.make('fundo.Custodiante')
+        self.corretora = mommy.make('fundo.Corretora')
+        self.data = datetime.date(year=2018, month=11, day=14)
+        cambio = mommy.make('ativos.Cambio')
+        mommy.make('mercado.Preco', ativo=cambio, data_referencia=self.data,
+            preco_fechamento=decimal.Decimal('3.7'))
+        self.config = mommy.make('configuracao.ConfigCambio', fundo=self.fundo)
+        self.config.cambio.add(cambio)
+
+    def comprar(self, quantidade):
+        for _ in range(quantidade):
+            acao = mommy.make('ativos.Acao')
+            mommy.make('mercado.Preco', ativo=acao, data_referencia=self.data,
+                preco_fechamento=decimal.Decimal('10'))
+            for qtd in ('100', '-40'):
+                mommy.make('fundo.Quantidade', fundo=self.fundo, data=self.data,
+                    qtd=decimal.Decimal(qtd), objeto_quantidade=acao,
+                    content_object=acao, custodia=self.custodia,
+                    corretora=self.corretora, ativo=acao)
+
+    def consultas(self):
+        fm.Posicao.objects.all().delete()
+        fm.CasamentoVerticeQuantidade.objects.all().delete()
+        fm.Vertice.objects.all().delete()
+        with CaptureQueriesContext(connection) as contexto:
+            self.fundo.criar_vertices(self.data)
+        return len(contexto.captured_queries)
+
+    def test_cria_vertices_e_casamentos(self):
+        self.comprar(2)
+        self.fundo.criar_vertices(self.data)
+        vertices = fm.Vertice.objects.filter(fundo=self.fundo, data=self.data)
+        self.assertEqual(vertices.count(), 2)
+        for vertice in vertices:
+            self.assertEqual(vertice.quantidade, decimal.Decimal('60'))
+            self.assertEqual(vertice.valor, decimal.Decimal('600'))
+            self.assertEqual(fm.CasamentoVerticeQuantidade.objects.filter(
+                vertice=vertice).count(), 2)
+
+    def test_cambio_com_oito_casas(self):
+        moeda = mommy.make('ativos.Moeda')
+        cambio = mommy.make('ativos.Cambio', moeda_origem=moeda)
+        taxa = decimal.Decimal('3.71234567')
+        mommy.make('mercado.Preco', ativo=cambio, data_referencia=self.data,
+            preco_fechamento=taxa)
+        self.config.cambio.add(cambio)
+        acao = mommy.make('ativos.Acao', moeda=moeda)
+        mommy.make('mercado.Preco', ativo=acao, data_referencia=self.data,
+            preco_fechamento=decimal.Decimal('10.1234567'))
+        mommy.make('fundo.Quantidade', fundo=self.fundo, data=self.data,
+            qtd=decimal.Decimal('333.333333'), objeto_quantidade=acao,
+            content_object=acao, custodia=self.custodia, corretora=self.corretora,
+            ativo=acao)
+        mommy.make('fundo.Movimentacao', fundo=self.fundo, data=self.data,
+            valor=decimal.Decimal('-1234.567891'), objeto_movimentacao=acao,
+            content_object=acao, custodia=self.custodia, corretora=self.corretora,
+            ativo=acao)
+        self.fundo.criar_vertices(self.data)
+        vertice = fm.Vertice.objects.get(fundo=self.fundo, object_id=acao.id)
+        # Fórmula original: preço com 6 casas vezes quantidade vezes o câmbio
+        # do Preco, arredondado só no campo do vértice.
+        preco = decimal.Decimal('10.123457')
+        self.assertEqual(vertice.valor, (preco * decimal.Decimal('333.333333') * \
+            taxa).quantize(decimal.Decimal('1.00')))
+        self.assertEqual(vertice.movimentacao, (decimal.Decimal('-1234.567891') * \
+            taxa).quantize(decimal.Decimal('1.000000')))
+        self.assertEqual(vertice.cambio, decimal.Decimal('3.712346'))
+
+    def test_vertice_sem_corretora(self):
+        acao = mommy.make('ativos.Acao')
+        mommy.make('mercado.Preco', ativo=acao, data_referencia=self.data,
+            preco_fechamento=decimal.Decimal('10'))
+        quantidade = mommy.make('fundo.Quantidade', fundo=self.fundo,
+            data=self.data, qtd=decimal.Decimal('100'), objeto_quantidade=acao,
+            content_object=acao, custodia=self.custodia, ativo=acao)
+        movimentacao = mommy.make('fundo.Movimentacao', fundo=self.fundo,
+            data=self.data, valor=decimal.Decimal('-1000'), objeto_movimentacao=acao,
+            content_object=acao, custodia=self.custodia, ativo=acao)
+        self.fundo.criar_vertices(self.data)
+        vertice = fm.Vertice.objects.get(fundo=self.fundo, object_id=acao.id)
+        self.assertIsNone(vertice.corretora)
+        self.assertEqual(vertice.valor, decimal.Decimal('1000'))
+        self.assertTrue(fm.CasamentoVerticeQuantidade.objects.filter(
+            vertice=vertice, quantidade=quantidade).exists())
+        self.assertTrue(fm.CasamentoVerticeMovimentacao.objects.filter(
+            vertice=vertice, movimentacao=movimentacao).exists())
+
+    def test_movimentacao_sem_custodia(self):
+        acao = mommy.make('ativos.Acao')
+        movimentacao = mommy.make('fundo.Movimentacao', fundo=self.fundo,
+            data=self.data, valor=decimal.Decimal('-1000'), objeto_movimentacao=acao,
+            content_object=acao, corretora=self.corretora, ativo=acao)
+        with self.assertRaisesRegex(ValueError, str(movimentacao.id)):
+            self.fundo.criar_vertices(self.data)
+        self.assertFalse(fm.Vertice.objects.filter(fundo=self.fundo).exists())
+
+    def test_consultas_nao_dependem_do_numero_de_ativos(self):
+        self.comprar(2)
+        # A primeira execução preenche o cache de ContentType.
+        self.consultas()
+        poucos = self.consultas()
+        self.comprar(8)
+        self.assertEqual(self.consultas(), poucos)
+
+    def test_simular_fechamento_nao_grava(self):
+        self.comprar(2)
+        mommy.make('fundo.CertificadoPassivo', fundo=self.fundo, data=self.data,
+            cotas_aplicadas=decimal.Decimal('100'))
+        vertices, carteira = self.fundo.simular_fechamento(self.data)
+        self.assertEqual(len(vertices), 2)
+        self.assertEqual(set(vertices['quantidade']), {decimal.Decimal('60')})
+        self.assertEqual(carteira.pl, decimal.Decimal('1200.00'))
+        self.assertEqual(carteira.cota, decimal.Decimal('12'))
+        self.assertFalse(fm.Vertice.objects.filter(fundo=self.fundo).exists())
+        self.assertFalse(fm.Posicao.objects.filter(fundo=self.fundo).exists())
+        self.assertFalse(fm.Carteira.objects.filter(fundo=self.fundo).exists())
+
+    def test_simular_data_fechada(self):
+        self.comprar(2)
+        mommy.make('fundo.CertificadoPassivo', fundo=self.fundo, data=self.data,
+            cotas_aplicadas=decimal.Decimal('100'))
+        self.fundo.fechar_fundo(self.data)
+        gravados = fm.Vertice.objects.filter(fundo=self.fundo).count()
+        vertices, carteira = self.fundo.simular_fechamento(self.data)
+        # Os vértices já gravados na data não entram na simulação.
+        self.assertEqual(len(vertices), 2)
+        self.assertEqual(carteira.pl, decimal.Decimal('1200.00'))
+        self.assertEqual(fm.Vertice.objects.filter(fundo=self.fundo).count(), gravados)
+
+class PendenciaFechamentoTests(TestCase):
+    """
+    Testes do índice de pendências usado para buscar as boletas no
+    fechamento.
+    """
+    def setUp(self):
+        self.data = datetime.date(year=2018, month=11, day=14)
+        self.caixa = mommy.make('ativos.Caixa')
+        self.fundo = mommy.make('fundo.Fundo', caixa_padrao=self.caixa)
+
+    def test_provisao_fechada_sai_do_fechamento(self):
+        provisoes = mommy.make('boletagem.BoletaProvisao', fundo=self.fundo,
+            caixa_alvo=self.caixa, data_pagamento=self.data + datetime.timedelta(days=2),
+            estado=bm.BoletaProvisao.ESTADO[0][0], _quantity=3)
+        pagamento = provisoes[0].data_pagamento
+        self.assertEqual(provisoes[0].proxima_acao, pagamento)
+        # Antes do pagamento, a provisão não tem o que fazer no fechamento.
+        self.fundo.fechar_boletas_provisao(self.data)
+        self.assertFalse(fm.Quantidade.objects.filter(fundo=self.fundo).exists())
+        self.fundo.fechar_boletas_provisao(pagamento)
+        self.assertEqual(bm.BoletaProvisao.objects.filter(fundo=self.fundo,
+            fechada=True, proxima_acao=None).count(), 3)
+        self.assertEqual(fm.Quantidade.objects.filter(fundo=self.fundo,
+            data=pagamento).count(), 3)
+        self.assertEqual(fm.Movimentacao.objects.filter(fundo=self.fundo,
+            data=pagamento).count(), 3)
+        with self.assertNumQueries(1):
+            self.fundo.fechar_boletas_provisao(pagamento)
+
+    def test_boletas_pendentes_como_ativo(self):
+        self.fundo.gestora = mommy.make('fundo.Gestora', anima=False)
+        self.fundo.save()
+        ativo = mommy.make('ativos.Fundo_Local', gestao=self.fundo)
+        investidor = mommy.make('fundo.Fundo')
+        anterior = self.data - datetime.timedelta(days=2)
+        boletas = [mommy.make('boletagem.BoletaFundoLocal', ativo=ativo,
+            fundo=investidor, data_operacao=anterior, data_cotizacao=anterior,
+            data_liquidacao=liquidacao, operacao=bm.BoletaFundoLocal.OPERACAO[0][0],
+            financeiro=decimal.Decimal('1000'), preco=decimal.Decimal('10'))
+            for liquidacao in (self.data, self.data, anterior)]
+        bm.BoletaFundoLocal.objects.filter(id=boletas[1].id).update(fechada=True)
+        pendentes = self.fundo.boletas_pendentes(bm.BoletaFundoLocal, self.data,
+            self.fundo.janela_cotizacao_liquidacao(self.data), ativo=ativo)
+        self.assertEqual(list(pendentes), [boletas[0]])
+        # A pendência fora da janela segue o fechamento do investidor.
+        self.assertFalse(bm.BoletaFundoLocal.objects.get(id=boletas[2].id).fechada)
+
+    def test_CPR_processado_ate_o_pagamento(self):
+        pagamento = self.data + datetime.timedelta(days=1)
+        cpr = mommy.make('boletagem.BoletaCPR', fundo=self.fundo,
+            data_inicio=self.data, data_pagamento=pagamento)
+        self.assertEqual(cpr.proxima_acao, self.data)
+        cpr.registrar_fechamento(self.data)
+        cpr.refresh_from_db()
+        self.assertEqual(cpr.proxima_acao, pagamento)
+        self.assertFalse(cpr.fechada)
+        cpr.registrar_fechamento(pagamento)
+        cpr.refresh_from_db()
+        self.assertTrue(cpr.fechada)
+        self.assertIsNone(cpr.proxima_acao)
+        bm.BoletaCPR.reabrir_pendencias(self.fundo, pagamento)
+        cpr.refresh_from_db()
+        self.assertEqual(cpr.proxima_acao, pagamento)
+
+    def test_boleta_vencida_marcada_como_fechada(self):
+        cambio = mommy.make('boletagem.BoletaCambio', fundo=self.fundo,
+            data_operacao=self.data - datetime.timedelta(days=3))
+        self.assertFalse(self.fundo.boletas_pendentes(bm.BoletaCambio, self.data,
+            models.Q(data_operacao=self.data)).exists())
+        cambio.refresh_from_db()
+        self.assertTrue(cambio.fechada)
+
+class CarteiraTests(TestCase):
+    """
+    Testes do cálculo das carteiras a partir dos vértices.
+    """
+    def setUp(self):
+        self.data = datetime.date(year=2018, month=11, day=14)
+        self.fundos = []
+
+    def criar_fundo(self, valores, cotas):
+        fundo = mommy.make('fundo.Fundo')
+        for valor in valores:
+            mommy.make('fundo.Vertice', fundo=fundo, data=self.data,
+                valor=decimal.Decimal(valor), movimentacao=decimal.Decimal('0.125'),
+                content_object=mommy.make('ativos.Acao'))
+        for data, qtd in cotas:
+            mommy.make('fundo.CertificadoPassivo', fundo=fundo, data=data,
+                cotas_aplicadas=decimal.Decimal(qtd))
+        self.fundos.append(fundo)
+        return fundo
+
+    def test_total_cotas_aplicadas(self):
+        fundo = self.criar_fundo([], [(self.data - datetime.timedelta(days=1), '10'),
+            (self.data, '5'), (self.data + datetime.timedelta(days=1), '7')])
+        self.assertEqual(fm.CertificadoPassivo.total_cotas_aplicadas(fundo, self.data),
+            decimal.Decimal('15'))
+        self.assertEqual(fm.CertificadoPassivo.total_cotas_aplicadas(fundo,
+            self.data - datetime.timedelta(days=2)), 0)
+
+    def test_calcular_carteiras(self):
+        fundo = self.criar_fundo(['100.10', '50.20'], [(self.data, '10')])
+        sem_cotas = self.criar_fundo(['10'], [])
+        self.assertEqual(fm.Carteira.calcular_carteiras(self.data), 1)
+        carteira = fm.Carteira.objects.get(fundo=fundo, data=self.data)
+        self.assertEqual(carteira.pl, decimal.Decimal('150.30'))
+        self.assertEqual(carteira.movimentacao, decimal.Decimal('0.25'))
+        self.assertEqual(carteira.cota, decimal.Decimal('15.03'))
+        self.assertEqual(carteira.vertices.count(), 2)
+        self.assertFalse(fm.Carteira.objects.filter(fundo=sem_cotas).exists())
+        # Recalcular substitui a carteira da data.
+        fm.Carteira.calcular_carteiras(self.data, [fundo])
+        self.assertEqual(fm.Carteira.objects.filter(fundo=fundo).count(), 1)
+
+    def test_consultas_nao_dependem_do_numero_de_fundos(self):
+        for _ in range(2):
+            self.criar_fundo(['10', '20'], [(self.data, '10')])
+        # As duas medições substituem carteiras já existentes.
+        fm.Carteira.calcular_carteiras(self.data)
+        with CaptureQueriesContext(connection) as poucos:
+            fm.Carteira.calcular_carteiras(self.data)
+        for _ in range(5):
+            self.criar_fundo(['10', '20', '30'], [(self.data, '10')])
+        with CaptureQueriesContext(connection) as muitos:
+            self.assertEqual(fm.Carteira.calcular_carteiras(self.data), 7)
+        self.assertEqual(len(muitos.captured_queries), len(poucos.captured_queries))
+
+class ReprocessarCotaTests(TestCase):
+    """
+    Testes do reprocessamento de uma data já fechada.
+    """
+    def setUp(self):
+        self.data = datetime.date(year=2018, month=11, day=14)
+        self.seguinte = datetime.date(year=2018, month=11, day=15)
+        caixa = mommy.make('ativos.Caixa')
+        self.fundo = mommy.make('fundo.Fundo', caixa_padrao=caixa, nome='Fundo',
+            calendario=mommy.make('calendario.Calendario'))
+        cambio = mommy.make('ativos.Cambio')
+        for data in (self.data, self.seguinte):
+            mommy.make('mercado.Preco', ativo=cambio, data_referencia=data,
+                preco_fechamento=decimal.Decimal('3.7'))
+            mommy.make('mercado.Preco', ativo=caixa, data_referencia=data,
+                preco_fechamento=decimal.Decimal('1'))
+        config = mommy.make('configuracao.ConfigCambio', fundo=self.fundo)
+        config.cambio.add(cambio)
+        cotista = mommy.make('fundo.Cotista', nome='Cotista')
+        self.certificado = mommy.make('fundo.CertificadoPassivo', fundo=self.fundo,
+            cotista=cotista, data=datetime.date(year=2018, month=11, day=1),
+            qtd_cotas=decimal.Decimal('100'), cotas_aplicadas=decimal.Decimal('100'))
+        mommy.make('boletagem.BoletaPassivo', fundo=self.fundo, cotista=cotista,
+            valor=decimal.Decimal('100'), cota=decimal.Decimal('10'),
+            operacao='Resgate', data_operacao=self.data,
+            data_cotizacao=self.seguinte, data_liquidacao=self.seguinte,
+            content_object=None)
+        self.fundo.fechar_fundo_periodo(self.data, self.seguinte)
+
+    def test_desfazer_fechamento(self):
+        anteriores = set(fm.Vertice.objects.filter(fundo=self.fundo,
+            data=self.data).values_list('id', flat=True))
+        self.fundo.desfazer_fechamento(self.seguinte)
+        self.certificado.refresh_from_db()
+        self.assertEqual(self.certificado.cotas_aplicadas, decimal.Decimal('100'))
+        self.assertFalse(fm.Vertice.objects.filter(fundo=self.fundo,
+            data=self.seguinte).exists())
+        self.assertFalse(bm.BoletaProvisao.objects.filter(fundo=self.fundo).exists())
+        self.assertFalse(bm.BoletaCPR.objects.filter(fundo=self.fundo).exists())
+        self.assertEqual(set(fm.Vertice.objects.filter(fundo=self.fundo,
+            data=self.data).values_list('id', flat=True)), anteriores)
+
+    def test_reprocessar_cota(self):
+        vertices = fm.Vertice.objects.filter(fundo=self.fundo, data=self.seguinte)
+        antes = sorted(vertices.values_list('object_id', 'quantidade', 'valor'))
+        self.assertTrue(antes)
+        quantidades = fm.Quantidade.objects.filter(fundo=self.fundo).count()
+        casamentos = fm.CasamentoVerticeQuantidade.objects.count()
+        self.assertEqual(self.fundo.reprocessar_cota(self.seguinte), [self.seguinte])
+        self.assertEqual(sorted(vertices.values_list('object_id', 'quantidade', 'valor')), antes)
+        self.assertEqual(fm.Quantidade.objects.filter(fundo=self.fundo).count(), quantidades)
+        self.assertEqual(fm.CasamentoVerticeQuantidade.objects.count(), casamentos)
+        self.assertEqual(bm.BoletaProvisao.objects.filter(fundo=self.fundo).count(), 1)
+        self.assertEqual(bm.BoletaCPR.objects.filter(fundo=self.fundo).count(), 1)
+        self.certificado.refresh_from_db()
+        self.assertEqual(self.certificado.cotas_aplicadas, decimal.Decimal('90'))
+
+class PontoFixoTests(TestCase):
+    """
+    Testes da aritmética em ponto fixo usada no fechamento.
+    """
+    def test_multiplicar_igual_decimal(self):
+        precos = [decimal.Decimal('12.34567891'), decimal.Decimal('0.000001'),
+            decimal.Decimal('98765.4321')]
+        quantidades = [decimal.Decimal('-1500.5'), decimal.Decimal('123456789.123456'),
+            decimal.Decimal('3')]
+        cambios = [decimal.Decimal('3.712345'), decimal.Decimal('1'),
+            decimal.Decimal('0.268123')]
+        valores = fm.PontoFixo.multiplicar([fm.PontoFixo.de_decimais(precos, 6),
+            fm.PontoFixo.de_decimais(quantidades, 6),
+            fm.PontoFixo.de_decimais(cambios, 6)], [6, 6, 6], 2)
+        for valor, preco, quantidade, cambio in zip(
+            fm.PontoFixo.para_decimais(valores, 2), precos, quantidades, cambios):
+            esperado = (preco.quantize(decimal.Decimal('1.000000')) * quantidade
+                * cambio).quantize(decimal.Decimal('1.00'))
+            self.assertEqual(valor, esperado)
+
+    def test_arredondamento_half_even(self):
+        valores = fm.PontoFixo.de_decimais([decimal.Decimal('0.005'),
+            decimal.Decimal('0.015'), decimal.Decimal('-0.025')], 6)
+        resultado = fm.PontoFixo.multiplicar([valores], [6], 2)
+        self.assertEqual(fm.PontoFixo.para_decimais(resultado, 2),
+            [decimal.Decimal('0.00'), decimal.Decimal('0.02'), decimal.Decimal('-0.02')])
+
+    def test_overflow(self):
+        grande = fm.PontoFixo.de_decimais([decimal.Decimal('10000000000')], 6)
+        with self.assertRaises(OverflowError):
+            fm.PontoFixo.multiplicar([grande, grande], [6, 6], 6)
@@ -7,5 +7,6 @@ app_name='fundos'
 
 urlpatterns = [
     path('fechamento/', views.fechamento, name='fechamento'),
+    path('fechamento/<int:fundo_id>/simular/', views.simular_fechamento, name='simular_fechamento'),
     path('base_site/', TemplateView.as_view(template_name='base_site.html'), name='base_site'),
 ]
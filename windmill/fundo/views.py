@@ -1,3 +1,4 @@
+import datetime
 from django.shortcuts import render, get_object_or_404
 from django.http import HttpResponse
 from django.views.generic import DetailView, ListView, TemplateView
@@ -20,3 +21,23 @@ def fechamento(request):
     except:
         fundos = Fundo.objects.none()
     return render(request, 'fechamento.html', {'fundos': fundos})
+
+def simular_fechamento(request, fundo_id):
+    """
+    Mostra a carteira, o PL e a cota que o fechamento do fundo geraria na
+    data informada (parâmetro data, AAAA-MM-DD), sem gravar nada. A simulação
+    executa o fechamento inteiro, então só roda em requisições POST; o GET
+    apenas mostra o formulário. Enquanto a simulação roda, as boletas que ela
+    fecharia ficam travadas e um fechamento real do fundo espera o seu fim.
+    """
+    fundo = get_object_or_404(Fundo, id=fundo_id)
+    try:
+        data = datetime.datetime.strptime(request.POST.get('data', ''), '%Y-%m-%d').date()
+    except ValueError:
+        data = datetime.date.today()
+    contexto = {'fundo': fundo, 'data': data, 'simulado': request.method == 'POST'}
+    if request.method == 'POST':
+        vertices, carteira = fundo.simular_fechamento(data)
+        contexto['vertices'] = vertices.to_dict('records')
+        contexto['carteira'] = carteira
+    return render(request, 'simulacao_fechamento.html', contexto)
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = 'Atualiza a matriz de preços em disco com os preços novos ou alterados.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reconstruir', action='store_true',
+            help='Gera a matriz novamente a partir de todos os preços.')
+
+    def handle(self, *args, **options):
+        import mercado.models as mm
+        matriz = mm.MatrizPrecos()
+        if options['reconstruir']:
+            lidos = matriz.reconstruir()
+        else:
+            lidos = matriz.atualizar()
+        self.stdout.write('%d preços lidos.' % lidos)
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = 'Carrega um arquivo de preços em formato longo (ativo, data, campos de preço).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('arquivo')
+        parser.add_argument('--separador', default=',')
+        parser.add_argument('--formato-data', default=None,
+            help='Formato das datas do arquivo, ex.: %%d/%%m/%%Y.')
+        parser.add_argument('--tamanho-lote', type=int, default=100000)
+
+    def handle(self, *args, **options):
+        import mercado.models as mm
+        carregador = mm.CarregadorPrecos(options['tamanho_lote'])
+        resultado = carregador.carregar_arquivo(options['arquivo'],
+            options['separador'], options['formato_data'])
+        self.stdout.write('%(lidas)d linhas lidas, %(ignoradas)d ignoradas, '
+            '%(gravadas)d gravadas.' % resultado)
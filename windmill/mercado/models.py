@@ -10,9 +10,17 @@ Responsabilidades deste app:
     acordo com proventos anunciados, como dividendos, split, etc.
     - Este app usa o app Ativos como base para nomes de ativos.
 """
+import contextlib
 import datetime
 import decimal
-from django.db import models
+import io
+import json
+import os
+import numpy as np
+import pandas as pd
+from django.db import connection, models, transaction
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.dispatch import receiver, Signal
 from django.utils import timezone
 import ativos.models as am
 
@@ -87,6 +95,75 @@ class Preco(BaseModel):
     class Meta:
         unique_together = (('ativo', 'data_referencia'),)
 
+    @staticmethod
+    def _dataframe_precos(precos, campo):
+        """
+        Monta o DataFrame de retorno das consultas de preços em lote.
+        """
+        df = pd.DataFrame(list(precos.values_list('ativo_id', 'data_referencia', campo)),
+            columns=['ativo', 'data_referencia', campo])
+        return df.set_index('ativo')
+
+    @staticmethod
+    def ultimos_precos(ativos, data_referencia, campo='preco_fechamento'):
+        """
+        iterable Ativo, date, str -> pd.DataFrame
+        Busca, em uma única consulta, o último preço disponível na data de
+        referência ou antes dela para cada um dos ativos (instâncias ou ids).
+        Retorna um DataFrame indexado pelo id do ativo, com a data do preço
+        encontrado (data_referencia) e o valor do campo de preço pedido.
+        Ativos sem nenhum preço até a data não aparecem no resultado.
+        """
+        precos = Preco.objects.filter(ativo__in=ativos,
+            data_referencia__lte=data_referencia).exclude(**{campo: None})
+        if connection.features.can_distinct_on_fields:
+            # DISTINCT ON mantém só a primeira linha de cada ativo, na ordem
+            # decrescente de data.
+            precos = precos.order_by('ativo_id', '-data_referencia').distinct('ativo_id')
+        else:
+            ultima_data = Preco.objects.filter(ativo=models.OuterRef('ativo'),
+                data_referencia__lte=data_referencia).exclude(**{campo: None}).\
+                order_by('-data_referencia').values('data_referencia')[:1]
+            precos = precos.filter(data_referencia=models.Subquery(ultima_data))
+        return Preco._dataframe_precos(precos, campo)
+
+    @staticmethod
+    def precos_do_dia(ativos, data_referencia, campo='preco_fechamento'):
+        """
+        iterable Ativo, date, str -> pd.DataFrame
+        Como ultimos_precos, mas apenas com os preços da própria data de
+        referência.
+        """
+        precos = Preco.objects.filter(ativo__in=ativos,
+            data_referencia=data_referencia).exclude(**{campo: None})
+        return Preco._dataframe_precos(precos, campo)
+
+    @staticmethod
+    def precos_nas_datas(pares, campo='preco_fechamento'):
+        """
+        iterable (int, date), str -> dict
+        Busca, em uma única consulta, os preços de cada par (id do ativo,
+        data de referência). Retorna um dicionário indexado pelos pares que
+        têm preço, com o valor do campo pedido.
+        """
+        pares = set(pares)
+        if not pares:
+            return {}
+        precos = Preco.objects.filter(ativo_id__in={ativo for ativo, data in pares},
+            data_referencia__in={data for ativo, data in pares}).\
+            exclude(**{campo: None}).values_list('ativo_id', 'data_referencia', campo)
+        return {(ativo, data): valor for ativo, data, valor in precos \
+            if (ativo, data) in pares}
+
+    @staticmethod
+    def preco_do_dia(ativo, data_referencia, campo='preco_fechamento'):
+        """
+        Ativo, date, str -> Decimal
+        Retorna o preço do ativo na data de referência, ou None se não houver.
+        """
+        return Preco.objects.filter(ativo=ativo, data_referencia=data_referencia).\
+            exclude(**{campo: None}).values_list(campo, flat=True).first()
+
 class Provento(BaseModel):
     """
     Armazena informações de proventos de ativos.
@@ -128,3 +205,582 @@ class Provento(BaseModel):
     # emitidos.
     direito_por_acao = models.DecimalField(decimal_places=9, max_digits=11,
         default=None, blank=True, null=True)
+
+
+# Índices de retorno total já calculados, por id de ativo. Assim como o
+# cache de dias úteis do calendário, é local ao processo e descartado, a
+# partir da data alterada, pelos receivers de Preco e Provento.
+_cache_retorno_total = {}
+
+class IndiceRetornoTotal(object):
+    """
+    Índice de retorno total de um ativo: o preço de fechamento multiplicado
+    pelo fator acumulado de ajuste dos proventos com data ex até cada data.
+    Dividendos e JSCP são reinvestidos no fechamento anterior à data ex
+    (fator P/(P - valor líquido)), splits, inplits e bonificações corrigem a
+    quantidade (fator valor bruto) e direitos de subscrição aplicam o fator
+    de correção do preço histórico (fator 1/valor bruto). O retorno total
+    entre duas datas é a razão entre os índices nessas datas.
+    """
+    def __init__(self):
+        self.datas = np.array([], dtype='datetime64[D]')
+        self.precos = np.array([], dtype=np.float64)
+        self.fatores = np.array([], dtype=np.float64)
+        # Primeira data cujo índice precisa ser recalculado. None indica que
+        # o índice está completo.
+        self.invalido_desde = np.datetime64('1900-01-01')
+
+    @property
+    def indice(self):
+        return self.precos * self.fatores
+
+    def invalidar(self, data):
+        data = np.datetime64(data, 'D')
+        if self.invalido_desde is None or data < self.invalido_desde:
+            self.invalido_desde = data
+
+    @staticmethod
+    def fator_provento(tipo, valor_bruto, valor_liquido, preco_anterior):
+        """
+        Retorna o fator pelo qual o índice é multiplicado na data ex do
+        provento.
+        """
+        if tipo in (Provento.TIPO[0][0], Provento.TIPO[1][0]):
+            if np.isnan(preco_anterior) or preco_anterior <= valor_liquido:
+                return 1.0
+            return preco_anterior/(preco_anterior - valor_liquido)
+        elif tipo in (Provento.TIPO[2][0], Provento.TIPO[4][0]):
+            return valor_bruto
+        elif tipo == Provento.TIPO[3][0]:
+            return 1/valor_bruto
+        return 1.0
+
+    @staticmethod
+    def atualizar(ativos):
+        """
+        iterable int -> dict
+        Recalcula, a partir da data invalidada, os índices dos ativos que
+        precisarem, com uma consulta de preços e uma de proventos para todos
+        eles. Retorna os índices dos ativos pedidos.
+        """
+        ativos = set(ativos)
+        for ativo in ativos:
+            if ativo not in _cache_retorno_total:
+                _cache_retorno_total[ativo] = IndiceRetornoTotal()
+        pendentes = {ativo: _cache_retorno_total[ativo] for ativo in ativos
+            if _cache_retorno_total[ativo].invalido_desde is not None}
+        if pendentes:
+            inicio = min(i.invalido_desde for i in pendentes.values()).astype(datetime.date)
+            inicio_proventos = min(i._inicio_proventos() for i in pendentes.values()).\
+                astype(datetime.date)
+            precos = pd.DataFrame(list(Preco.objects.filter(ativo__in=pendentes,
+                data_referencia__gte=inicio).exclude(preco_fechamento=None).\
+                order_by('data_referencia').values_list('ativo_id',
+                'data_referencia', 'preco_fechamento')),
+                columns=['ativo', 'data', 'preco'])
+            proventos = pd.DataFrame(list(Provento.objects.filter(ativo__in=pendentes,
+                data_ex__gte=inicio_proventos).order_by('data_ex').values_list('ativo_id',
+                'data_ex', 'tipo_provento', 'valor_bruto', 'valor_liquido')),
+                columns=['ativo', 'data_ex', 'tipo', 'valor_bruto', 'valor_liquido'])
+            precos_ativo = dict(list(precos.groupby('ativo')))
+            proventos_ativo = dict(list(proventos.groupby('ativo')))
+            for ativo, indice in pendentes.items():
+                indice._recalcular(precos_ativo.get(ativo), proventos_ativo.get(ativo))
+        return {ativo: _cache_retorno_total[ativo] for ativo in ativos}
+
+    def _inicio_proventos(self):
+        """
+        Proventos com data ex posterior ao último preço mantido no
+        recálculo ainda não foram aplicados ao índice.
+        """
+        corte = np.searchsorted(self.datas, self.invalido_desde, side='left')
+        if corte:
+            return self.datas[corte - 1] + 1
+        return np.datetime64('1900-01-01')
+
+    def _recalcular(self, precos, proventos):
+        """
+        Descarta as datas a partir de invalido_desde e recalcula o índice
+        com os preços e proventos dessas datas em diante.
+        """
+        corte = np.searchsorted(self.datas, self.invalido_desde, side='left')
+        ultima_data = self.datas[corte - 1] if corte else None
+        fator_base = self.fatores[corte - 1] if corte else 1.0
+        datas = self.datas[:corte]
+        valores = self.precos[:corte]
+        if precos is not None:
+            novas = precos['data'].values.astype('datetime64[D]')
+            validas = novas >= self.invalido_desde
+            datas = np.concatenate([datas, novas[validas]])
+            valores = np.concatenate([valores,
+                precos['preco'].values[validas].astype(np.float64)])
+        multiplicadores = np.ones(len(datas) - corte)
+        if proventos is not None and len(datas):
+            datas_ex = proventos['data_ex'].values.astype('datetime64[D]')
+            if ultima_data is not None:
+                proventos = proventos[datas_ex > ultima_data]
+                datas_ex = datas_ex[datas_ex > ultima_data]
+            posicoes = np.searchsorted(datas, datas_ex, side='left')
+            for posicao, provento in zip(posicoes, proventos.itertuples()):
+                if posicao >= len(datas):
+                    continue
+                preco_anterior = valores[posicao - 1] if posicao else np.nan
+                fator = self.fator_provento(provento.tipo, float(provento.valor_bruto),
+                    float(provento.valor_liquido), preco_anterior)
+                multiplicadores[posicao - corte] *= fator
+        self.datas = datas
+        self.precos = valores
+        self.fatores = np.concatenate([self.fatores[:corte],
+            fator_base*np.cumprod(multiplicadores)])
+        self.invalido_desde = None
+
+    def valor(self, datas, exato=False):
+        """
+        Retorna o índice na última data com preço em ou antes de cada data,
+        ou NaN se não houver. Com exato, é NaN também quando não há preço
+        na própria data.
+        """
+        datas = np.asarray(datas, dtype='datetime64[D]')
+        posicoes = np.searchsorted(self.datas, datas, side='right') - 1
+        indice = self.indice
+        if not len(indice):
+            return np.full(np.shape(posicoes), np.nan)
+        encontradas = posicoes >= 0
+        if exato:
+            encontradas &= self.datas[np.maximum(posicoes, 0)] == datas
+        return np.where(encontradas, indice[np.maximum(posicoes, 0)], np.nan)
+
+    @staticmethod
+    def retornos(ativos, data_inicio, data_fim, exato=False):
+        """
+        iterable Ativo, date, date, bool -> pd.Series
+        Retorno total, ajustado a proventos, de cada ativo entre as datas de
+        início e fim, indexado pelo id do ativo. Usa o último preço em ou
+        antes de cada data; com exato, exige preço nas próprias datas e o
+        retorno é NaN quando falta algum.
+        """
+        ids = [getattr(ativo, 'id', ativo) for ativo in ativos]
+        indices = IndiceRetornoTotal.atualizar(ids)
+        datas = np.array([data_inicio, data_fim], dtype='datetime64[D]')
+        retornos = {}
+        for ativo in ids:
+            inicio, fim = indices[ativo].valor(datas, exato)
+            retornos[ativo] = fim/inicio - 1
+        return pd.Series(retornos)
+
+    @staticmethod
+    def invalidar_cache(ativo_id=None, data=None):
+        """
+        Marca os índices para recálculo a partir da data. Sem ativo, ou sem
+        data, descarta os índices inteiros.
+        """
+        if ativo_id is None:
+            _cache_retorno_total.clear()
+        elif ativo_id in _cache_retorno_total:
+            if data is None:
+                del _cache_retorno_total[ativo_id]
+            else:
+                _cache_retorno_total[ativo_id].invalidar(data)
+
+
+class MatrizPrecos(object):
+    """
+    Matriz colunar com o histórico de preços: para cada campo de preço do
+    Preco, um array float64 de datas x ativos, com NaN onde não há preço.
+    Os arrays ficam em arquivos .npy no diretório MATRIZ_PRECOS_DIR e são
+    abertos com memory map, então os workers do gunicorn e os processos em
+    lote compartilham as mesmas páginas de memória sem copiar os dados.
+
+    A matriz é atualizada incrementalmente a partir dos preços cujo
+    atualizado_em é posterior à última atualização, menos a MARGEM: o
+    atualizado_em é preenchido no save, e uma transação longa pode ser
+    confirmada depois da atualização com um atualizado_em anterior a ela.
+    Alterações feitas com QuerySet.update ou hard_delete não mudam o
+    atualizado_em e exigem uma reconstrução completa.
+    """
+    CAMPOS = ('preco_fechamento', 'preco_contabil', 'preco_gerencial', 'preco_estimado')
+    # Janela relida a cada atualização. Transações mais longas que ela
+    # exigem uma reconstrução.
+    MARGEM = datetime.timedelta(minutes=10)
+
+    def __init__(self, diretorio=None):
+        from django.conf import settings
+        if diretorio is None:
+            diretorio = getattr(settings, 'MATRIZ_PRECOS_DIR',
+                os.path.join(settings.BASE_DIR, 'dados', 'matriz_precos'))
+        self.diretorio = diretorio
+        self.versao = None
+        self.datas = np.array([], dtype='datetime64[D]')
+        self.ativos = np.array([], dtype=np.int64)
+        self.valores = {}
+
+    def _caminho(self, nome):
+        return os.path.join(self.diretorio, nome + '.npy')
+
+    def _ler_meta(self):
+        try:
+            with open(os.path.join(self.diretorio, 'meta.json')) as arquivo:
+                return json.load(arquivo)
+        except FileNotFoundError:
+            return None
+
+    def _gravar(self, nome, valores):
+        """
+        Grava um array em um arquivo temporário e o coloca no lugar do
+        arquivo da matriz.
+        """
+        caminho = self._caminho(nome)
+        with open(caminho + '.tmp', 'wb') as arquivo:
+            np.save(arquivo, valores)
+        os.replace(caminho + '.tmp', caminho)
+
+    @contextlib.contextmanager
+    def _travar(self, compartilhada=False):
+        """
+        Trava do diretório da matriz entre processos, pelo arquivo 'lock'.
+        Usa flock no Unix, compartilhada para a leitura e exclusiva para a
+        escrita, e msvcrt.locking, sempre exclusiva, no Windows.
+        """
+        with open(os.path.join(self.diretorio, 'lock'), 'a+') as trava:
+            try:
+                import fcntl
+            except ImportError:
+                import msvcrt
+                trava.seek(0)
+                while True:
+                    try:
+                        # LK_LOCK desiste depois de 10 tentativas.
+                        msvcrt.locking(trava.fileno(), msvcrt.LK_LOCK, 1)
+                        break
+                    except OSError:
+                        pass
+                try:
+                    yield
+                finally:
+                    trava.seek(0)
+                    msvcrt.locking(trava.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                fcntl.flock(trava, fcntl.LOCK_SH if compartilhada else fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(trava, fcntl.LOCK_UN)
+
+    def carregar(self):
+        """
+        Abre os arquivos da matriz, se a versão em disco for diferente da
+        carregada. Retorna False se a matriz ainda não foi gerada.
+        """
+        if self._ler_meta() is None:
+            return False
+        # A trava impede a leitura de eixos e valores de versões diferentes
+        # durante uma atualização.
+        with self._travar(compartilhada=True):
+            return self._carregar()
+
+    def _carregar(self):
+        """
+        Como carregar, com a trava do diretório já obtida.
+        """
+        meta = self._ler_meta()
+        if meta is None:
+            return False
+        if meta['versao'] != self.versao:
+            self.datas = np.load(self._caminho('datas'))
+            self.ativos = np.load(self._caminho('ativos'))
+            self.valores = {campo: np.load(self._caminho(campo), mmap_mode='r')
+                for campo in self.CAMPOS}
+            self.versao = meta['versao']
+        return True
+
+    def atualizar(self):
+        """
+        Traz para a matriz os preços criados, alterados ou apagados desde a
+        última atualização. Se aparecerem datas ou ativos novos, os arquivos
+        são regravados com os novos eixos; caso contrário, os valores são
+        escritos nos próprios arquivos. Retorna a quantidade de preços lidos.
+        """
+        os.makedirs(self.diretorio, exist_ok=True)
+        with self._travar():
+            meta = self._ler_meta()
+            precos = Preco.all_objects.all()
+            if meta is not None:
+                self._carregar()
+                precos = precos.filter(atualizado_em__gt=
+                    pd.Timestamp(meta['atualizado_em']).to_pydatetime() - self.MARGEM)
+            df = pd.DataFrame(list(precos.values_list('ativo_id', 'data_referencia',
+                'deletado_em', 'atualizado_em', *self.CAMPOS)),
+                columns=('ativo', 'data', 'deletado_em', 'atualizado_em') + self.CAMPOS)
+            if df.empty:
+                return 0
+            datas = df['data'].values.astype('datetime64[D]')
+            ativos = df['ativo'].values.astype(np.int64)
+            novas_datas = np.union1d(self.datas, datas)
+            novos_ativos = np.union1d(self.ativos, ativos)
+            regravar = meta is None or len(novas_datas) != len(self.datas) or \
+                len(novos_ativos) != len(self.ativos)
+            linhas = np.searchsorted(novas_datas, datas)
+            colunas = np.searchsorted(novos_ativos, ativos)
+            apagados = df['deletado_em'].notnull().values
+            versao = (meta['versao'] + 1) if meta is not None else 1
+            if regravar:
+                self._gravar('datas', novas_datas)
+                self._gravar('ativos', novos_ativos)
+            for campo in self.CAMPOS:
+                valores = df[campo].values.astype(np.float64)
+                valores[apagados] = np.nan
+                if regravar:
+                    caminho = self._caminho(campo)
+                    matriz = np.lib.format.open_memmap(caminho + '.tmp', mode='w+',
+                        dtype=np.float64, shape=(len(novas_datas), len(novos_ativos)))
+                    matriz[:] = np.nan
+                    if campo in self.valores:
+                        matriz[np.ix_(np.searchsorted(novas_datas, self.datas),
+                            np.searchsorted(novos_ativos, self.ativos))] = self.valores[campo]
+                    matriz[linhas, colunas] = valores
+                    matriz.flush()
+                    del matriz
+                    # Os processos que já abriram o arquivo antigo continuam
+                    # lendo a versão anterior até chamarem carregar().
+                    os.replace(caminho + '.tmp', caminho)
+                else:
+                    matriz = np.load(self._caminho(campo), mmap_mode='r+')
+                    matriz[linhas, colunas] = valores
+                    matriz.flush()
+                    del matriz
+            atualizado_em = df['atualizado_em'].max()
+            if meta is not None:
+                atualizado_em = max(atualizado_em, pd.Timestamp(meta['atualizado_em']))
+            with open(os.path.join(self.diretorio, 'meta.json'), 'w') as arquivo:
+                json.dump({'versao': versao, 'atualizado_em': atualizado_em.isoformat()}, arquivo)
+            self.versao = None
+            self._carregar()
+            return len(df)
+
+    def reconstruir(self):
+        """
+        Descarta os arquivos e gera a matriz novamente a partir de todos os
+        preços.
+        """
+        caminho = os.path.join(self.diretorio, 'meta.json')
+        if os.path.exists(caminho):
+            os.remove(caminho)
+        self.datas = np.array([], dtype='datetime64[D]')
+        self.ativos = np.array([], dtype=np.int64)
+        self.valores = {}
+        self.versao = None
+        return self.atualizar()
+
+    def fatia(self, campo='preco_fechamento', data_inicio=None, data_fim=None, ativos=None):
+        """
+        str, date, date, iterable int -> (np.ndarray, np.ndarray, np.ndarray)
+        Retorna as datas, os ids dos ativos e os valores da matriz entre as
+        datas de início e fim, inclusive. Sem ativos, a fatia contém todos.
+        Quando os ativos não são informados, os valores são uma visão do
+        arquivo mapeado, sem cópia.
+        """
+        if not self.valores and not self.carregar():
+            raise ValueError("Matriz de preços não gerada.")
+        inicio = 0 if data_inicio is None else \
+            np.searchsorted(self.datas, np.datetime64(data_inicio, 'D'), side='left')
+        fim = len(self.datas) if data_fim is None else \
+            np.searchsorted(self.datas, np.datetime64(data_fim, 'D'), side='right')
+        valores = self.valores[campo][inicio:fim]
+        if ativos is None:
+            return self.datas[inicio:fim], self.ativos, valores
+        ativos = np.asarray(list(ativos), dtype=np.int64)
+        resultado = np.full((fim - inicio, len(ativos)), np.nan)
+        if len(self.ativos):
+            colunas = np.minimum(np.searchsorted(self.ativos, ativos), len(self.ativos) - 1)
+            encontrados = self.ativos[colunas] == ativos
+            resultado[:, encontrados] = valores[:, colunas[encontrados]]
+        return self.datas[inicio:fim], ativos, resultado
+
+    def serie(self, ativo, campo='preco_fechamento', data_inicio=None, data_fim=None):
+        """
+        int, str, date, date -> pd.Series
+        Série de preços de um ativo, indexada pela data, sem os dias sem
+        preço.
+        """
+        datas, ativos, valores = self.fatia(campo, data_inicio, data_fim, [ativo])
+        serie = pd.Series(valores[:, 0], index=pd.DatetimeIndex(datas))
+        return serie.dropna()
+
+
+class CarregadorPrecos(object):
+    """
+    Carga de preços em lote, a partir de arquivos em formato longo: uma
+    linha por ativo e data, com a coluna 'ativo' (nome, ticker da Bloomberg
+    ou ISIN), a coluna 'data' e qualquer subconjunto dos campos de preço.
+    Os identificadores são resolvidos por um dicionário carregado uma única
+    vez. No PostgreSQL, cada lote é copiado com COPY para uma tabela
+    temporária e mesclado no Preco com INSERT ... ON CONFLICT; nos demais
+    bancos, com bulk_create e atualizações apenas das linhas alteradas.
+    Campos vazios no arquivo não apagam valores já gravados, e linhas
+    idênticas às gravadas não são alteradas, então recarregar o mesmo
+    arquivo não muda nada.
+    """
+    CAMPOS = MatrizPrecos.CAMPOS
+
+    def __init__(self, tamanho_lote=100000):
+        import ativos.models as am
+        self.tamanho_lote = tamanho_lote
+        self.identificadores = {}
+        for id, nome, ticker, isin in am.Ativo.objects.values_list('id', 'nome',
+            'bbg_ticker', 'isin'):
+            for identificador in (nome, ticker, isin):
+                if identificador:
+                    self.identificadores[identificador] = id
+
+    def carregar_arquivo(self, arquivo, separador=',', formato_data=None):
+        """
+        str ou file, str, str -> dict
+        Lê o arquivo em lotes e carrega os preços. Retorna a quantidade de
+        linhas lidas, ignoradas (ativo desconhecido, data ou preço inválido)
+        e gravadas (inseridas ou alteradas).
+        """
+        resultado = {'lidas': 0, 'ignoradas': 0, 'gravadas': 0}
+        lotes = pd.read_csv(arquivo, sep=separador, dtype=str,
+            chunksize=self.tamanho_lote, keep_default_na=False)
+        for lote in lotes:
+            parcial = self.carregar_dataframe(lote, formato_data)
+            for chave in resultado:
+                resultado[chave] += parcial[chave]
+        return resultado
+
+    def carregar_dataframe(self, df, formato_data=None):
+        """
+        pd.DataFrame, str -> dict
+        Carrega um DataFrame com as colunas do arquivo de preços.
+        """
+        lidas = len(df)
+        df = df.rename(columns={'data_referencia': 'data'})
+        campos = [campo for campo in self.CAMPOS if campo in df.columns]
+        if not campos:
+            raise ValueError("Arquivo de preços sem nenhum campo de preço.")
+        precos = pd.DataFrame({
+            'ativo_id': df['ativo'].str.strip().map(self.identificadores),
+            'data_referencia': pd.to_datetime(df['data'], format=formato_data,
+                errors='coerce').dt.date,
+        })
+        invalidas = pd.Series(False, index=df.index)
+        for campo in campos:
+            # Células vazias, None e NaN são campos não informados. Os
+            # valores seguem como texto, para não perder casas decimais.
+            valores = df[campo].where(df[campo].notnull(), '').astype(str).str.strip().\
+                str.replace(',', '.', regex=False)
+            valores = valores.where(~valores.str.lower().isin(('nan', 'none')), '')
+            numeros = pd.to_numeric(valores.where(valores != ''), errors='coerce')
+            # Números que não cabem no campo também invalidam a linha.
+            invalidas |= (valores != '') & ~(np.isfinite(numeros) & (numeros.abs() < 10**7))
+            precos[campo] = valores.where(valores != '', None)
+        precos = precos[~invalidas].dropna(subset=['ativo_id', 'data_referencia'])
+        precos['ativo_id'] = precos['ativo_id'].astype(int)
+        # Um par (ativo, data) só pode aparecer uma vez em cada mesclagem.
+        precos = precos.drop_duplicates(subset=['ativo_id', 'data_referencia'], keep='last')
+        if precos.empty:
+            gravadas = 0
+        elif connection.vendor == 'postgresql':
+            gravadas = self._mesclar_postgres(precos, campos)
+        else:
+            gravadas = self._mesclar_orm(precos, campos)
+        # Cargas em lote não disparam sinais.
+        for ativo, data in precos.groupby('ativo_id')['data_referencia'].min().items():
+            IndiceRetornoTotal.invalidar_cache(ativo, data)
+        if 'preco_fechamento' in campos:
+            cotados = precos.dropna(subset=['preco_fechamento'])
+            precos_carregados.send(sender=Preco, pares=[(int(ativo), data) for \
+                ativo, data in zip(cotados['ativo_id'], cotados['data_referencia'])])
+        return {'lidas': lidas, 'ignoradas': lidas - len(precos), 'gravadas': gravadas}
+
+    def _mesclar_postgres(self, precos, campos):
+        """
+        Copia o lote para uma tabela temporária e o mescla no Preco.
+        """
+        tabela = Preco._meta.db_table
+        colunas = ['ativo_id', 'data_referencia'] + campos
+        buffer = io.StringIO()
+        precos[colunas].to_csv(buffer, header=False, index=False)
+        buffer.seek(0)
+        atribuicoes = ', '.join('%s = COALESCE(EXCLUDED.%s, p.%s)' % (c, c, c) for c in campos)
+        atuais = ', '.join(['p.%s' % c for c in campos] + ['p.deletado_em'])
+        novos = ', '.join(['COALESCE(EXCLUDED.%s, p.%s)' % (c, c) for c in campos] + ['NULL'])
+        with transaction.atomic(), connection.cursor() as cursor:
+            # Dentro de uma transação externa, a tabela de um lote anterior
+            # ainda existe: é reaproveitada, com todas as colunas de preço.
+            cursor.execute('CREATE TEMP TABLE IF NOT EXISTS preco_carga (ativo_id integer, '
+                'data_referencia date, %s) ON COMMIT DROP' %
+                ', '.join('%s numeric(15, 8)' % c for c in self.CAMPOS))
+            cursor.execute('TRUNCATE preco_carga')
+            cursor.copy_expert('COPY preco_carga (%s) FROM STDIN WITH CSV' %
+                ', '.join(colunas), buffer)
+            cursor.execute(
+                'INSERT INTO {tabela} AS p ({colunas}, criado_em, atualizado_em) '
+                'SELECT {colunas}, now(), now() FROM preco_carga '
+                'ON CONFLICT (ativo_id, data_referencia) DO UPDATE SET {atribuicoes}, '
+                'atualizado_em = now(), deletado_em = NULL '
+                'WHERE ({atuais}) IS DISTINCT FROM ({novos})'.format(tabela=tabela,
+                colunas=', '.join(colunas), atribuicoes=atribuicoes, atuais=atuais,
+                novos=novos))
+            return cursor.rowcount
+
+    def _mesclar_orm(self, precos, campos):
+        """
+        Mesclagem portável: insere os preços novos com bulk_create e atualiza
+        apenas os existentes que mudaram.
+        """
+        registros = precos.to_dict('records')
+        for registro in registros:
+            for campo in campos:
+                if registro[campo] is not None:
+                    registro[campo] = decimal.Decimal(registro[campo])
+        existentes = {(p['ativo_id'], p['data_referencia']): p for p in
+            Preco.all_objects.filter(ativo_id__in=precos['ativo_id'].unique().tolist(),
+                data_referencia__gte=precos['data_referencia'].min(),
+                data_referencia__lte=precos['data_referencia'].max()).\
+            values('id', 'ativo_id', 'data_referencia', 'deletado_em', *campos)}
+        novos = []
+        gravadas = 0
+        agora = timezone.now()
+        with transaction.atomic():
+            for registro in registros:
+                atual = existentes.get((registro['ativo_id'], registro['data_referencia']))
+                if atual is None:
+                    novos.append(Preco(**registro))
+                    continue
+                alteracoes = {campo: registro[campo] for campo in campos
+                    if registro[campo] is not None and registro[campo] != atual[campo]}
+                if alteracoes or atual['deletado_em'] is not None:
+                    Preco.all_objects.filter(id=atual['id']).update(deletado_em=None,
+                        atualizado_em=agora, **alteracoes)
+                    gravadas += 1
+            Preco.objects.bulk_create(novos, batch_size=5000)
+        return gravadas + len(novos)
+
+
+# Enviado pelas cargas em lote, que não disparam post_save, com os pares
+# (id do ativo, data de referência) gravados com preço de fechamento.
+precos_carregados = Signal(providing_args=['pares'])
+
+"""
+Invalidação do cache de retorno total
+"""
+
+@receiver(pre_save, sender=Preco)
+@receiver(pre_save, sender=Provento)
+def guardar_data_anterior(sender, instance, **kwargs):
+    campo = 'data_referencia' if sender == Preco else 'data_ex'
+    instance._data_anterior = None
+    if instance.pk is not None:
+        instance._data_anterior = sender.all_objects.filter(pk=instance.pk).\
+            values_list(campo, flat=True).first()
+
+@receiver(post_save, sender=Preco)
+@receiver(post_delete, sender=Preco)
+@receiver(post_save, sender=Provento)
+@receiver(post_delete, sender=Provento)
+def invalidar_retorno_total(sender, instance, **kwargs):
+    data = instance.data_referencia if sender == Preco else instance.data_ex
+    if getattr(instance, '_data_anterior', None) is not None:
+        data = min(data, instance._data_anterior)
+    IndiceRetornoTotal.invalidar_cache(instance.ativo_id, data)
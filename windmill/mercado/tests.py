@@ -1,3 +1,243 @@
+import datetime
+import decimal
+import numpy as np
+import pandas as pd
 from django.test import TestCase
+from model_mommy import mommy
+import mercado.models as mm
 
-# Create your tests here.
+class PrecoUnitTests(TestCase):
+    """
+    Testes da busca de preços em lote.
+    """
+    def setUp(self):
+        self.acao = mommy.make('ativos.Acao')
+        self.fundo = mommy.make('ativos.Fundo_Local')
+        self.sem_preco = mommy.make('ativos.Acao')
+        self.data = datetime.date(year=2018, month=11, day=14)
+        for dias, valor in ((-3, '10'), (-1, '11'), (1, '12')):
+            mommy.make('mercado.Preco', ativo=self.acao,
+                data_referencia=self.data + datetime.timedelta(days=dias),
+                preco_fechamento=decimal.Decimal(valor))
+        mommy.make('mercado.Preco', ativo=self.fundo,
+            data_referencia=self.data - datetime.timedelta(days=5),
+            preco_fechamento=decimal.Decimal('100'))
+        # Preço sem fechamento não deve ser considerado.
+        mommy.make('mercado.Preco', ativo=self.fundo,
+            data_referencia=self.data, preco_contabil=decimal.Decimal('99'))
+
+    def test_ultimos_precos(self):
+        with self.assertNumQueries(1):
+            precos = mm.Preco.ultimos_precos([self.acao, self.fundo.id,
+                self.sem_preco], self.data)
+        self.assertEqual(len(precos), 2)
+        self.assertEqual(precos.loc[self.acao.id, 'preco_fechamento'], decimal.Decimal('11'))
+        self.assertEqual(precos.loc[self.acao.id, 'data_referencia'],
+            self.data - datetime.timedelta(days=1))
+        self.assertEqual(precos.loc[self.fundo.id, 'data_referencia'],
+            self.data - datetime.timedelta(days=5))
+        contabil = mm.Preco.ultimos_precos([self.fundo], self.data, 'preco_contabil')
+        self.assertEqual(contabil.loc[self.fundo.id, 'preco_contabil'], decimal.Decimal('99'))
+
+    def test_preco_do_dia(self):
+        self.assertIsNone(mm.Preco.preco_do_dia(self.acao, self.data))
+        self.assertIsNone(mm.Preco.preco_do_dia(self.fundo, self.data))
+        self.assertEqual(mm.Preco.preco_do_dia(self.acao,
+            self.data + datetime.timedelta(days=1)), decimal.Decimal('12'))
+        self.assertEqual(len(mm.Preco.precos_do_dia([self.acao, self.fundo], self.data)), 0)
+
+class MatrizPrecosUnitTests(TestCase):
+    """
+    Testes da matriz de preços persistida em disco.
+    """
+    def setUp(self):
+        import tempfile
+        self.diretorio = tempfile.TemporaryDirectory()
+        self.matriz = mm.MatrizPrecos(self.diretorio.name)
+        self.acao = mommy.make('ativos.Acao')
+        self.outra = mommy.make('ativos.Acao')
+        self.data = datetime.date(year=2018, month=11, day=14)
+        mommy.make('mercado.Preco', ativo=self.acao, data_referencia=self.data,
+            preco_fechamento=decimal.Decimal('10'))
+        mommy.make('mercado.Preco', ativo=self.outra,
+            data_referencia=self.data + datetime.timedelta(days=1),
+            preco_fechamento=decimal.Decimal('20'), preco_contabil=decimal.Decimal('21'))
+
+    def tearDown(self):
+        self.diretorio.cleanup()
+
+    def test_gera_matriz(self):
+        self.assertEqual(self.matriz.atualizar(), 2)
+        datas, ativos, valores = self.matriz.fatia('preco_fechamento')
+        self.assertEqual(valores.shape, (2, 2))
+        serie = self.matriz.serie(self.outra.id, 'preco_contabil')
+        self.assertEqual(list(serie.values), [21.0])
+        # Outro processo abre os mesmos arquivos.
+        leitor = mm.MatrizPrecos(self.diretorio.name)
+        with self.assertNumQueries(0):
+            datas, ativos, valores = leitor.fatia('preco_fechamento',
+                self.data, self.data, [self.acao.id, self.outra.id, 0])
+        self.assertEqual(valores[0, 0], 10.0)
+        self.assertTrue(np.isnan(valores[0, 1]))
+        self.assertTrue(np.isnan(valores[0, 2]))
+
+    def test_atualizacao_incremental(self):
+        # Sem a margem, só os preços alterados são relidos.
+        self.matriz.MARGEM = datetime.timedelta(0)
+        self.matriz.atualizar()
+        leitor = mm.MatrizPrecos(self.diretorio.name)
+        leitor.carregar()
+        preco = mm.Preco.objects.get(ativo=self.acao)
+        preco.preco_fechamento = decimal.Decimal('11')
+        preco.save()
+        # Nenhuma data ou ativo novo: a atualização é feita no próprio arquivo.
+        self.assertEqual(self.matriz.atualizar(), 1)
+        self.assertEqual(leitor.serie(self.acao.id).iloc[0], 11.0)
+        preco.delete()
+        mommy.make('mercado.Preco', ativo=self.acao,
+            data_referencia=self.data + datetime.timedelta(days=2),
+            preco_fechamento=decimal.Decimal('12'))
+        self.assertEqual(self.matriz.atualizar(), 2)
+        self.assertEqual(self.matriz.atualizar(), 0)
+        leitor.carregar()
+        self.assertEqual(list(leitor.serie(self.acao.id).values), [12.0])
+
+    def test_transacao_confirmada_depois_da_atualizacao(self):
+        self.matriz.atualizar()
+        # Preço gravado em uma transação que começou antes da atualização e
+        # foi confirmada depois dela.
+        preco = mommy.make('mercado.Preco', ativo=self.acao,
+            data_referencia=self.data + datetime.timedelta(days=1),
+            preco_fechamento=decimal.Decimal('13'))
+        meta = self.matriz._ler_meta()
+        mm.Preco.objects.filter(id=preco.id).update(atualizado_em=
+            pd.Timestamp(meta['atualizado_em']).to_pydatetime() - datetime.timedelta(minutes=1))
+        self.matriz.atualizar()
+        self.assertEqual(list(self.matriz.serie(self.acao.id).values), [10.0, 13.0])
+
+class CarregadorPrecosUnitTests(TestCase):
+    """
+    Testes da carga de preços em lote.
+    """
+    ARQUIVO = (
+        'ativo;data;preco_fechamento;preco_contabil\n'
+        'PETR4;14/11/2018;10,5;\n'
+        'BR0000000001;14/11/2018;20;21\n'
+        'DESCONHECIDO;14/11/2018;1;\n'
+        'PETR4;16/11/2018;11;\n'
+    )
+
+    def setUp(self):
+        self.petr = mommy.make('ativos.Acao', nome='PETR4')
+        self.outra = mommy.make('ativos.Acao', isin='BR0000000001')
+        self.data = datetime.date(year=2018, month=11, day=14)
+
+    def carregar(self, conteudo):
+        import io
+        carregador = mm.CarregadorPrecos()
+        return carregador.carregar_arquivo(io.StringIO(conteudo), ';', '%d/%m/%Y')
+
+    def test_carregar_arquivo(self):
+        self.assertEqual(self.carregar(self.ARQUIVO),
+            {'lidas': 4, 'ignoradas': 1, 'gravadas': 3})
+        preco = mm.Preco.objects.get(ativo=self.petr, data_referencia=self.data)
+        self.assertEqual(preco.preco_fechamento, decimal.Decimal('10.5'))
+        self.assertIsNone(preco.preco_contabil)
+        self.assertEqual(mm.Preco.objects.get(ativo=self.outra).preco_contabil,
+            decimal.Decimal('21'))
+
+    def test_ignora_precos_invalidos(self):
+        resultado = self.carregar('ativo;data;preco_fechamento\n'
+            'PETR4;14/11/2018;abc\nPETR4;15/11/2018;1e20\nBR0000000001;14/11/2018;20\n')
+        self.assertEqual(resultado, {'lidas': 3, 'ignoradas': 2, 'gravadas': 1})
+        self.assertFalse(mm.Preco.objects.filter(ativo=self.petr).exists())
+
+    def test_dataframe_com_valores_ausentes(self):
+        carregador = mm.CarregadorPrecos()
+        resultado = carregador.carregar_dataframe(pd.DataFrame({
+            'ativo': ['PETR4', 'BR0000000001'],
+            'data': ['2018-11-14', '2018-11-14'],
+            'preco_fechamento': [10.5, np.nan],
+            'preco_contabil': [None, '21'],
+        }))
+        self.assertEqual(resultado['gravadas'], 2)
+        preco = mm.Preco.objects.get(ativo=self.petr)
+        self.assertEqual(preco.preco_fechamento, decimal.Decimal('10.5'))
+        self.assertIsNone(preco.preco_contabil)
+        preco = mm.Preco.objects.get(ativo=self.outra)
+        self.assertIsNone(preco.preco_fechamento)
+        self.assertEqual(preco.preco_contabil, decimal.Decimal('21'))
+
+    def test_recarga_sem_alteracoes(self):
+        self.carregar(self.ARQUIVO)
+        self.assertEqual(self.carregar(self.ARQUIVO)['gravadas'], 0)
+        self.assertEqual(mm.Preco.objects.count(), 3)
+
+    def test_atualiza_apenas_campos_informados(self):
+        self.carregar(self.ARQUIVO)
+        resultado = self.carregar('ativo;data;preco_contabil\nPETR4;14/11/2018;9\n')
+        self.assertEqual(resultado['gravadas'], 1)
+        preco = mm.Preco.objects.get(ativo=self.petr, data_referencia=self.data)
+        self.assertEqual(preco.preco_fechamento, decimal.Decimal('10.5'))
+        self.assertEqual(preco.preco_contabil, decimal.Decimal('9'))
+
+class IndiceRetornoTotalUnitTests(TestCase):
+    """
+    Testes do índice de retorno total ajustado a proventos.
+    """
+    def setUp(self):
+        mm.IndiceRetornoTotal.invalidar_cache()
+        self.acao = mommy.make('ativos.Acao')
+        self.inicio = datetime.date(year=2018, month=11, day=12)
+        # Preços de 12/11 a 16/11.
+        for dias, valor in enumerate(('10', '10', '9', '9', '4.5')):
+            mommy.make('mercado.Preco', ativo=self.acao,
+                data_referencia=self.inicio + datetime.timedelta(days=dias),
+                preco_fechamento=decimal.Decimal(valor))
+        # Dividendo de 1 por ação com data ex em 14/11 e split 2 para 1 com
+        # data ex em 16/11.
+        self.dividendo = mommy.make('mercado.Provento', ativo=self.acao,
+            tipo_provento='Dividendo', data_com=self.inicio + datetime.timedelta(days=1),
+            data_ex=self.inicio + datetime.timedelta(days=2),
+            valor_bruto=decimal.Decimal('1'), valor_liquido=decimal.Decimal('1'))
+        mommy.make('mercado.Provento', ativo=self.acao,
+            tipo_provento='Stock Split/Inplit', data_com=self.inicio + datetime.timedelta(days=3),
+            data_ex=self.inicio + datetime.timedelta(days=4),
+            valor_bruto=decimal.Decimal('2'), valor_liquido=decimal.Decimal('2'))
+        self.fim = self.inicio + datetime.timedelta(days=4)
+
+    def test_retorno_ajustado(self):
+        retorno = self.acao.retorno_do_periodo(self.inicio, self.fim, dividendos=True)
+        self.assertEqual(retorno, decimal.Decimal('0'))
+        self.assertEqual(self.acao.retorno_do_periodo(self.inicio, self.fim),
+            decimal.Decimal('-0.55'))
+
+    def test_retorno_exige_precos_nas_datas(self):
+        sem_preco = self.fim + datetime.timedelta(days=1)
+        with self.assertRaises(mm.Preco.DoesNotExist):
+            self.acao.retorno_do_periodo(self.inicio, sem_preco)
+        with self.assertRaises(mm.Preco.DoesNotExist):
+            self.acao.retorno_do_periodo(self.inicio, sem_preco, dividendos=True)
+        retornos = mm.IndiceRetornoTotal.retornos([self.acao], self.inicio, sem_preco)
+        self.assertAlmostEqual(retornos[self.acao.id], 0)
+
+    def test_sem_consultas_apos_calculo(self):
+        mm.IndiceRetornoTotal.retornos([self.acao], self.inicio, self.fim)
+        with self.assertNumQueries(0):
+            retornos = mm.IndiceRetornoTotal.retornos([self.acao.id],
+                self.inicio, self.fim - datetime.timedelta(days=1))
+        self.assertAlmostEqual(retornos[self.acao.id], 0)
+
+    def test_recalcula_a_partir_do_provento_alterado(self):
+        mm.IndiceRetornoTotal.retornos([self.acao], self.inicio, self.fim)
+        indice = mm._cache_retorno_total[self.acao.id]
+        self.dividendo.valor_liquido = decimal.Decimal('0')
+        self.dividendo.save()
+        self.assertEqual(indice.invalido_desde, np.datetime64(self.dividendo.data_ex))
+        retornos = mm.IndiceRetornoTotal.retornos([self.acao], self.inicio, self.fim)
+        self.assertAlmostEqual(retornos[self.acao.id], -0.1)
+        novo = self.fim + datetime.timedelta(days=1)
+        mommy.make('mercado.Preco', ativo=self.acao, data_referencia=novo,
+            preco_fechamento=decimal.Decimal('5.4'))
+        retornos = mm.IndiceRetornoTotal.retornos([self.acao], self.inicio, novo)
+        self.assertAlmostEqual(retornos[self.acao.id], 0.08)